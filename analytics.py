@@ -0,0 +1,315 @@
+#!/bin/python3
+
+"""
+Vectorized analytics over the watch and rating history.
+
+The whole history is bulk loaded with binary COPY straight into NumPy arrays
+(one array per column) and every statistic is computed with array operations
+instead of another GROUP BY on the server, so tens of millions of events can
+be crunched in seconds on one machine.
+
+With shards the watches and ratings of every shard are loaded and put
+together, each shard read from a replica when it has one. The catalog
+links come from the directory, the shards hold copies of them.
+
+usage: analytics.py
+"""
+
+import io
+import sys
+
+import numpy as np
+
+import routing
+
+# Every column is cast to a fixed width type and never NULL so rows can be
+# read straight out of the COPY buffer with a structured dtype
+WATCH_QUERY = """
+SELECT userid::int4, movieid::int4, EXTRACT(EPOCH FROM datetime)::int8, COALESCE(watchduration, 0)::int4
+FROM watched
+"""
+
+RATING_QUERY = """
+SELECT userid::int4, movieid::int4, rating::int4
+FROM rated
+WHERE rating IS NOT NULL
+"""
+
+MOVIE_GENRE_QUERY = "SELECT movieid::int4, genreid::int4 FROM moviegenre"
+MOVIE_STUDIO_QUERY = "SELECT movieid::int4, studioid::int4 FROM produced"
+
+# The fixed part of a binary COPY stream: signature, flags and header extension length
+COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\0"
+COPY_HEADER_SIZE = len(COPY_SIGNATURE) + 8
+
+# Largest star rating
+MAX_RATING = 5
+
+
+def copy_columns(conn, query: str, types: list[str]) -> list[np.ndarray]:
+    """
+    Runs a query through binary COPY and splits the result into arrays.
+
+    :param conn: Connection to the database.
+    :param query: Query whose columns are all non-null and fixed width.
+    :param types: Big endian NumPy type of each column (e.g. '>i4').
+    :return: One native-endian array per column.
+    """
+    buffer = io.BytesIO()
+    with conn.cursor() as curs:
+        curs.copy_expert("COPY ({}) TO STDOUT WITH (FORMAT binary)".format(query), buffer)
+    data = buffer.getbuffer()
+
+    if bytes(data[:len(COPY_SIGNATURE)]) != COPY_SIGNATURE:
+        raise ValueError("Unexpected COPY header")
+    extension_length = int.from_bytes(data[len(COPY_SIGNATURE) + 4:COPY_HEADER_SIZE], "big")
+    start = COPY_HEADER_SIZE + extension_length
+
+    # each row is a field count followed by (length, value) for every field
+    fields = [("count", ">i2")]
+    for i, column_type in enumerate(types):
+        fields.append(("length%d" % i, ">i4"))
+        fields.append(("value%d" % i, column_type))
+    row_type = np.dtype(fields)
+
+    # the stream ends with a 2 byte trailer
+    row_count = (len(data) - start - 2) // row_type.itemsize
+    rows = np.frombuffer(data, dtype=row_type, count=row_count, offset=start)
+    columns = [rows["value%d" % i].astype(np.dtype(column_type).newbyteorder("=")) for i, column_type in enumerate(types)]
+
+    del rows
+    data.release()
+    return columns
+
+
+def read_connection(conn):
+    """
+    The connection to read a database from, a replica when one is fresh enough.
+
+    :param conn: A connection or Router.
+    """
+    if isinstance(conn, routing.Router):
+        return conn.for_read()
+    return conn
+
+
+def copy_shard_columns(conn, query: str, types: list[str]) -> list[np.ndarray]:
+    """
+    copy_columns on every shard, each column concatenated in shard order.
+
+    :param conn: A connection, Router or ShardRouter.
+    """
+    shards = conn.shards if isinstance(conn, routing.ShardRouter) else [conn]
+    parts = []
+    for shard in shards:
+        shard_conn = read_connection(shard)
+        parts.append(copy_columns(shard_conn, query, types))
+        shard_conn.commit()
+    return [np.concatenate(columns) for columns in zip(*parts)]
+
+
+class History():
+    def __init__(self, conn):
+        """
+        Loads the watch and rating history and the genre and studio links.
+
+        :param conn: Connection, Router or ShardRouter.
+        """
+        self.watch_user, self.watch_movie, self.watch_time, self.watch_duration = copy_shard_columns(conn, WATCH_QUERY, [">i4", ">i4", ">i8", ">i4"])
+        self.rate_user, self.rate_movie, self.rating = copy_shard_columns(conn, RATING_QUERY, [">i4", ">i4", ">i4"])
+
+        # the catalog is the same everywhere
+        conn = read_connection(conn.shards[0] if isinstance(conn, routing.ShardRouter) else conn)
+        self.genre_movie, self.genre_id = copy_columns(conn, MOVIE_GENRE_QUERY, [">i4", ">i4"])
+        self.studio_movie, self.studio_id = copy_columns(conn, MOVIE_STUDIO_QUERY, [">i4", ">i4"])
+
+        with conn.cursor() as curs:
+            curs.execute("SELECT genreid, genrename FROM genre")
+            self.genre_names = dict(curs.fetchall())
+            curs.execute("SELECT studioid, name FROM studio")
+            self.studio_names = dict(curs.fetchall())
+        conn.commit()
+
+
+def expand_links(event_movies: np.ndarray, link_movies: np.ndarray, link_entities: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Pairs every event with every entity (genre, studio, ...) linked to its
+    movie, an event for a movie with three genres comes out three times.
+
+    :param event_movies: Movie id of each event.
+    :param link_movies: Movie id of each link.
+    :param link_entities: Entity id of each link.
+    :return: (event index, entity id) arrays of equal length.
+    """
+    order = np.argsort(link_movies, kind="stable")
+    link_movies = link_movies[order]
+    link_entities = link_entities[order]
+
+    starts = np.searchsorted(link_movies, event_movies, side="left")
+    counts = np.searchsorted(link_movies, event_movies, side="right") - starts
+
+    event_index = np.repeat(np.arange(len(event_movies)), counts)
+    # position of each expanded row within its event's run of links
+    run_offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return event_index, link_entities[np.repeat(starts, counts) + run_offsets]
+
+
+def rating_distribution(history: History) -> np.ndarray:
+    """
+    How many ratings were given at each star level.
+
+    :return: Array indexed by rating (0-5).
+    """
+    return np.bincount(history.rating, minlength=MAX_RATING + 1)
+
+
+def watch_time_totals(history: History) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Views and minutes watched per user, most minutes first.
+
+    :return: (user ids, view counts, total minutes)
+    """
+    users, user_index = np.unique(history.watch_user, return_inverse=True)
+    views = np.bincount(user_index, minlength=len(users))
+    minutes = np.bincount(user_index, weights=history.watch_duration, minlength=len(users)).astype(np.int64)
+    order = np.argsort(-minutes, kind="stable")
+    return users[order], views[order], minutes[order]
+
+
+def engagement(history: History, link_movies: np.ndarray, link_entities: np.ndarray) -> dict[str, np.ndarray]:
+    """
+    Engagement per linked entity (genre, studio, ...), most viewed first.
+
+    :param history: The loaded history.
+    :param link_movies: Movie id of each link.
+    :param link_entities: Entity id of each link.
+    :return: Arrays keyed by 'id', 'views', 'viewers', 'minutes', 'ratings' and 'avg_rating'.
+    """
+    entities = np.unique(link_entities)
+
+    watch_index, watch_entity = expand_links(history.watch_movie, link_movies, link_entities)
+    watch_entity = np.searchsorted(entities, watch_entity)
+    views = np.bincount(watch_entity, minlength=len(entities))
+    minutes = np.bincount(watch_entity, weights=history.watch_duration[watch_index], minlength=len(entities)).astype(np.int64)
+
+    # distinct (entity, user) pairs
+    pairs = np.unique(watch_entity.astype(np.int64) << 32 | history.watch_user[watch_index].astype(np.int64) & 0xffffffff)
+    viewers = np.bincount(pairs >> 32, minlength=len(entities))
+
+    rate_index, rate_entity = expand_links(history.rate_movie, link_movies, link_entities)
+    rate_entity = np.searchsorted(entities, rate_entity)
+    ratings = np.bincount(rate_entity, minlength=len(entities))
+    rating_sums = np.bincount(rate_entity, weights=history.rating[rate_index], minlength=len(entities))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        avg_rating = np.where(ratings > 0, rating_sums / ratings, np.nan)
+
+    order = np.argsort(-views, kind="stable")
+    return {"id": entities[order], "views": views[order], "viewers": viewers[order], "minutes": minutes[order], "ratings": ratings[order], "avg_rating": avg_rating[order]}
+
+
+def genre_engagement(history: History) -> dict[str, np.ndarray]:
+    """
+    Engagement per genre, see engagement().
+    """
+    return engagement(history, history.genre_movie, history.genre_id)
+
+
+def studio_engagement(history: History) -> dict[str, np.ndarray]:
+    """
+    Engagement per studio, see engagement().
+    """
+    return engagement(history, history.studio_movie, history.studio_id)
+
+
+def cohort_retention(history: History) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Monthly cohort retention. Users belong to the cohort of the month they
+    first watched something in, retention[c][k] is the fraction of cohort c
+    that watched something k months later (NaN past the end of the history).
+
+    :return: (cohort months as datetime64[M], retention matrix)
+    """
+    if len(history.watch_user) == 0:
+        return np.array([], dtype="datetime64[M]"), np.zeros((0, 0))
+
+    months = history.watch_time.astype("datetime64[s]").astype("datetime64[M]").astype(np.int64)
+    first_month = months.min()
+    months -= first_month
+    month_count = int(months.max()) + 1
+
+    users, user_index = np.unique(history.watch_user, return_inverse=True)
+    cohort = np.full(len(users), month_count, dtype=np.int64)
+    np.minimum.at(cohort, user_index, months)
+
+    # every month each user was active in, counted once
+    active = np.unique(user_index.astype(np.int64) * month_count + months)
+    active_user = active // month_count
+    active_cohort = cohort[active_user]
+    offset = active % month_count - active_cohort
+
+    counts = np.bincount(active_cohort * month_count + offset, minlength=month_count * month_count).reshape(month_count, month_count)
+    sizes = counts[:, 0]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        retention = np.where(sizes[:, None] > 0, counts / sizes[:, None], np.nan)
+    # months past the end of the history haven't happened yet
+    retention[np.arange(month_count)[:, None] + np.arange(month_count)[None, :] >= month_count] = np.nan
+
+    cohorts = np.arange(month_count) + first_month
+    has_users = sizes > 0
+    return cohorts[has_users].astype("datetime64[M]"), retention[has_users]
+
+
+def print_report(history: History, top: int = 10) -> None:
+    """
+    Prints a summary of every statistic.
+
+    :param history: The loaded history.
+    :param top: How many rows to show in the ranked tables.
+    """
+    print("Loaded %s watch event(s) and %s rating(s)" % (len(history.watch_user), len(history.rating)))
+
+    print("\nRating distribution:")
+    distribution = rating_distribution(history)
+    total = max(distribution.sum(), 1)
+    for stars in range(len(distribution)):
+        print("\t%d stars: %s (%.1f%%)" % (stars, distribution[stars], 100 * distribution[stars] / total))
+
+    users, views, minutes = watch_time_totals(history)
+    print("\nTotal watch time: %s:%02d hrs:min across %s user(s)" % (minutes.sum() // 60, minutes.sum() % 60, len(users)))
+    print("Top %d users by watch time:" % top)
+    for i in range(min(top, len(users))):
+        print("\t%d. User %s: %s views, %s:%02d hrs:min" % (i + 1, users[i], views[i], minutes[i] // 60, minutes[i] % 60))
+
+    for title, stats, names in [("genres", genre_engagement(history), history.genre_names), ("studios", studio_engagement(history), history.studio_names)]:
+        print("\nTop %d %s by views:" % (top, title))
+        for i in range(min(top, len(stats["id"]))):
+            rating = "%.1f" % stats["avg_rating"][i] if not np.isnan(stats["avg_rating"][i]) else "N/A"
+            print("\t%d. %s: %s views by %s user(s), %s hrs, average rating %s" % (i + 1, names.get(stats["id"][i], stats["id"][i]), stats["views"][i], stats["viewers"][i], stats["minutes"][i] // 60, rating))
+
+    cohorts, retention = cohort_retention(history)
+    print("\nMonthly retention by first-watch cohort:")
+    for i in range(len(cohorts)):
+        months = retention[i][~np.isnan(retention[i])]
+        print("\t%s: %s" % (cohorts[i], " ".join("%3.0f%%" % (100 * value) for value in months[:12])))
+
+
+def main() -> int:
+    """
+    Loads the history and prints the report.
+
+    :return: 0 on success
+    """
+    import sigmadb
+
+    credentials = sigmadb.load_credentials()
+    if credentials == None:
+        return 1
+
+    with sigmadb.connect(credentials) as conn:
+        # analytics only reads, replicas will do when they are configured
+        print_report(History(conn))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
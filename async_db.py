@@ -0,0 +1,465 @@
+#!/bin/python3
+
+"""
+Asyncio data access for the movie and user queries.
+
+movie_funcs and user_funcs mix their queries with prompting and printing
+on one synchronous connection, so a process waits on one query at a time.
+Database offers the same reads and writes as coroutines on an asyncpg
+pool, with no input or output. Each call borrows a pooled connection only
+while its statements run, so thousands of sessions (tasks) can share a
+few dozen connections, and independent queries (the four behind a
+profile) run at the same time on different connections.
+
+The SQL is the same as the synchronous code's and comes from the same
+constants. psycopg2's %s and %(name)s placeholders are rewritten to $n
+once per query. asyncpg prepares and caches every statement on each
+connection by itself. Writes retry serialization failures and deadlocks
+like transactions.run_write. Movie details go through movie_cache, which
+is kept current by LISTENing for changed movies on a connection of its
+own.
+
+    async with async_db.open_database(credentials) as db:
+        profile, feed_page = await asyncio.gather(db.profile(userid), db.feed_page(userid))
+
+credentials.json may set "async_pool_min" and "async_pool_max"
+(connections kept open, default 2, and most at once, default 20).
+
+The pool only reaches the primary, so this doesn't work with "shards"
+(each user's rows would have to come from their own shard, see
+routing.ShardRouter). open_database refuses to start when they are set.
+"""
+
+import asyncio
+import contextlib
+import datetime
+import functools
+import random
+import re
+
+import asyncpg
+
+import feed
+import movie_cache
+import movie_funcs
+import search
+import statements
+import transactions
+import user_funcs
+
+DEFAULT_POOL_MIN = 2
+DEFAULT_POOL_MAX = 20
+
+NAMED_PLACEHOLDER_PATTERN = re.compile(r"%%|%\((\w+)\)s")
+
+
+@functools.lru_cache(maxsize=None)
+def server_query(query: str) -> str:
+    """
+    A query with %s placeholders rewritten to $n.
+    """
+    return statements.Statement("", query).server_text
+
+
+@functools.lru_cache(maxsize=None)
+def server_named_query(query: str) -> tuple[str, tuple[str]]:
+    """
+    A query with %(name)s placeholders rewritten to $n.
+
+    :return: (query, argument names in $n order)
+    """
+    names = []
+
+    def number(match) -> str:
+        if match.group(0) == "%%":
+            return "%"
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return "$%d" % (names.index(match.group(1)) + 1)
+
+    return NAMED_PLACEHOLDER_PATTERN.sub(number, query), tuple(names)
+
+
+def bind(query: str, args) -> tuple:
+    """
+    A psycopg2 style query and its arguments as asyncpg wants them.
+
+    :param query: Query with %s or %(name)s placeholders.
+    :param args: Sequence or dict of arguments.
+    :return: (query, *arguments)
+    """
+    if isinstance(args, dict):
+        text, names = server_named_query(query)
+        return (text,) + tuple(args[name] for name in names)
+    return (server_query(query),) + tuple(args)
+
+
+def registered(name: str) -> str:
+    """
+    A statement from the statements registry, by name.
+    """
+    return statements.get(name).query
+
+
+async def publish(conn, userid: int, kind: str, events: list[tuple[int, int]], created) -> None:
+    """
+    feed.publish on an asyncpg connection inside a transaction.
+    """
+    if len(events) == 0:
+        return
+    followers = await conn.fetchval(*bind(feed.COUNT_FOLLOWERS, (userid, feed.FANOUT_LIMIT + 1)))
+    fan_out = followers <= feed.FANOUT_LIMIT
+    rows = await conn.fetch(*bind(feed.INSERT_ACTIVITY, (userid, kind, created, fan_out, [movieid for movieid, value in events], [value for movieid, value in events])))
+    if fan_out:
+        await conn.execute(*bind(feed.FAN_OUT, ([row[0] for row in rows],)))
+    else:
+        await conn.execute(*bind(feed.ADD_PULL_AUTHOR, (userid,)))
+
+
+class Database():
+    def __init__(self, pool):
+        """
+        :param pool: asyncpg pool connected to the primary.
+        """
+        self.pool = pool
+
+    async def fetch(self, query: str, args=()) -> list:
+        async with self.pool.acquire() as conn:
+            return await conn.fetch(*bind(query, args))
+
+    async def fetchrow(self, query: str, args=()):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchrow(*bind(query, args))
+
+    async def fetchval(self, query: str, args=()):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval(*bind(query, args))
+
+    async def execute(self, query: str, args=()) -> str:
+        async with self.pool.acquire() as conn:
+            return await conn.execute(*bind(query, args))
+
+    async def write(self, work, *args, retries: int = transactions.MAX_RETRIES):
+        """
+        Runs work(connection, *args) in a transaction, starting over when it
+        fails with a serialization failure or deadlock.
+
+        :param work: Coroutine function doing the transaction's statements.
+        :return: Whatever work returns.
+        """
+        for attempt in range(retries + 1):
+            try:
+                async with self.pool.acquire() as conn:
+                    async with conn.transaction():
+                        return await work(conn, *args)
+            except asyncpg.PostgresError as e:
+                if e.sqlstate not in transactions.RETRY_CODES or attempt == retries:
+                    raise
+            await asyncio.sleep(random.uniform(0, transactions.RETRY_BACKOFF * 2 ** attempt))
+
+    # movies
+
+    async def search_movies(self, movie_search: search.MovieSearch, order: list[str] = []) -> list:
+        """
+        browse_movies' results, shaped like movie_funcs.print_movie expects.
+        """
+        rows = await self.fetch(*movie_search.compile(order))
+        movie_cache.warm(rows)
+        return rows
+
+    async def movies(self, movie_ids) -> dict:
+        """
+        movie_cache.get_many: Movie by movieid, loading the ones not cached.
+        """
+        movie_ids = list(movie_ids)
+        found = movie_cache.cache.lookup(movie_ids)
+        missing = [movie_id for movie_id in set(movie_ids) if movie_id not in found]
+        if len(missing) > 0:
+            for row in await self.fetch(movie_cache.MOVIES_QUERY, (missing,)):
+                movie = movie_cache.Movie(*row)
+                movie_cache.cache.put(movie)
+                found[movie.movieid] = movie
+        return found
+
+    async def titles(self, movie_ids: list[int]) -> list[str]:
+        movies = await self.movies(movie_ids)
+        return [movies[movie_id].title if movie_id in movies else "(removed)" for movie_id in movie_ids]
+
+    async def rate_movie(self, user_id: int, movie_id: int, rating: int) -> bool:
+        """
+        :return: Whether an earlier rating was replaced.
+        """
+        async def work(conn, date_rated):
+            await publish(conn, user_id, "rate", [(movie_id, rating)], date_rated)
+            if await conn.fetchrow(*bind(registered(movie_funcs.RATE_SELECT), (user_id, movie_id))) != None:
+                await conn.execute(*bind(registered(movie_funcs.RATE_UPDATE), (rating, user_id, movie_id)))
+                return True
+            await conn.execute(*bind(registered(movie_funcs.RATE_INSERT), (user_id, movie_id, rating)))
+            return False
+
+        return await self.write(work, datetime.datetime.now())
+
+    async def watch_movie(self, user_id: int, movie_id: int) -> int:
+        """
+        Records a full watch of a movie.
+
+        :return: The minutes watched, None if the movie doesn't exist.
+        """
+        movie = (await self.movies([movie_id])).get(movie_id)
+        if movie == None:
+            return None
+
+        async def work(conn, date_watched):
+            await conn.execute(*bind(registered(movie_funcs.WATCH_INSERT), (user_id, movie_id, date_watched, movie.length)))
+            await publish(conn, user_id, "watch", [(movie_id, movie.length)], date_watched)
+
+        await self.write(work, datetime.datetime.now())
+        return movie.length
+
+    async def more_like_this(self, movie_id: int) -> list:
+        """
+        :return: (similar movieid, score) rows, closest first.
+        """
+        return await self.fetch(registered(movie_funcs.MORE_LIKE_THIS), (movie_id,))
+
+    async def top_20_last_90_days(self) -> list:
+        """
+        :return: (movieid, approximate unique viewers) rows.
+        """
+        return await self.fetch(registered(movie_funcs.TOP_20_LAST_90_DAYS))
+
+    async def top_20_among_followers(self, user_id: int) -> list:
+        """
+        :return: (movieid, followers who watched) rows.
+        """
+        return await self.fetch(registered(movie_funcs.TOP_20_AMONG_FOLLOWERS), (user_id,))
+
+    async def top_5_releases_of_month(self) -> list:
+        """
+        :return: (movieid, approximate unique viewers) rows.
+        """
+        return await self.fetch(registered(movie_funcs.TOP_5_RELEASES_OF_MONTH))
+
+    async def recommended(self, user_id: int) -> list[int]:
+        """
+        movie_funcs.fetch_recommended: co-viewers' favourites, else the
+        neighbours of the user's history, else what's popular.
+        """
+        rows = await self.fetch(registered(movie_funcs.FOR_YOU), (user_id, user_id, user_id))
+        if len(rows) == 0:
+            rows = await self.fetch(registered(movie_funcs.SIMILAR_TO_HISTORY), (user_id, user_id, user_id))
+        if len(rows) == 0:
+            rows = await self.fetch(registered(movie_funcs.TOP_20_LAST_90_DAYS))
+        return [row[0] for row in rows]
+
+    async def watched(self, user_id: int) -> set[int]:
+        return set(row[0] for row in await self.fetch(movie_funcs.WATCHED_QUERY, (user_id,)))
+
+    # accounts
+
+    async def username_taken(self, username: str) -> bool:
+        return await self.fetchrow(user_funcs.USERNAME_TAKEN_QUERY, (username,)) != None
+
+    async def email_taken(self, email: str) -> bool:
+        return await self.fetchrow(user_funcs.EMAIL_TAKEN_QUERY, (email,)) != None
+
+    async def create_account(self, first_name: str, last_name: str, username: str, password: str, email: str) -> int:
+        """
+        :param password: Plaintext, it is hashed like user_funcs does.
+        :return: The new account's userid.
+        """
+        async def work(conn, now):
+            await conn.execute(*bind(user_funcs.INSERT_ACCOUNT_QUERY, (first_name, last_name, username, user_funcs.pass_to_hash(password, username), email, now, now)))
+            return await conn.fetchval(*bind(user_funcs.USERID_BY_USERNAME_QUERY, (username,)))
+
+        return await self.write(work, datetime.datetime.now())
+
+    async def login(self, username: str, password: str) -> tuple[str, int]:
+        """
+        Checks a username and password and records the access.
+
+        :param password: Plaintext, it is hashed like user_funcs does.
+        :return: (username, userid), None if they don't match an account.
+        """
+        row = await self.fetchrow(registered(user_funcs.LOGIN_SELECT), (username, user_funcs.pass_to_hash(password, username)))
+        if row == None:
+            return None
+        await self.execute(registered(user_funcs.LOGIN_UPDATE_ACCESS), (datetime.datetime.now(), row[1]))
+        return (row[0], row[1])
+
+    # following
+
+    async def user_by_email(self, email: str) -> tuple[int, str]:
+        """
+        :return: (userid, username), None if no one has the email.
+        """
+        row = await self.fetchrow(user_funcs.USER_BY_EMAIL_QUERY, (email,))
+        return tuple(row) if row != None else None
+
+    async def follow(self, userid: int, followingid: int) -> bool:
+        """
+        :return: Whether the user wasn't already followed.
+        """
+        async def work(conn):
+            if await conn.fetchrow(*bind(user_funcs.IS_FOLLOWING_QUERY, (userid, followingid))) != None:
+                return False
+            await conn.execute(*bind(user_funcs.FOLLOW_QUERY, (userid, followingid)))
+            return True
+
+        return await self.write(work)
+
+    async def unfollow(self, userid: int, followingid: int) -> bool:
+        """
+        :return: Whether the user was followed.
+        """
+        return await self.execute(user_funcs.UNFOLLOW_QUERY, (userid, followingid)) != "DELETE 0"
+
+    async def following_page(self, userid: int, limit: int = 10, offset: int = 0) -> list:
+        """
+        :return: (username, email, userid) rows.
+        """
+        return await self.fetch(user_funcs.FOLLOWING_PAGE_QUERY, (userid, limit, offset))
+
+    async def feed_page(self, userid: int, before: int = feed.FIRST_PAGE, limit: int = feed.PAGE_SIZE) -> list:
+        """
+        :return: (activityid, username, kind, movieid, value, created) rows, see feed.page.
+        """
+        return await self.fetch(feed.FEED_PAGE_QUERY, {"userid": userid, "before": before, "limit": limit})
+
+    # collections
+
+    async def create_collection(self, user_id: int, name: str) -> None:
+        await self.execute(user_funcs.CREATE_COLLECTION_QUERY, (name, user_id))
+
+    async def collections(self, user_id: int) -> list:
+        """
+        :return: (collectionid, name, movie count, total minutes) rows.
+        """
+        return await self.fetch(user_funcs.GET_COLLECTIONS_QUERY, (user_id,))
+
+    async def collection_movies(self, collection_id: int) -> list:
+        """
+        :return: The collection's movies, sorted by title.
+        """
+        movie_ids = [row[0] for row in await self.fetch(user_funcs.COLLECTION_MOVIES_QUERY, (collection_id,))]
+        movies = await self.movies(movie_ids)
+        return sorted((movies[movie_id] for movie_id in movie_ids if movie_id in movies), key=lambda movie: movie.title)
+
+    async def add_to_collection(self, movie_id: int, collection_id: int) -> bool:
+        """
+        :return: Whether the movie was added (False if it was already there).
+        """
+        async def work(conn):
+            if await conn.fetchval(*bind(user_funcs.IN_COLLECTION_QUERY, (movie_id, collection_id))) > 0:
+                return False
+            await conn.execute(*bind(user_funcs.ADD_MOVIE_QUERY, (movie_id, collection_id)))
+            return True
+
+        return await self.write(work)
+
+    async def remove_from_collection(self, movie_id: int, collection_id: int) -> None:
+        await self.execute(user_funcs.REMOVE_MOVIE_QUERY, (movie_id, collection_id))
+
+    async def rename_collection(self, collection_id: int, name: str) -> None:
+        await self.execute(user_funcs.CHANGE_NAME_QUERY, (name, collection_id))
+
+    async def delete_collection(self, collection_id: int) -> None:
+        async def work(conn):
+            await conn.execute(*bind(user_funcs.DELETE_ALL_MOVIE_QUERY, (collection_id,)))
+            await conn.execute(*bind(user_funcs.DELETE_MOVIECOLLECTION_QUERY, (collection_id,)))
+
+        await self.write(work)
+
+    async def watch_collection(self, user_id: int, collection_id: int) -> int:
+        """
+        Records a full watch of every movie in a collection.
+
+        :return: How many movies were watched.
+        """
+        async def work(conn, date_watched):
+            rows = await conn.fetch(*bind(user_funcs.WATCH_COLLECTION_QUERY, (user_id, date_watched, collection_id)))
+            await publish(conn, user_id, "watch", [tuple(row) for row in rows], date_watched)
+            return len(rows)
+
+        return await self.write(work, datetime.datetime.now())
+
+    # profile
+
+    async def profile(self, userid: int) -> tuple:
+        """
+        user_funcs.fetch_profile, with the four queries run at once.
+
+        :return: (number of collections, followers, following, top ten rated titles)
+        """
+        num_collections, num_followers, num_following, top_ten = await asyncio.gather(
+            self.fetchval(user_funcs.GET_NUM_COLLECTIONS, (userid,)),
+            self.fetchval(user_funcs.GET_NUM_FOLLOWERS, (userid,)),
+            self.fetchval(user_funcs.GET_NUM_FOLLOWING, (userid,)),
+            self.fetch(user_funcs.TEN_HIGHEST_RATINGS, (userid,)))
+        return (num_collections, num_followers, num_following, [row[0] for row in top_ten])
+
+
+def movie_changed(connection, pid, channel, payload) -> None:
+    """
+    Listener callback dropping changed movies from movie_cache.
+    """
+    if payload == movie_cache.ALL_MOVIES:
+        movie_cache.cache.clear()
+    else:
+        movie_cache.cache.invalidate(int(payload))
+
+
+@contextlib.asynccontextmanager
+async def open_database(credentials: dict):
+    """
+    Opens a pool to the primary described by the credentials, tunneling
+    over SSH like sigmadb.connect unless they have a "host".
+
+    :param credentials: The parsed credentials file.
+    :return: An async context manager giving a Database.
+    """
+    if len(credentials.get("shards", [])) > 0:
+        raise ValueError("async_db can't route users to their shards, remove \"shards\" from the credentials to use it")
+
+    async with contextlib.AsyncExitStack() as stack:
+        if "host" in credentials:
+            host = credentials["host"]
+            port = credentials.get("port", 5432)
+        else:
+            from sshtunnel import SSHTunnelForwarder
+
+            server = SSHTunnelForwarder(
+                ('starbug.cs.rit.edu', 22),
+                ssh_username=credentials["username"],
+                ssh_password=credentials["password"],
+                remote_bind_address=('127.0.0.1', 5432))
+            await asyncio.to_thread(server.start)
+            stack.callback(server.stop)
+            host = '127.0.0.1'
+            port = server.local_bind_port
+
+        params = {
+            'database': credentials.get("database", "p320_10"),
+            'user': credentials["username"],
+            'password': credentials["password"],
+            'host': host,
+            'port': port,
+        }
+        settings = {
+            "statement_timeout": str(int(credentials.get("statement_timeout", transactions.DEFAULT_STATEMENT_TIMEOUT))),
+            "idle_in_transaction_session_timeout": str(int(credentials.get("idle_in_transaction_timeout", transactions.DEFAULT_IDLE_TIMEOUT))),
+        }
+
+        pool = await asyncpg.create_pool(min_size=int(credentials.get("async_pool_min", DEFAULT_POOL_MIN)),
+                                         max_size=int(credentials.get("async_pool_max", DEFAULT_POOL_MAX)),
+                                         server_settings=settings, **params)
+        stack.push_async_callback(pool.close)
+
+        # pooled connections come and go, the listener stays
+        listener = await asyncpg.connect(**params)
+        stack.push_async_callback(listener.close)
+        await listener.add_listener(movie_cache.CHANNEL, movie_changed)
+        # anything cached before now was never covered by invalidation
+        movie_cache.cache.clear()
+
+        yield Database(pool)
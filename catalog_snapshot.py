@@ -0,0 +1,650 @@
+#!/bin/python3
+
+"""
+A local, memory-mapped snapshot of the movie catalog.
+
+The catalog is exported to a compact columnar file: one fixed-width array per
+field, variable length lists (releases, genres, cast, directors, studios)
+stored as offset/value pairs and every piece of text in a single string
+table. Browsing memory-maps the file and filters and sorts straight out of
+the mapped arrays, so no query goes over the network. It takes the same
+searches as browse_movies (search.MovieSearch). The titles and names text
+is matched against are also kept lower cased in one blob per field, so a
+search is a few finds over the mapped bytes instead of decoding every row.
+
+Movie metadata rarely changes, so refresh() only pulls the movies touched
+since the snapshot was taken (based on the rows' xmin) and rewrites the file.
+Deleted genre/cast/studio links are not visible this way, re-export now and
+then to pick those up.
+
+usage: catalog_snapshot.py [export|refresh]
+"""
+
+import array
+import bisect
+import datetime
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+
+import input_utils
+import movie_funcs
+import routing
+import streaming
+
+DEFAULT_PATH = "catalog.snap"
+
+MAGIC = b"SGCS"
+VERSION = 2
+
+# magic, version, row count, column count, snapshot xid, creation time
+HEADER_FORMAT = "=4sIIIQd"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# column name, array typecode, byte offset, item count
+DIRECTORY_FORMAT = "=24sc7xQQ"
+DIRECTORY_SIZE = struct.calcsize(DIRECTORY_FORMAT)
+
+# Stored for missing values in int columns
+NULL_INT = -2**31
+
+# Release dates are stored as days since this date
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+# Every list column is stored as <name>_offsets and <name>_values
+LIST_COLUMNS = ["releases", "genres", "cast", "directors", "studios"]
+
+# Separates the entries of a search blob, never part of a search
+SEARCH_SEPARATOR = b"\0"
+
+CATALOG_QUERY = """
+SELECT
+    m.movieid, m.title, m.length, m.mpaarating,
+    ARRAY(SELECT releasedate FROM movierelease AS mr WHERE mr.movieid = m.movieid ORDER BY releasedate),
+    ARRAY(SELECT genreid FROM moviegenre AS mg WHERE mg.movieid = m.movieid),
+    ARRAY(SELECT crewid FROM actsin AS a WHERE a.movieid = m.movieid),
+    ARRAY(SELECT crewid FROM directed AS d WHERE d.movieid = m.movieid),
+    ARRAY(SELECT studioid FROM produced AS p WHERE p.movieid = m.movieid),
+    (SELECT AVG(rating) FROM rated WHERE rated.movieid = m.movieid)
+FROM movie AS m
+"""
+
+# A row counts as changed when it was written by a transaction that had not
+# finished when the snapshot was taken
+CHANGED_CONDITION = "age(xmin) <= age(%(xid)s::text::xid)"
+
+CHANGED_MOVIES_QUERY = """
+SELECT movieid FROM movie WHERE {0}
+UNION SELECT movieid FROM movierelease WHERE {0}
+UNION SELECT movieid FROM moviegenre WHERE {0}
+UNION SELECT movieid FROM actsin WHERE {0}
+UNION SELECT movieid FROM directed WHERE {0}
+UNION SELECT movieid FROM produced WHERE {0}
+UNION SELECT movieid FROM rated WHERE {0}
+""".format(CHANGED_CONDITION)
+
+
+class Catalog():
+    def __init__(self):
+        # movieid -> (title, length, mpaarating, release dates, genre ids, cast ids, director ids, studio ids, avg rating)
+        self.movies = {}
+        # id -> name, crew names are (first, last)
+        self.genres = {}
+        self.crew = {}
+        self.studios = {}
+
+    def load(self, conn, movie_ids: list = None, changed_xid: int = None) -> None:
+        """
+        Pulls movies and the names they reference from the database.
+
+        :param conn: Connection to the database.
+        :param movie_ids: Only pull these movies. Leave None for all of them.
+        :param changed_xid: Only pull names changed since this transaction id.
+        """
+        query = CATALOG_QUERY
+        args = None
+        if movie_ids != None:
+            query += " WHERE m.movieid = ANY(%(ids)s)"
+            args = {"ids": list(movie_ids)}
+        for row in streaming.stream_rows(conn, query, args):
+            avg_rating = float(row[9]) if row[9] != None else None
+            self.movies[row[0]] = tuple(row[1:9]) + (avg_rating,)
+
+        name_filter = ""
+        args = None
+        if changed_xid != None:
+            name_filter = " WHERE " + CHANGED_CONDITION
+            args = {"xid": changed_xid}
+        for genreid, name in streaming.stream_rows(conn, "SELECT genreid, genrename FROM genre" + name_filter, args):
+            self.genres[genreid] = name
+        for crewid, first, last in streaming.stream_rows(conn, "SELECT crewid, firstname, lastname FROM crewmember" + name_filter, args):
+            self.crew[crewid] = (first, last)
+        for studioid, name in streaming.stream_rows(conn, "SELECT studioid, name FROM studio" + name_filter, args):
+            self.studios[studioid] = name
+
+    def write(self, path: str, snapshot_xid: int) -> None:
+        """
+        Writes the catalog as a snapshot file, replacing any existing one.
+
+        :param path: Where to write the snapshot.
+        :param snapshot_xid: The transaction id later refreshes compare against.
+        """
+        strings = {}
+        string_data = bytearray()
+        string_offsets = array.array("i", [0])
+
+        def string_id(text):
+            if text == None:
+                return NULL_INT
+            sid = strings.get(text)
+            if sid == None:
+                sid = len(strings)
+                strings[text] = sid
+                string_data.extend(text.encode("utf-8"))
+                string_offsets.append(len(string_data))
+            return sid
+
+        columns = {name: array.array("i") for name in ["movie_id", "title", "length", "mpaa", "first_release", "title_rank", "genres_rank", "studios_rank"]}
+        columns["avg_rating"] = array.array("f")
+        for name in LIST_COLUMNS:
+            columns[name + "_offsets"] = array.array("i", [0])
+            columns[name + "_values"] = array.array("i")
+
+        movie_ids = sorted(self.movies)
+        genre_text = {}
+        studio_text = {}
+        for movie_id in movie_ids:
+            title, length, mpaa, releases, genres, cast, directors, studios, avg_rating = self.movies[movie_id]
+            columns["movie_id"].append(movie_id)
+            columns["title"].append(string_id(title))
+            columns["length"].append(length if length != None else NULL_INT)
+            columns["mpaa"].append(string_id(mpaa))
+            columns["avg_rating"].append(avg_rating if avg_rating != None else math.nan)
+
+            days = [release.toordinal() - EPOCH_ORDINAL for release in releases]
+            columns["first_release"].append(days[0] if days else NULL_INT)
+            for name, values in zip(LIST_COLUMNS, [days, genres, cast, directors, studios]):
+                columns[name + "_values"].extend(values)
+                columns[name + "_offsets"].append(len(columns[name + "_values"]))
+
+            # the text browse_movies sorts genres and studios by
+            genre_text[movie_id] = join_names(sorted(self.genres.get(genre, "") for genre in genres))
+            studio_text[movie_id] = join_names(sorted(self.studios.get(studio, "") for studio in studios))
+
+        # sort keys are precomputed so sorting never has to decode strings
+        for rank_column, text in [("title_rank", {movie_id: self.movies[movie_id][0] for movie_id in movie_ids}), ("genres_rank", genre_text), ("studios_rank", studio_text)]:
+            ranks = rank_texts(text)
+            columns[rank_column].extend(ranks[movie_id] for movie_id in movie_ids)
+
+        for table, names in [("genre", self.genres), ("studio", self.studios)]:
+            ids = sorted(names)
+            columns[table + "_table_id"] = array.array("i", ids)
+            columns[table + "_table_name"] = array.array("i", [string_id(names[i]) for i in ids])
+        crew_ids = sorted(self.crew)
+        columns["crew_table_id"] = array.array("i", crew_ids)
+        columns["crew_table_first"] = array.array("i", [string_id(self.crew[i][0]) for i in crew_ids])
+        columns["crew_table_last"] = array.array("i", [string_id(self.crew[i][1]) for i in crew_ids])
+
+        # lower cased text to search, <name>_find_offsets[i] is where entry i starts
+        for name, texts in [("title", [self.movies[movie_id][0] for movie_id in movie_ids]),
+                            ("genre", [self.genres[i] for i in sorted(self.genres)]),
+                            ("studio", [self.studios[i] for i in sorted(self.studios)]),
+                            ("crew_first", [self.crew[i][0] for i in crew_ids]),
+                            ("crew_last", [self.crew[i][1] for i in crew_ids])]:
+            data, offsets = search_blob(texts)
+            columns[name + "_find_offsets"] = offsets
+            columns[name + "_find_data"] = data
+
+        columns["string_offsets"] = string_offsets
+        columns["string_data"] = array.array("B", bytes(string_data))
+
+        # write next to the old file and swap it in, open snapshots keep their mapping
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as out:
+            out.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, len(movie_ids), len(columns), snapshot_xid, time.time()))
+            offset = align(HEADER_SIZE + DIRECTORY_SIZE * len(columns))
+            for name, values in columns.items():
+                out.write(struct.pack(DIRECTORY_FORMAT, name.encode(), values.typecode.encode(), offset, len(values)))
+                offset = align(offset + values.itemsize * len(values))
+            for values in columns.values():
+                out.write(b"\0" * (align(out.tell()) - out.tell()))
+                values.tofile(out)
+        os.replace(temp_path, path)
+
+
+def join_names(names) -> str:
+    """
+    Joins names the way STRING_AGG does in browse_movies, None when empty.
+    """
+    names = list(names)
+    if len(names) == 0:
+        return None
+    return ", ".join(names)
+
+
+def rank_texts(texts: dict) -> dict:
+    """
+    Maps each key to the sort position of its text, missing text sorts last.
+    """
+    ordered = sorted(set(text for text in texts.values() if text != None))
+    positions = {text: i for i, text in enumerate(ordered)}
+    return {key: positions.get(text, len(ordered)) for key, text in texts.items()}
+
+
+def search_blob(texts: list[str]) -> tuple[array.array, array.array]:
+    """
+    Joins lower cased texts into one blob to search with find().
+
+    :return: (blob, offsets), entry i starts at offsets[i] and ends before offsets[i + 1].
+    """
+    data = bytearray()
+    offsets = array.array("i", [0])
+    for text in texts:
+        data.extend((text or "").lower().encode("utf-8"))
+        data.extend(SEARCH_SEPARATOR)
+        offsets.append(len(data))
+    return array.array("B", bytes(data)), offsets
+
+
+def align(offset: int) -> int:
+    """
+    Rounds an offset up so columns start on an 8 byte boundary.
+    """
+    return (offset + 7) & ~7
+
+
+class Snapshot():
+    def __init__(self, path: str):
+        """
+        Memory-maps a snapshot file.
+
+        :param path: Path to the snapshot.
+        """
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.row_count, column_count, self.snapshot_xid, self.created = struct.unpack_from(HEADER_FORMAT, self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError("%s is not a version %d catalog snapshot" % (path, VERSION))
+
+        self._views = [memoryview(self._map)]
+        self.columns = {}
+        # name -> (first byte, end) of the column in the file
+        self.spans = {}
+        for i in range(column_count):
+            name, typecode, offset, count = struct.unpack_from(DIRECTORY_FORMAT, self._map, HEADER_SIZE + DIRECTORY_SIZE * i)
+            typecode = typecode.decode()
+            nbytes = count * array.array(typecode).itemsize
+            column = self._views[0][offset:offset + nbytes].cast(typecode)
+            self._views.append(column)
+            name = name.rstrip(b"\0").decode()
+            self.columns[name] = column
+            self.spans[name] = (offset, offset + nbytes)
+
+    def close(self) -> None:
+        """
+        Unmaps the snapshot.
+        """
+        for view in reversed(getattr(self, "_views", [])):
+            view.release()
+        self._views = []
+        self._map.close()
+        self._file.close()
+
+    def string(self, sid: int) -> str:
+        """
+        Looks up an entry in the string table, None for a missing value.
+        """
+        if sid == NULL_INT:
+            return None
+        offsets = self.columns["string_offsets"]
+        return bytes(self.columns["string_data"][offsets[sid]:offsets[sid + 1]]).decode("utf-8")
+
+    def list_values(self, name: str, row: int):
+        """
+        The values of a list column for one row.
+
+        :param name: One of LIST_COLUMNS.
+        :param row: The row number.
+        """
+        offsets = self.columns[name + "_offsets"]
+        return self.columns[name + "_values"][offsets[row]:offsets[row + 1]]
+
+    def _table_lookup(self, table: str, entity_id: int, field: str = "name") -> str:
+        ids = self.columns[table + "_table_id"]
+        i = bisect.bisect_left(ids, entity_id)
+        if i == len(ids) or ids[i] != entity_id:
+            return ""
+        return self.string(self.columns[table + "_table_" + field][i])
+
+    def crew_name(self, crew_id: int) -> str:
+        return "{} {}".format(self._table_lookup("crew", crew_id, "first"), self._table_lookup("crew", crew_id, "last"))
+
+    def row_for(self, movie_id: int) -> int:
+        """
+        Finds the row of a movie, -1 if it is not in the snapshot.
+        """
+        ids = self.columns["movie_id"]
+        i = bisect.bisect_left(ids, movie_id)
+        if i == len(ids) or ids[i] != movie_id:
+            return -1
+        return i
+
+    def display_row(self, row: int) -> tuple:
+        """
+        A row in the same shape browse_movies prints.
+
+        :return: (movieid, title, length, mpaarating, first_release, genres, crew, directors, studios, avg_rating)
+        """
+        columns = self.columns
+        first_release = columns["first_release"][row]
+        length = columns["length"][row]
+        avg_rating = columns["avg_rating"][row]
+        return (columns["movie_id"][row],
+                self.string(columns["title"][row]),
+                length if length != NULL_INT else None,
+                self.string(columns["mpaa"][row]),
+                datetime.date.fromordinal(first_release + EPOCH_ORDINAL) if first_release != NULL_INT else None,
+                join_names(sorted(self._table_lookup("genre", i) for i in self.list_values("genres", row))),
+                join_names(sorted(self.crew_name(i) for i in self.list_values("cast", row))),
+                join_names(sorted(self.crew_name(i) for i in self.list_values("directors", row))),
+                join_names(sorted(self._table_lookup("studio", i) for i in self.list_values("studios", row))),
+                avg_rating if not math.isnan(avg_rating) else None)
+
+    def catalog(self) -> Catalog:
+        """
+        Reads the whole snapshot back into a Catalog so it can be rewritten.
+        """
+        catalog = Catalog()
+        columns = self.columns
+        for row in range(self.row_count):
+            first_release = columns["first_release"][row]
+            length = columns["length"][row]
+            avg_rating = columns["avg_rating"][row]
+            releases = [datetime.date.fromordinal(days + EPOCH_ORDINAL) for days in self.list_values("releases", row)]
+            catalog.movies[columns["movie_id"][row]] = (self.string(columns["title"][row]),
+                                                        length if length != NULL_INT else None,
+                                                        self.string(columns["mpaa"][row]),
+                                                        releases,
+                                                        list(self.list_values("genres", row)),
+                                                        list(self.list_values("cast", row)),
+                                                        list(self.list_values("directors", row)),
+                                                        list(self.list_values("studios", row)),
+                                                        avg_rating if not math.isnan(avg_rating) else None)
+        for table, names in [("genre", catalog.genres), ("studio", catalog.studios)]:
+            for i, entity_id in enumerate(columns[table + "_table_id"]):
+                names[entity_id] = self.string(columns[table + "_table_name"][i])
+        for i, crew_id in enumerate(columns["crew_table_id"]):
+            catalog.crew[crew_id] = (self.string(columns["crew_table_first"][i]), self.string(columns["crew_table_last"][i]))
+        return catalog
+
+    def find(self, name: str, text: str) -> set[int]:
+        """
+        The entries of a search blob containing some text, ignoring case.
+
+        :param name: title (entries are rows), genre, studio, crew_first or crew_last (entries index the name table).
+        :param text: The text to look for.
+        """
+        pattern = text.lower().encode("utf-8")
+        start, end = self.spans[name + "_find_data"]
+        offsets = self.columns[name + "_find_offsets"]
+        if len(pattern) == 0:
+            return set(range(len(offsets) - 1))
+        found = set()
+        position = self._map.find(pattern, start, end)
+        while position != -1:
+            entry = bisect.bisect_right(offsets, position - start) - 1
+            found.add(entry)
+            # on to the next entry, one match each is enough
+            position = self._map.find(pattern, start + offsets[entry + 1], end)
+        return found
+
+    def _matching_ids(self, table: str, text: str) -> set:
+        ids = self.columns[table + "_table_id"]
+        return set(ids[entry] for entry in self.find(table, text))
+
+    def _matching_crew(self, first_name: str, last_name: str) -> set:
+        ids = self.columns["crew_table_id"]
+        return set(ids[entry] for entry in self.find("crew_first", first_name) & self.find("crew_last", last_name))
+
+    def search(self, criteria: list[tuple]) -> list[int]:
+        """
+        Finds the rows matching every criterion of a search.MovieSearch,
+        the way its query would. Average ratings are as of the last refresh.
+
+        :param criteria: The search's criteria, (filter name, arguments) pairs.
+        :return: The matching row numbers.
+        """
+        columns = self.columns
+        rows = range(self.row_count)
+        for name, args in criteria:
+            match name:
+                case "title":
+                    titles = self.find("title", args[0])
+                    rows = [row for row in rows if row in titles]
+                case "released_between":
+                    first = args[0].toordinal() - EPOCH_ORDINAL
+                    last = args[1].toordinal() - EPOCH_ORDINAL
+                    rows = [row for row in rows if any(first <= days <= last for days in self.list_values("releases", row))]
+                case "genres":
+                    genres = set()
+                    for genre in args[0]:
+                        genres |= self._matching_ids("genre", genre)
+                    rows = [row for row in rows if not genres.isdisjoint(self.list_values("genres", row))]
+                case "cast":
+                    crew = self._matching_crew(*args)
+                    rows = [row for row in rows if not crew.isdisjoint(self.list_values("cast", row))]
+                case "director":
+                    crew = self._matching_crew(*args)
+                    rows = [row for row in rows if not crew.isdisjoint(self.list_values("directors", row))]
+                case "studio":
+                    studios = self._matching_ids("studio", args[0])
+                    rows = [row for row in rows if not studios.isdisjoint(self.list_values("studios", row))]
+                case "mpaa":
+                    # only the few distinct ratings are decoded
+                    wanted = set(rating.upper() for rating in args[0])
+                    mpaa = columns["mpaa"]
+                    sids = set(sid for sid in set(mpaa) if sid != NULL_INT and self.string(sid).upper() in wanted)
+                    rows = [row for row in rows if mpaa[row] in sids]
+                case "runtime":
+                    shortest = args[0] if args[0] != None else NULL_INT + 1
+                    longest = args[1] if args[1] != None else 2**31 - 1
+                    length = columns["length"]
+                    rows = [row for row in rows if length[row] != NULL_INT and shortest <= length[row] <= longest]
+                case "min_rating":
+                    # NaN (no ratings) never compares true
+                    avg_rating = columns["avg_rating"]
+                    rows = [row for row in rows if avg_rating[row] >= args[0]]
+                case _:
+                    raise ValueError("The catalog snapshot can't search by '%s'" % name)
+        return list(rows)
+
+    def sort(self, rows: list[int], sort_parameters: list) -> list[int]:
+        """
+        Sorts rows by browse_movies' sort parameters, missing values sort
+        last ascending and first descending like they do in PostgreSQL.
+
+        :param rows: Row numbers to sort.
+        :param sort_parameters: movie_funcs.SortParameter list, highest priority first.
+        :return: The sorted rows.
+        """
+        keys = {"title": "title_rank", "first_release": "first_release", "studios": "studios_rank", "genres": "genres_rank"}
+        rows = list(rows)
+        # stable sorts from the lowest priority key up give a multi-key sort
+        for param in reversed(sort_parameters):
+            if param.order == movie_funcs.SortOrder.NONE:
+                continue
+            column = self.columns[keys[param.sql_name]]
+            rows.sort(key=lambda row: column[row] if column[row] != NULL_INT else 2**31,
+                      reverse=param.order == movie_funcs.SortOrder.DESCENDING)
+        return rows
+
+
+def begin_snapshot(conn) -> int:
+    """
+    Starts a repeatable read transaction so everything exported comes from
+    one consistent view of the catalog.
+
+    :param conn: Connection to the database.
+    :return: The oldest transaction id still running, anything written at or
+    after it counts as changed on the next refresh.
+    """
+    conn.commit()
+    with conn.cursor() as curs:
+        curs.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        curs.execute("SELECT txid_snapshot_xmin(txid_current_snapshot()) % 4294967296")
+        return int(curs.fetchone()[0])
+
+
+def export(conn, path: str = DEFAULT_PATH) -> int:
+    """
+    Exports the whole catalog to a snapshot file.
+
+    :param conn: Connection to the database.
+    :param path: Where to write the snapshot.
+    :return: The number of movies exported.
+    """
+    xid = begin_snapshot(conn)
+    catalog = Catalog()
+    catalog.load(conn)
+    conn.commit()
+
+    catalog.write(path, xid)
+    return len(catalog.movies)
+
+
+def refresh(conn, path: str = DEFAULT_PATH) -> int:
+    """
+    Brings a snapshot up to date by pulling only the movies changed since it
+    was taken.
+
+    :param conn: Connection to the database.
+    :param path: The snapshot to refresh.
+    :return: The number of movies pulled.
+    """
+    try:
+        snapshot = Snapshot(path)
+    except ValueError:
+        # written by an older version, start over
+        return export(conn, path)
+    try:
+        catalog = snapshot.catalog()
+        old_xid = snapshot.snapshot_xid
+    finally:
+        snapshot.close()
+
+    xid = begin_snapshot(conn)
+    with conn.cursor() as curs:
+        curs.execute(CHANGED_MOVIES_QUERY, {"xid": old_xid})
+        changed = [row[0] for row in curs.fetchall()]
+        curs.execute("SELECT movieid FROM movie")
+        current = set(row[0] for row in curs.fetchall())
+
+    for movie_id in list(catalog.movies):
+        if movie_id not in current:
+            del catalog.movies[movie_id]
+    catalog.load(conn, changed, old_xid)
+    conn.commit()
+
+    catalog.write(path, xid)
+    return len(changed)
+
+
+def browse(snapshot: Snapshot) -> int:
+    """
+    browse_movies, served from a local snapshot.
+
+    :param snapshot: The snapshot to browse.
+    :return: The movie id the user wants to view or -1 if they exited.
+    """
+
+    movie_search = movie_funcs.ask_search()
+    found = snapshot.search(movie_search.criteria)
+    sort_parameters = movie_funcs.default_sort_parameters()
+
+    skip_sort = False
+    while True:
+        if not skip_sort:
+            rows = snapshot.sort(found, sort_parameters)
+            if movie_search.limit != None:
+                rows = rows[:movie_search.limit]
+            for i in range(len(rows)):
+                movie_funcs.print_movie(i, snapshot.display_row(rows[i]))
+
+        skip_sort = False
+
+        print("\nFound %s result(s)" % len(rows))
+        if len(rows) == movie_search.limit:
+            print("Only the first %s are shown, add more to search by to narrow it down" % movie_search.limit)
+        input_text = "\nSorted by " + ", ".join([order.display_text() for order in sort_parameters]) + "\nSelect a movie by its number, 'e' to go back to the menu, or enter of the sort options above\n> "
+        user_input = input_utils.get_input_matching(input_text, regex='^(?:\d+|[etrsg])$')
+
+        if user_input.isdigit():
+            selected_film = int(user_input)
+            if selected_film >= len(rows):
+                print("Movie not in list!")
+                skip_sort = True
+            else:
+                return snapshot.columns["movie_id"][rows[selected_film]]
+
+        elif user_input == 'e':
+            return -1
+        else:
+            for sort_param in sort_parameters:
+                if sort_param.name[0] == user_input:
+                    sort_param.order += 1
+                    # wrap around sort orders
+                    sort_param.order %= 3
+
+
+def open_snapshot(conn, path: str = DEFAULT_PATH) -> Snapshot:
+    """
+    Brings the snapshot at path up to date (exporting it if it doesn't exist
+    yet) and maps it.
+
+    :param conn: Connection to the database.
+    :param path: Path to the snapshot.
+    :return: The snapshot.
+    """
+    if os.path.exists(path):
+        count = refresh(conn, path)
+        print("Refreshed %s movie(s) in the local catalog" % count)
+    else:
+        count = export(conn, path)
+        print("Exported %s movie(s) to the local catalog" % count)
+    return Snapshot(path)
+
+
+def main() -> int:
+    """
+    Exports or refreshes the snapshot from the command line.
+
+    :return: 0 on success
+    """
+    import sigmadb
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "refresh"
+    if command not in ["export", "refresh"]:
+        print(__doc__)
+        return 1
+
+    credentials = sigmadb.load_credentials()
+    if credentials == None:
+        return 1
+
+    path = credentials.get("catalog_snapshot", DEFAULT_PATH)
+    with sigmadb.connect(credentials) as conn:
+        conn = routing.primary_connection(conn)
+        if command == "export" or not os.path.exists(path):
+            print("Exported %s movie(s) to %s" % (export(conn, path), path))
+        else:
+            print("Refreshed %s movie(s) in %s" % (refresh(conn, path), path))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,108 @@
+#!/bin/python3
+
+"""
+Opening database connections from the credentials.
+
+sigmadb.connect() opens everything a session may use: the tunnel, the
+primary, the replicas and the shards. The pieces it is built from are here
+so library code can open only what it needs, e.g. a prefetch session only
+wants the database holding one user's rows.
+
+Each function takes a contextlib.ExitStack that closes what it opened.
+"""
+
+import psycopg2
+from sshtunnel import SSHTunnelForwarder
+
+import profiling
+import routing
+
+SSH_SERVER = ('starbug.cs.rit.edu', 22)
+
+DEFAULT_DATABASE = "p320_10"
+DEFAULT_PORT = 5432
+
+
+def open_tunnel(stack, credentials: dict, quiet: bool = False) -> tuple[str, int]:
+    """
+    Opens the SSH tunnel to starbug, unless the credentials have a "host"
+    (and optionally "port") to connect to directly.
+
+    :param stack: ExitStack closing the tunnel.
+    :param credentials: The parsed credentials file.
+    :param quiet: Don't print progress.
+    :return: (host, port) to connect to.
+    """
+    if "host" in credentials:
+        return credentials["host"], credentials.get("port", DEFAULT_PORT)
+
+    server = stack.enter_context(SSHTunnelForwarder(
+        SSH_SERVER,
+        ssh_username=credentials["username"],
+        ssh_password=credentials["password"],
+        remote_bind_address=('127.0.0.1', DEFAULT_PORT)))
+
+    server.start()
+    if not quiet:
+        print("Connected to server!")
+    return '127.0.0.1', server.local_bind_port
+
+
+def connection_params(credentials: dict, host: str, port: int) -> dict:
+    """
+    The primary's connection parameters, replicas and shards override them.
+    """
+    return {
+        'database': credentials.get("database", DEFAULT_DATABASE),
+        'user': credentials["username"],
+        'password': credentials["password"],
+        'host': host,
+        'port': port
+        }
+
+
+def open_connection(stack, params: dict, overrides: dict = None):
+    """
+    Connects with the primary's parameters, overridden by a replica's or
+    shard's entry.
+
+    :param stack: ExitStack closing the connection.
+    :param params: From connection_params().
+    :param overrides: An entry of "replicas" or "shards", or None for the primary.
+    :return: The connection.
+    """
+    conn_params = dict(params)
+    conn_params.update(overrides or {})
+    conn = psycopg2.connect(cursor_factory=profiling.cursor_factory(), **conn_params)
+    stack.callback(conn.close)
+    return conn
+
+
+def open_user_database(stack, credentials: dict, params: dict, userid: int):
+    """
+    Opens the database holding a user's rows: the primary of their shard,
+    or for users on the directory, a Router over it and its replicas when
+    replicas are configured.
+
+    :param stack: ExitStack closing the connections.
+    :param credentials: The parsed credentials file.
+    :param params: From connection_params().
+    :param userid: The user.
+    :return: A connection or a routing.Router.
+    """
+    directory = open_connection(stack, params)
+    shards = credentials.get("shards", [])
+    if len(shards) > 0:
+        with directory.cursor() as curs:
+            curs.execute(routing.SHARD_OF_QUERY, (userid,))
+            row = curs.fetchone()
+        directory.rollback()
+        # users without a placement live on the directory
+        if row != None and row[0] > 0:
+            directory.close()
+            return open_connection(stack, params, shards[row[0] - 1])
+
+    replicas = [open_connection(stack, params, replica) for replica in credentials.get("replicas", [])]
+    if len(replicas) == 0:
+        return directory
+    return routing.Router(directory, replicas, float(credentials.get("max_staleness", routing.DEFAULT_MAX_STALENESS)))
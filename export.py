@@ -0,0 +1,311 @@
+#!/bin/python3
+
+"""
+Streaming exports of user data and whole tables.
+
+CSV is written by COPY ... TO STDOUT straight into the output file and JSON
+lines are fetched through a server-side cursor one batch at a time, so
+memory use stays flat however long a history is. Files ending in '.gz' are
+gzip compressed as they are written.
+
+A user export writes one file per section into <directory>/user_<id>/:
+
+watches: every retained watch event
+watch_totals: views, minutes and first/last watch per movie over all time
+ratings, follows, followers: what they say
+collections: one row per movie in each collection (empty collections too)
+
+Every section of a user is read from the same snapshot. With 'all', users
+are exported in parallel, each worker on its own connection.
+
+With shards each user is read from their own shard, and a table export
+appends every shard's rows to the one file (except for the tables copied to
+every shard, see shards.py), each shard from its own snapshot. Follows are
+kept on both users' shards, each is taken from its follower's shard only.
+
+usage: export.py user <userid|all> <directory> [csv|jsonl] [gz] [workers]
+       export.py table <table> <file>
+"""
+
+import gzip
+import os
+import queue
+import sys
+import threading
+
+import routing
+import shards
+import streaming
+import transactions
+
+USER_SECTIONS = [
+    ("watches", """
+        SELECT w.movieid, m.title, w.datetime, w.watchduration
+        FROM watched AS w
+        JOIN movie AS m ON m.movieid = w.movieid
+        WHERE w.userid = %(userid)s
+        ORDER BY w.datetime
+        """),
+    ("watch_totals", """
+        SELECT r.movieid, m.title, r.views, r.total_duration, r.first_watched, r.last_watched
+        FROM watched_user_movie_rollup AS r
+        JOIN movie AS m ON m.movieid = r.movieid
+        WHERE r.userid = %(userid)s
+        ORDER BY r.last_watched
+        """),
+    ("ratings", """
+        SELECT r.movieid, m.title, r.rating
+        FROM rated AS r
+        JOIN movie AS m ON m.movieid = r.movieid
+        WHERE r.userid = %(userid)s
+        ORDER BY r.movieid
+        """),
+    ("follows", """
+        SELECT u.userid, u.username
+        FROM following AS f
+        JOIN "user" AS u ON u.userid = f.followingid
+        WHERE f.followerid = %(userid)s
+        ORDER BY u.username
+        """),
+    ("followers", """
+        SELECT u.userid, u.username
+        FROM following AS f
+        JOIN "user" AS u ON u.userid = f.followerid
+        WHERE f.followingid = %(userid)s
+        ORDER BY u.username
+        """),
+    ("collections", """
+        SELECT mc.collectionid, mc.name, ic.movieid, m.title
+        FROM moviecollection AS mc
+        LEFT JOIN incollection AS ic ON ic.collectionid = mc.collectionid
+        LEFT JOIN movie AS m ON m.movieid = ic.movieid
+        WHERE mc.madeby = %(userid)s
+        ORDER BY mc.name, m.title
+        """),
+]
+
+DEFAULT_WORKERS = 4
+
+# Tables whose rows are kept on both users' shards, by the column whose
+# user's shard a table export takes each row from
+EDGE_TABLES = {"following": "followerid"}
+
+PLACEMENTS_QUERY = "SELECT userid, shard FROM user_shard WHERE shard <> 0"
+
+# Rows whose user lives on a shard: on shard n > 0 the user is one of
+# "placed" there, on shard 0 none of "placed" anywhere else
+EDGES_OF_SHARD = "SELECT * FROM {table} WHERE ({column} = ANY(%(placed)s)) = %(local)s"
+
+
+def open_output(path: str):
+    """
+    Opens a file for writing text, gzip compressed if it ends in '.gz'.
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, 'wt', encoding='utf-8', newline='')
+    return open(path, 'w', encoding='utf-8', newline='')
+
+
+def write_query(conn, query: str, args: dict, output, output_format: str, header: bool = True) -> None:
+    """
+    Streams a query's result into an open file.
+
+    :param conn: Connection inside the export's transaction.
+    :param query: The query to export.
+    :param args: Arguments for the query's placeholders.
+    :param output: File from open_output().
+    :param output_format: 'csv' or 'jsonl'.
+    :param header: Whether CSV starts with the column names.
+    """
+    if output_format == "csv":
+        with conn.cursor() as curs:
+            bound = curs.mogrify(query, args).decode()
+            curs.copy_expert("COPY ({}) TO STDOUT WITH (FORMAT csv{})".format(bound, ", HEADER" if header else ""), output)
+    else:
+        # JSON is built by the server, dates and all, one row at a time
+        json_query = "SELECT row_to_json(q)::text FROM ({}) AS q".format(query)
+        for (row,) in streaming.stream_rows(conn, json_query, args):
+            output.write(row + "\n")
+
+
+def export_query(conn, query: str, args: dict, path: str, output_format: str) -> None:
+    """
+    Streams a query's result into a file.
+
+    :param conn: Connection inside the export's transaction.
+    :param query: The query to export.
+    :param args: Arguments for the query's placeholders.
+    :param path: File to write.
+    :param output_format: 'csv' or 'jsonl'.
+    """
+    with open_output(path) as output:
+        write_query(conn, query, args, output, output_format)
+
+
+def user_connection(conn, userid: int):
+    """
+    The primary holding a user's rows.
+
+    :param conn: A connection, Router or ShardRouter.
+    """
+    return routing.primary_connection(routing.connection_for(conn, userid))
+
+
+def export_user(conn, userid: int, directory: str, output_format: str = "csv", compress: bool = False) -> list[str]:
+    """
+    Exports every section of one user's data from a single snapshot.
+
+    :param conn: Connection to the database, not inside a transaction.
+    :param userid: The user to export.
+    :param directory: Where the user's directory is created.
+    :param output_format: 'csv' or 'jsonl'.
+    :param compress: Whether to gzip the files.
+    :return: The files written.
+    """
+    user_directory = os.path.join(directory, "user_%d" % userid)
+    os.makedirs(user_directory, exist_ok=True)
+
+    paths = []
+    with transactions.transaction(conn, read_only=True):
+        with conn.cursor() as curs:
+            curs.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        for name, query in USER_SECTIONS:
+            path = os.path.join(user_directory, name + "." + output_format + (".gz" if compress else ""))
+            export_query(conn, query, {"userid": userid}, path, output_format)
+            paths.append(path)
+    return paths
+
+
+def export_users(credentials: dict, userids, directory: str, output_format: str, compress: bool, workers: int = DEFAULT_WORKERS) -> int:
+    """
+    Exports many users in parallel.
+
+    :param credentials: The parsed credentials file, every worker connects with it.
+    :param userids: Iterable of user ids, consumed as workers free up.
+    :param directory: Where the users' directories are created.
+    :param output_format: 'csv' or 'jsonl'.
+    :param compress: Whether to gzip the files.
+    :param workers: Users exported at once.
+    :return: The number of users exported.
+    """
+    import sigmadb
+
+    # bounded so a huge user list is never held in memory at once
+    pending = queue.Queue(maxsize=workers * 4)
+    exported = [0] * workers
+
+    def worker(index: int) -> None:
+        with sigmadb.connect(credentials) as conn:
+            while True:
+                userid = pending.get()
+                if userid == None:
+                    return
+                try:
+                    export_user(user_connection(conn, userid), userid, directory, output_format, compress)
+                    exported[index] += 1
+                except Exception as e:
+                    # keep going, a dead worker would leave the queue full
+                    print("Failed to export user %d: %s" % (userid, e))
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        for userid in userids:
+            pending.put(userid)
+    finally:
+        for _ in threads:
+            pending.put(None)
+        for thread in threads:
+            thread.join()
+    return sum(exported)
+
+
+def all_userids(conn):
+    """
+    Yields every user id, fetched a batch at a time.
+    """
+    for (userid,) in streaming.stream_rows(conn, "SELECT userid FROM \"user\" ORDER BY userid"):
+        yield userid
+
+
+def export_table(conn, table: str, path: str) -> None:
+    """
+    Dumps a whole table, CSV or JSON lines depending on the file name.
+
+    :param conn: Connection, Router or ShardRouter, not inside a transaction.
+    :param table: Name of the table.
+    :param path: File to write, ending in .csv, .jsonl, .csv.gz or .jsonl.gz.
+    """
+    output_format = "jsonl" if path.removesuffix(".gz").endswith(".jsonl") else "csv"
+    directory = routing.primary_connection(conn)
+    with directory.cursor() as curs:
+        curs.execute("SELECT quote_ident(%s), to_regclass(quote_ident(%s))", (table, table))
+        quoted, exists = curs.fetchone()
+    directory.commit()
+    if exists == None:
+        raise ValueError("No table named '%s'" % table)
+
+    # the shards' copies of the replicated tables are the directory's rows again
+    sources = [directory] if quoted in shards.REPLICATED_TABLES else routing.shard_primaries(conn)
+    edges = len(sources) > 1 and quoted in EDGE_TABLES
+    query = "SELECT * FROM " + quoted
+    if edges:
+        query = EDGES_OF_SHARD.format(table=quoted, column=EDGE_TABLES[quoted])
+        with directory.cursor() as curs:
+            curs.execute(PLACEMENTS_QUERY)
+            placements = dict(curs.fetchall())
+        directory.commit()
+
+    with open_output(path) as output:
+        for index, source in enumerate(sources):
+            args = {}
+            if edges and index == 0:
+                args = {"placed": list(placements), "local": False}
+            elif edges:
+                args = {"placed": [userid for userid, shard in placements.items() if shard == index], "local": True}
+            with transactions.transaction(source, read_only=True):
+                write_query(source, query, args, output, output_format, header=index == 0)
+
+
+def main() -> int:
+    """
+    Runs an export from the command line.
+
+    :return: 0 on success
+    """
+    import sigmadb
+
+    arguments = sys.argv[1:]
+    if len(arguments) >= 3 and arguments[0] == "user":
+        target, directory = arguments[1], arguments[2]
+        options = arguments[3:]
+        output_format = "jsonl" if "jsonl" in options else "csv"
+        compress = "gz" in options
+        workers = next((int(option) for option in options if option.isdigit()), DEFAULT_WORKERS)
+    elif len(arguments) == 3 and arguments[0] == "table":
+        table, path = arguments[1], arguments[2]
+    else:
+        print(__doc__)
+        return 1
+
+    credentials = sigmadb.load_credentials()
+    if credentials == None:
+        return 1
+
+    with sigmadb.connect(credentials) as conn:
+        if arguments[0] == "table":
+            export_table(conn, table, path)
+            print("Exported %s to %s" % (table, path))
+        elif target == "all":
+            # every account is on the directory
+            count = export_users(credentials, all_userids(routing.primary_connection(conn)), directory, output_format, compress, workers)
+            print("Exported %d user(s) to %s" % (count, directory))
+        else:
+            export_user(user_connection(conn, int(target)), int(target), directory, output_format, compress)
+            print("Exported user %s to %s" % (target, directory))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,225 @@
+#!/bin/python3
+
+"""
+Activity feed of the users someone follows.
+
+Watching and rating a movie publish an event in the same transaction as
+the watch or rating. The event is kept in activity, the author's own
+history, and for most authors it is also copied into the feed_timeline of
+every follower (fan out on write), so reading a feed is one index range
+scan. Authors with more than FANOUT_LIMIT followers would make every write
+that expensive instead. Their events are only kept in activity, and they
+are added to feed_pull_author. Readers merge in the recent events of the
+pull authors they follow (merge on read).
+
+Pages are fetched by cursor (the last activityid seen), newest first, so
+each page costs the same however deep someone scrolls. The maintenance
+daemon's feed_trim job keeps every timeline and every author's history to
+the newest TIMELINE_LENGTH events. Events from before someone followed an
+author aren't copied into their timeline, and events from authors they
+have unfollowed are skipped.
+
+With shards, events stay on their author's shard, which also has every
+edge of the author's followers (see shards.py), so the fan out and the
+pull authors work as above on each shard. A page is gathered from every
+shard. Activity ids come from the time and the shard's number (migration
+8), so they are unique across shards and order events across them.
+"""
+
+import routing
+
+# Authors with more followers than this aren't fanned out on write
+FANOUT_LIMIT = 1000
+
+# Events kept per timeline and per author by trim()
+TIMELINE_LENGTH = 500
+
+PAGE_SIZE = 10
+
+# Cursor for the first page, newer than every event
+FIRST_PAGE = 2 ** 63 - 1
+
+CREATE_FEED_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS activity (
+        activityid bigserial PRIMARY KEY,
+        userid integer NOT NULL,
+        kind text NOT NULL CHECK (kind IN ('watch', 'rate')),
+        movieid integer NOT NULL,
+        value integer,
+        created timestamp NOT NULL,
+        fanned_out boolean NOT NULL
+    )
+    """,
+    # the pull authors' events, newest first
+    "CREATE INDEX IF NOT EXISTS activity_pull_idx ON activity (userid, activityid) WHERE NOT fanned_out",
+    """
+    CREATE TABLE IF NOT EXISTS feed_timeline (
+        ownerid integer NOT NULL,
+        activityid bigint NOT NULL,
+        actorid integer NOT NULL,
+        kind text NOT NULL,
+        movieid integer NOT NULL,
+        value integer,
+        created timestamp NOT NULL,
+        PRIMARY KEY (ownerid, activityid)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS feed_pull_author (
+        userid integer PRIMARY KEY
+    )
+    """,
+]
+
+# Milliseconds since the epoch, then the shard (8 bits), then the low 12
+# bits of the sequence. Always above the plain sequence ids handed out
+# before, so older events still sort first.
+CREATE_GLOBAL_ACTIVITY_IDS = [
+    """
+    CREATE OR REPLACE FUNCTION next_activity_id() RETURNS bigint
+    LANGUAGE sql VOLATILE AS $$
+        SELECT (floor(extract(epoch FROM clock_timestamp()) * 1000)::bigint << 20)
+             | (COALESCE((SELECT shard FROM shard_identity), 0)::bigint << 12)
+             | (nextval('activity_activityid_seq') & 4095)
+    $$
+    """,
+    "ALTER TABLE activity ALTER COLUMN activityid SET DEFAULT next_activity_id()",
+]
+
+COUNT_FOLLOWERS = "SELECT COUNT(*) FROM (SELECT 1 FROM \"following\" WHERE followingid = %s LIMIT %s) AS f"
+
+INSERT_ACTIVITY = """
+INSERT INTO activity (userid, kind, movieid, value, created, fanned_out)
+SELECT %s::integer, %s::text, e.movieid, e.value, %s::timestamp, %s::boolean
+FROM unnest(%s::integer[], %s::integer[]) AS e(movieid, value)
+RETURNING activityid
+"""
+
+FAN_OUT = """
+INSERT INTO feed_timeline (ownerid, activityid, actorid, kind, movieid, value, created)
+SELECT f.followerid, a.activityid, a.userid, a.kind, a.movieid, a.value, a.created
+FROM activity AS a
+JOIN "following" AS f ON f.followingid = a.userid
+WHERE a.activityid = ANY(%s)
+"""
+
+ADD_PULL_AUTHOR = "INSERT INTO feed_pull_author (userid) VALUES (%s) ON CONFLICT DO NOTHING"
+
+# Newest events older than the cursor: the owner's timeline plus the recent
+# events of each pull author they follow, at most a page from each.
+FEED_PAGE_QUERY = """
+SELECT e.activityid, u.username, e.kind, e.movieid, e.value, e.created
+FROM (
+    (
+        SELECT t.activityid, t.actorid, t.kind, t.movieid, t.value, t.created
+        FROM feed_timeline AS t
+        WHERE t.ownerid = %(userid)s AND t.activityid < %(before)s
+        AND EXISTS (SELECT 1 FROM "following" AS f WHERE f.followerid = t.ownerid AND f.followingid = t.actorid)
+        ORDER BY t.activityid DESC
+        LIMIT %(limit)s
+    )
+    UNION ALL
+    (
+        SELECT recent.activityid, recent.userid, recent.kind, recent.movieid, recent.value, recent.created
+        FROM feed_pull_author AS p
+        JOIN "following" AS f ON f.followingid = p.userid AND f.followerid = %(userid)s
+        CROSS JOIN LATERAL (
+            SELECT a.activityid, a.userid, a.kind, a.movieid, a.value, a.created
+            FROM activity AS a
+            WHERE a.userid = p.userid AND NOT a.fanned_out AND a.activityid < %(before)s
+            ORDER BY a.activityid DESC
+            LIMIT %(limit)s
+        ) AS recent
+    )
+) AS e
+JOIN "user" AS u ON u.userid = e.actorid
+ORDER BY e.activityid DESC
+LIMIT %(limit)s
+"""
+
+TRIM_TIMELINES = """
+DELETE FROM feed_timeline AS t
+USING (
+    SELECT ownerid, activityid
+    FROM (SELECT ownerid, activityid, row_number() OVER (PARTITION BY ownerid ORDER BY activityid DESC) AS position FROM feed_timeline) AS ranked
+    WHERE position > %s
+) AS old
+WHERE t.ownerid = old.ownerid AND t.activityid = old.activityid
+"""
+
+TRIM_ACTIVITY = """
+DELETE FROM activity AS a
+USING (
+    SELECT activityid
+    FROM (SELECT activityid, row_number() OVER (PARTITION BY userid ORDER BY activityid DESC) AS position FROM activity) AS ranked
+    WHERE position > %s
+) AS old
+WHERE a.activityid = old.activityid
+"""
+
+TRIM_PULL_AUTHORS = """
+DELETE FROM feed_pull_author AS p
+WHERE NOT EXISTS (SELECT 1 FROM activity AS a WHERE a.userid = p.userid AND NOT a.fanned_out)
+"""
+
+
+def publish(curs, userid: int, kind: str, events: list[tuple[int, int]], created) -> None:
+    """
+    Publishes events to an author's followers. Call it inside the
+    transaction that made the change.
+
+    :param curs: Cursor inside the writing transaction.
+    :param userid: The author.
+    :param kind: 'watch' (value is the minutes watched) or 'rate' (value is the rating).
+    :param events: (movieid, value) of each event.
+    :param created: When the events happened.
+    """
+    if len(events) == 0:
+        return
+
+    # counting stops as soon as the author is known to be too big
+    curs.execute(COUNT_FOLLOWERS, (userid, FANOUT_LIMIT + 1))
+    fan_out = curs.fetchone()[0] <= FANOUT_LIMIT
+
+    curs.execute(INSERT_ACTIVITY, (userid, kind, created, fan_out, [movieid for movieid, value in events], [value for movieid, value in events]))
+    activityids = [activityid for (activityid,) in curs.fetchall()]
+
+    if fan_out:
+        curs.execute(FAN_OUT, (activityids,))
+    else:
+        curs.execute(ADD_PULL_AUTHOR, (userid,))
+
+
+def page(conn, userid: int, before: int = FIRST_PAGE, limit: int = PAGE_SIZE) -> list[tuple]:
+    """
+    One page of someone's feed, newest first.
+
+    :param conn: Connection to the database, or a ShardRouter to merge every shard's events.
+    :param userid: Whose feed.
+    :param before: Cursor, the activityid of the last event on the previous page.
+    :param limit: Events per page.
+    :return: (activityid, username, kind, movieid, value, created) rows.
+    """
+    results = routing.gather(conn, FEED_PAGE_QUERY, {"userid": userid, "before": before, "limit": limit})
+    # each shard sends its own newest page
+    results.sort(key=lambda result: result[0], reverse=True)
+    return results[:limit]
+
+
+def trim(conn) -> tuple[int, int]:
+    """
+    Drops all but the newest TIMELINE_LENGTH events of every timeline and
+    every author, and forgets pull authors with none left.
+
+    :param conn: Connection to the primary.
+    :return: (timeline rows, activity rows) deleted
+    """
+    with conn.cursor() as curs:
+        curs.execute(TRIM_TIMELINES, (TIMELINE_LENGTH,))
+        timeline_rows = curs.rowcount
+        curs.execute(TRIM_ACTIVITY, (TIMELINE_LENGTH,))
+        activity_rows = curs.rowcount
+        curs.execute(TRIM_PULL_AUTHORS)
+    conn.commit()
+    return timeline_rows, activity_rows
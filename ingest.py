@@ -0,0 +1,329 @@
+#!/bin/python3
+
+"""
+Bulk catalog ingestion.
+
+Loads movies with their releases, genres, cast, directors and studios from
+CSV or JSON-lines dumps. The dumps are parsed in parallel worker processes.
+Genres, studios and crew members are matched against what is already in
+the database and deduplicated (ignoring case), and every foreign key is
+resolved in memory. Each table is then loaded with one COPY, in dependency
+order, all in a single transaction. Large loads drop the browse indexes
+on the loaded tables first and rebuild them once at the end. The derived
+data (similar movies, catalog snapshot) is refreshed by asking the
+maintenance daemon once the load has committed. With shards the catalog is
+loaded into the directory and then synced to every shard (see shards.py).
+
+One record per movie. In JSON lines:
+
+{"title": "Alien", "length": 117, "mpaa": "R", "releases": ["1979-05-25"],
+ "genres": ["Horror", "Sci-Fi"], "cast": ["Sigourney Weaver", "Tom Skerritt"],
+ "directors": ["Ridley Scott"], "studios": ["20th Century Fox"]}
+
+In CSV the same columns (header row required), with list columns separated
+by '|'. A crew member's last name is the last word of their name. A movie
+whose title and first release date match one already loaded is skipped.
+
+usage: ingest.py <dump file> [dump file ...]
+"""
+
+import concurrent.futures
+import csv
+import datetime
+import io
+import itertools
+import json
+import sys
+import time
+
+import maintenance
+import routing
+import schema
+import shards
+
+# Separates the items of a list column in CSV dumps
+LIST_SEPARATOR = "|"
+
+# Records parsed per task handed to a worker process
+CHUNK_SIZE = 5000
+
+# Loads adding more link rows than this drop and rebuild the indexes on the
+# loaded tables instead of updating them row by row
+DEFER_INDEXES_ROWS = 100000
+
+# (table, id column or None, columns) in the order they must be loaded
+TABLES = [
+    ("genre", "genreid", ["genreid", "genrename"]),
+    ("studio", "studioid", ["studioid", "name"]),
+    ("crewmember", "crewid", ["crewid", "firstname", "lastname"]),
+    ("movie", "movieid", ["movieid", "title", "length", "mpaarating"]),
+    ("movierelease", None, ["movieid", "releasedate"]),
+    ("moviegenre", None, ["movieid", "genreid"]),
+    ("actsin", None, ["crewid", "movieid"]),
+    ("directed", None, ["crewid", "movieid"]),
+    ("produced", None, ["studioid", "movieid"]),
+]
+
+EXISTING_MOVIES_QUERY = """
+SELECT m.movieid, m.title, (SELECT MIN(releasedate) FROM movierelease AS mr WHERE mr.movieid = m.movieid)
+FROM movie AS m
+"""
+
+
+def split_list(value) -> list[str]:
+    """
+    A list column as a list, from either a JSON list or a '|' separated string.
+    """
+    if value == None:
+        return []
+    if isinstance(value, str):
+        value = value.split(LIST_SEPARATOR)
+    return [str(item).strip() for item in value if str(item).strip() != ""]
+
+
+def split_name(name: str) -> tuple[str, str]:
+    """
+    (first name, last name) of a crew member, the last name is the last word.
+    """
+    parts = name.rsplit(" ", 1)
+    if len(parts) == 1:
+        return ("", parts[0])
+    return (parts[0], parts[1])
+
+
+def parse_record(record: dict) -> dict:
+    """
+    Normalizes one movie record from a dump.
+
+    :param record: The record as read from CSV or JSON.
+    :return: The movie with typed fields and list columns as lists.
+    """
+    length = record.get("length")
+    return {
+        "title": str(record["title"]).strip(),
+        "length": int(length) if length not in [None, ""] else None,
+        "mpaa": str(record["mpaa"]).strip() if record.get("mpaa") not in [None, ""] else None,
+        "releases": sorted(set(datetime.date.fromisoformat(day) for day in split_list(record.get("releases")))),
+        "genres": split_list(record.get("genres")),
+        "cast": [split_name(name) for name in split_list(record.get("cast"))],
+        "directors": [split_name(name) for name in split_list(record.get("directors"))],
+        "studios": split_list(record.get("studios")),
+    }
+
+
+def parse_records(records: list[dict]) -> list[dict]:
+    """
+    Worker process task: parses a chunk of records.
+    """
+    return [parse_record(record) for record in records]
+
+
+def read_records(path: str):
+    """
+    Yields the raw records of a CSV or JSON-lines dump.
+
+    :param path: Dump file, '.csv' for CSV and anything else for JSON lines.
+    """
+    with open(path, 'r', newline='') as df:
+        if path.lower().endswith(".csv"):
+            yield from csv.DictReader(df)
+        else:
+            for line in df:
+                if line.strip() != "":
+                    yield json.loads(line)
+
+
+def copy_text(value) -> str:
+    """
+    A value in COPY's text format.
+    """
+    if value == None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+class Catalog():
+    def __init__(self, curs):
+        """
+        The entities already in the database, keyed the way new ones are
+        deduplicated, and the rows to add.
+
+        :param curs: Cursor inside the load's transaction (after the tables are locked).
+        """
+        curs.execute("SELECT LOWER(genrename), genreid FROM genre")
+        self.genres = dict(curs.fetchall())
+        curs.execute("SELECT LOWER(name), studioid FROM studio")
+        self.studios = dict(curs.fetchall())
+        curs.execute("SELECT LOWER(firstname), LOWER(lastname), crewid FROM crewmember")
+        self.crew = {(first, last): crewid for first, last, crewid in curs.fetchall()}
+        curs.execute(EXISTING_MOVIES_QUERY)
+        self.movies = {(title.lower(), first_release): movieid for movieid, title, first_release in curs.fetchall()}
+
+        self.next_ids = {}
+        for table, id_column, columns in TABLES:
+            if id_column != None:
+                curs.execute("SELECT COALESCE(MAX({}), 0) + 1 FROM {}".format(id_column, table))
+                self.next_ids[table] = curs.fetchone()[0]
+
+        self.rows = {table: [] for table, id_column, columns in TABLES}
+        self.links = {table: set() for table, id_column, columns in TABLES if id_column == None}
+        self.skipped = 0
+
+    def entity(self, table: str, known: dict, key, values: tuple) -> int:
+        """
+        The id of an entity, adding it if it is new.
+
+        :param table: Table the entity belongs in.
+        :param known: Ids of the table's entities by key.
+        :param key: The entity's deduplication key.
+        :param values: The entity's columns after the id.
+        """
+        if key not in known:
+            known[key] = self.next_ids[table]
+            self.next_ids[table] += 1
+            self.rows[table].append((known[key],) + values)
+        return known[key]
+
+    def add(self, movie: dict) -> None:
+        """
+        Resolves a parsed movie into rows for every table.
+        """
+        key = (movie["title"].lower(), movie["releases"][0] if len(movie["releases"]) > 0 else None)
+        if key in self.movies:
+            self.skipped += 1
+            return
+        movieid = self.entity("movie", self.movies, key, (movie["title"], movie["length"], movie["mpaa"]))
+
+        for day in movie["releases"]:
+            self.links["movierelease"].add((movieid, day))
+        for name in movie["genres"]:
+            self.links["moviegenre"].add((movieid, self.entity("genre", self.genres, name.lower(), (name,))))
+        for first, last in movie["cast"]:
+            self.links["actsin"].add((self.entity("crewmember", self.crew, (first.lower(), last.lower()), (first, last)), movieid))
+        for first, last in movie["directors"]:
+            self.links["directed"].add((self.entity("crewmember", self.crew, (first.lower(), last.lower()), (first, last)), movieid))
+        for name in movie["studios"]:
+            self.links["produced"].add((self.entity("studio", self.studios, name.lower(), (name,)), movieid))
+
+    def table_rows(self, table: str) -> list[tuple]:
+        if table in self.links:
+            return sorted(self.links[table])
+        return self.rows[table]
+
+
+def copy_rows(curs, table: str, columns: list[str], rows: list[tuple]) -> None:
+    """
+    Loads rows into a table with COPY.
+    """
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(copy_text(value) for value in row) + "\n")
+    buffer.seek(0)
+    curs.copy_expert("COPY {} ({}) FROM STDIN".format(table, ", ".join(columns)), buffer)
+
+
+def parse_dumps(paths: list[str], workers: int = None) -> list[dict]:
+    """
+    Reads every dump and parses its records in worker processes.
+
+    :param paths: Dump files.
+    :param workers: Worker processes, None for one per CPU.
+    :return: The parsed movies in file order.
+    """
+    records = itertools.chain.from_iterable(read_records(path) for path in paths)
+    chunks = iter(lambda: list(itertools.islice(records, CHUNK_SIZE)), [])
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        return list(itertools.chain.from_iterable(pool.map(parse_records, chunks)))
+
+
+def load(conn, movies: list[dict]) -> dict:
+    """
+    Loads parsed movies in one transaction.
+
+    :param conn: Connection to the primary.
+    :param movies: Movies from parse_dumps().
+    :return: Rows loaded per table, plus 'skipped' for movies already present.
+    """
+    table_names = [table for table, id_column, columns in TABLES]
+    with conn.cursor() as curs:
+        # keeps concurrent writers out while ids are handed out, readers carry on
+        curs.execute("LOCK TABLE {} IN SHARE ROW EXCLUSIVE MODE".format(", ".join(table_names)))
+
+        catalog = Catalog(curs)
+        for movie in movies:
+            catalog.add(movie)
+
+        link_rows = sum(len(catalog.links[table]) for table in catalog.links)
+        deferred = [index for index in schema.INDEXES if index.table in table_names] if link_rows > DEFER_INDEXES_ROWS else []
+        for index in deferred:
+            curs.execute(index.drop_sql())
+
+        counts = {}
+        for table, id_column, columns in TABLES:
+            rows = catalog.table_rows(table)
+            copy_rows(curs, table, columns, rows)
+            counts[table] = len(rows)
+
+        for index in deferred:
+            curs.execute(index.create_sql())
+
+        # ids were given out by hand, move any serial sequences past them
+        for table, id_column, columns in TABLES:
+            if id_column != None:
+                curs.execute("SELECT pg_get_serial_sequence(%s, %s)", (table, id_column))
+                sequence = curs.fetchone()[0]
+                if sequence != None:
+                    curs.execute("SELECT setval(%s, (SELECT MAX({}) FROM {}))".format(id_column, table), (sequence,))
+
+        curs.execute("ANALYZE " + ", ".join(table_names))
+    conn.commit()
+
+    # delivered once the load has committed
+    maintenance.request_run(conn, "similarity")
+    maintenance.request_run(conn, "catalog_snapshot")
+
+    counts["skipped"] = catalog.skipped
+    return counts
+
+
+def main() -> int:
+    """
+    Ingests dumps from the command line.
+
+    :return: 0 on success
+    """
+    import sigmadb
+
+    if len(sys.argv) < 2:
+        print(__doc__)
+        return 1
+
+    credentials = sigmadb.load_credentials()
+    if credentials == None:
+        return 1
+
+    start = time.perf_counter()
+    movies = parse_dumps(sys.argv[1:])
+    parsed = time.perf_counter()
+    print("Parsed %d movie(s) in %.1fs" % (len(movies), parsed - start))
+
+    with sigmadb.connect(credentials) as conn:
+        counts = load(routing.primary_connection(conn), movies)
+        loaded = time.perf_counter()
+        # browsing, caches and foreign keys on the shards use their copies of the catalog
+        if isinstance(conn, routing.ShardRouter):
+            changed = shards.sync(conn)
+            print("Synced the catalog to %d shard(s), %d row(s) changed in %.1fs" % (len(changed), sum(changed), time.perf_counter() - loaded))
+
+    skipped = counts.pop("skipped")
+    total = sum(counts.values())
+    for table, count in counts.items():
+        print("\t%s: %d row(s)" % (table, count))
+    print("Loaded %d row(s) in %.1fs (%.0f rows/s), skipped %d movie(s) already present" %
+          (total, loaded - parsed, total / max(loaded - parsed, 1e-9), skipped))
+    print("Total %.1fs, %.0f rows/s" % (loaded - start, total / max(loaded - start, 1e-9)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,6 +6,32 @@ Some functions to help with input validation
 
 import re
 import getpass
+import threading
+import contextlib
+
+import profiling
+
+# Answers fed to get_input_matching in place of the terminal, per thread
+_scripted = threading.local()
+
+
+@contextlib.contextmanager
+def scripted_answers(answers: list[str]):
+    """
+    Answers the prompts in the calling thread from a list instead of the
+    terminal, e.g. for load testing. Running out of answers raises EOFError
+    (like input() at the end of a file) and an answer that doesn't match its
+    prompt raises ValueError, scripted input is never retried.
+
+    :param answers: Answers in the order the prompts will ask for them.
+    """
+    previous = getattr(_scripted, "answers", None)
+    _scripted.answers = list(answers)
+    try:
+        yield
+    finally:
+        _scripted.answers = previous
+
 
 def get_input_matching(prompt: str, max_len: int = -1, regex: str = None, failure: str = "Invalid input!", hide_input: bool = False) -> str:
     """
@@ -19,15 +45,26 @@ def get_input_matching(prompt: str, max_len: int = -1, regex: str = None, failur
     :return: The user's input.
     """
 
+    answers = getattr(_scripted, "answers", None)
+    if answers != None:
+        if len(answers) == 0:
+            raise EOFError("No scripted answer for prompt %r" % prompt)
+        answer = answers.pop(0).strip()
+        if answer == "" or (max_len != -1 and len(answer) > max_len) or (regex and re.match(regex, answer) == None):
+            raise ValueError("Scripted answer %r doesn't match prompt %r" % (answer, prompt))
+        return answer
+
     invalid = True
     sanitized_input = ""
 
     while invalid:
         invalid = False
-        if hide_input:
-            sanitized_input = getpass.getpass(prompt).strip()
-        else:
-            sanitized_input = input(prompt).strip()
+        # waiting on the user isn't part of a profiled action's time
+        with profiling.timed(profiling.INPUT):
+            if hide_input:
+                sanitized_input = getpass.getpass(prompt).strip()
+            else:
+                sanitized_input = input(prompt).strip()
 
         # must NOT be blank
         if sanitized_input == "":
@@ -0,0 +1,407 @@
+#!/bin/python3
+
+"""
+Concurrent user-session load generator.
+
+Drives scripted sessions through the real movie_funcs and user_funcs flows,
+many at once, and reports throughput, latency percentiles per step, errors
+and lock waits. Every prompt is answered from the scenario file instead of
+the terminal (see input_utils.scripted_answers).
+
+A scenario file is JSON:
+
+{
+    "concurrency": 8,           sessions running at once (one connection each)
+    "arrival_rate": 4.0,        new sessions per second, 0 to start them all at once
+    "sessions": 200,            sessions to run in total
+    "users": [{"username": "alice", "password": "secret"}, ...],
+    "scenarios": [
+        {
+            "name": "browse and watch",
+            "weight": 3,
+            "steps": [
+                {"step": "login", "answers": ["{username}", "{password}"]},
+                {"step": "browse_movies", "answers": ["1", "star", "7", "1977", "s", "0"]},
+                {"step": "watch_movie"}
+            ]
+        }
+    ]
+}
+
+Each session picks a scenario by weight and the next user in "users". In
+answers {username}, {password} (and any other field of the user) and
+{session} are filled in. The steps are the names in STEPS, a step fails
+(and ends its session) if it raises, runs out of answers or is given one
+that doesn't match its prompt.
+
+usage: loadgen.py <scenario file>
+"""
+
+import contextlib
+import json
+import math
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+import input_utils
+import movie_funcs
+import routing
+import transactions
+import user_funcs
+
+# How often the lock monitor looks for sessions waiting on a lock
+LOCK_SAMPLE_INTERVAL = 0.1
+
+LOCK_WAITS_QUERY = """
+SELECT COUNT(*)
+FROM pg_stat_activity
+WHERE wait_event_type = 'Lock' AND datname = current_database()
+"""
+
+PERCENTILES = [50, 90, 99]
+
+
+class Session():
+    def __init__(self, number: int, scenario: dict, user: dict):
+        """
+        :param number: Index of the session in the run.
+        :param scenario: The scenario it runs.
+        :param user: The user it runs as.
+        """
+        self.number = number
+        self.scenario = scenario
+        self.variables = dict(user)
+        self.variables["session"] = number
+        self.username = ""
+        self.userid = -1
+        self.movie_id = -1
+        self.collection_id = -1
+        # when the session was due to start, to measure queueing
+        self.due = 0.0
+
+
+def step_create_account(conn, session: Session) -> None:
+    session.username, session.userid = user_funcs.create_account(conn)
+
+
+def step_login(conn, session: Session) -> None:
+    session.username, session.userid = user_funcs.login(conn)
+
+
+def step_browse_movies(conn, session: Session) -> None:
+    session.movie_id = movie_funcs.browse_movies(conn)
+
+
+def step_watch_movie(conn, session: Session) -> None:
+    movie_funcs.watch_movie(conn, session.userid, session.movie_id)
+
+
+def step_rate_movie(conn, session: Session) -> None:
+    movie_funcs.rate_movie(conn, session.userid, session.movie_id)
+
+
+def step_follow_user(conn, session: Session) -> None:
+    user_funcs.follow_user(conn, session.userid)
+
+
+def step_unfollow_user(conn, session: Session) -> None:
+    user_funcs.unfollow_user(conn, session.userid)
+
+
+def step_create_collection(conn, session: Session) -> None:
+    user_funcs.create_collection(conn, session.userid)
+
+
+def step_browse_collections(conn, session: Session) -> None:
+    session.collection_id = user_funcs.browse_collections(conn, session.userid)
+
+
+def step_modify_collection(conn, session: Session) -> None:
+    user_funcs.modify_collection(conn, session.userid, session.collection_id)
+
+
+def step_top_20_last_90_days(conn, session: Session) -> None:
+    movie_funcs.top_20_last_90_days(conn)
+
+
+def step_top_20_among_followers(conn, session: Session) -> None:
+    movie_funcs.top_20_among_followers(conn, session.userid)
+
+
+def step_top_5_releases_of_month(conn, session: Session) -> None:
+    movie_funcs.top_5_releases_of_month(conn)
+
+
+def step_view_recommended(conn, session: Session) -> None:
+    movie_funcs.view_recommended(conn, session.userid)
+
+
+def step_view_profile(conn, session: Session) -> None:
+    user_funcs.view_profile(conn, session.userid)
+
+
+# Step names usable in a scenario. Steps that need a movie or collection use
+# the one picked by the last browse_movies or browse_collections step.
+STEPS = {
+    "create_account": step_create_account,
+    "login": step_login,
+    "browse_movies": step_browse_movies,
+    "watch_movie": step_watch_movie,
+    "rate_movie": step_rate_movie,
+    "follow_user": step_follow_user,
+    "unfollow_user": step_unfollow_user,
+    "create_collection": step_create_collection,
+    "browse_collections": step_browse_collections,
+    "modify_collection": step_modify_collection,
+    "top_20_last_90_days": step_top_20_last_90_days,
+    "top_20_among_followers": step_top_20_among_followers,
+    "top_5_releases_of_month": step_top_5_releases_of_month,
+    "view_recommended": step_view_recommended,
+    "view_profile": step_view_profile,
+}
+
+
+class Results():
+    def __init__(self):
+        """
+        Measurements shared by every worker.
+        """
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.queue_delays = []
+        self.sessions_completed = 0
+        self.sessions_failed = 0
+        self.lock_samples = 0
+        self.lock_samples_waiting = 0
+        self.lock_waiters_max = 0
+        self.lock_waiters_total = 0
+
+    def record_step(self, step: str, seconds: float) -> None:
+        with self.lock:
+            self.latencies.setdefault(step, []).append(seconds)
+
+    def record_error(self, step: str, error: Exception) -> None:
+        # database errors are told apart by their SQLSTATE, e.g. 40P01 for a deadlock
+        code = getattr(error, "pgcode", None)
+        name = type(error).__name__ if code == None else "%s (%s)" % (type(error).__name__, code)
+        with self.lock:
+            key = (step, name)
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def record_session(self, queue_delay: float, completed: bool) -> None:
+        with self.lock:
+            self.queue_delays.append(queue_delay)
+            if completed:
+                self.sessions_completed += 1
+            else:
+                self.sessions_failed += 1
+
+    def record_lock_sample(self, waiting: int) -> None:
+        with self.lock:
+            self.lock_samples += 1
+            if waiting > 0:
+                self.lock_samples_waiting += 1
+            self.lock_waiters_max = max(self.lock_waiters_max, waiting)
+            self.lock_waiters_total += waiting
+
+
+def load_scenario_file(path: str) -> dict:
+    """
+    Reads and checks a scenario file.
+
+    :param path: Path to the JSON scenario file.
+    :return: The parsed file.
+    """
+    with open(path, 'r') as sf:
+        config = json.load(sf)
+
+    if len(config.get("scenarios", [])) == 0:
+        raise ValueError("Scenario file has no scenarios")
+    for scenario in config["scenarios"]:
+        for step in scenario["steps"]:
+            if step["step"] not in STEPS:
+                raise ValueError("Unknown step '%s' in scenario '%s'" % (step["step"], scenario.get("name", "")))
+    return config
+
+
+def make_sessions(config: dict) -> list[Session]:
+    """
+    Picks the scenario and user of every session in the run.
+
+    :param config: The parsed scenario file.
+    """
+    scenarios = config["scenarios"]
+    weights = [scenario.get("weight", 1) for scenario in scenarios]
+    users = config.get("users", [{}])
+    return [Session(i, random.choices(scenarios, weights)[0], users[i % len(users)]) for i in range(int(config.get("sessions", 1)))]
+
+
+def percentile(values: list[float], percent: float) -> float:
+    """
+    Nearest-rank percentile of a sorted list.
+    """
+    if len(values) == 0:
+        return 0.0
+    rank = max(1, math.ceil(percent / 100 * len(values)))
+    return values[rank - 1]
+
+
+def run_session(conn, session: Session, results: Results) -> None:
+    """
+    Runs every step of a session, stopping at the first failure.
+
+    :param conn: The worker's connection.
+    :param session: The session to run.
+    :param results: Where to record the measurements.
+    """
+    queue_delay = time.perf_counter() - session.due
+    for step in session.scenario["steps"]:
+        answers = [answer.format(**session.variables) for answer in step.get("answers", [])]
+        start = time.perf_counter()
+        try:
+            with input_utils.scripted_answers(answers):
+                STEPS[step["step"]](conn, session)
+        except Exception as e:
+            results.record_error(step["step"], e)
+            routing.primary_connection(conn).rollback()
+            results.record_session(queue_delay, False)
+            return
+        results.record_step(step["step"], time.perf_counter() - start)
+    results.record_session(queue_delay, True)
+
+
+def worker(credentials: dict, sessions: queue.Queue, results: Results) -> None:
+    """
+    Runs sessions from the queue on one connection until it gets None.
+    """
+    import sigmadb
+
+    with sigmadb.connect(credentials) as conn:
+        transactions.interactive(conn, credentials)
+        while True:
+            session = sessions.get()
+            if session == None:
+                return
+            run_session(conn, session, results)
+
+
+def lock_monitor(conn, results: Results, done: threading.Event) -> None:
+    """
+    Samples how many backends are waiting on a lock until the run is done.
+    """
+    with conn.cursor() as curs:
+        while not done.is_set():
+            curs.execute(LOCK_WAITS_QUERY)
+            results.record_lock_sample(curs.fetchone()[0])
+            conn.commit()
+            done.wait(LOCK_SAMPLE_INTERVAL)
+
+
+def run(credentials: dict, config: dict) -> tuple[Results, float]:
+    """
+    Runs the load described by a scenario file.
+
+    :param credentials: The parsed credentials file, each worker connects with it.
+    :param config: The parsed scenario file.
+    :return: (results, seconds the run took)
+    """
+    import sigmadb
+
+    concurrency = int(config.get("concurrency", 1))
+    arrival_rate = float(config.get("arrival_rate", 0))
+    sessions = make_sessions(config)
+    results = Results()
+    pending = queue.Queue()
+    done = threading.Event()
+
+    with sigmadb.connect(credentials) as monitor_conn:
+        monitor = threading.Thread(target=lock_monitor, args=(routing.primary_connection(monitor_conn), results, done))
+        monitor.start()
+
+        workers = [threading.Thread(target=worker, args=(credentials, pending, results)) for _ in range(concurrency)]
+        for thread in workers:
+            thread.start()
+
+        start = time.perf_counter()
+        due = start
+        for session in sessions:
+            # open model: sessions arrive on their own schedule (Poisson) whether or not workers are free
+            if arrival_rate > 0:
+                due += random.expovariate(arrival_rate)
+                time.sleep(max(0.0, due - time.perf_counter()))
+            session.due = due
+            pending.put(session)
+        for _ in workers:
+            pending.put(None)
+
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        done.set()
+        monitor.join()
+
+    return results, elapsed
+
+
+def print_report(results: Results, elapsed: float) -> None:
+    """
+    Prints throughput, per-step latency, errors and lock waits.
+
+    :param results: The measurements of a run.
+    :param elapsed: How long the run took in seconds.
+    """
+    sessions = results.sessions_completed + results.sessions_failed
+    steps = sum(len(latencies) for latencies in results.latencies.values())
+    print("Ran %d session(s) in %.1fs: %d completed, %d failed" % (sessions, elapsed, results.sessions_completed, results.sessions_failed))
+    print("Throughput: %.2f sessions/s, %.2f steps/s" % (sessions / elapsed, steps / elapsed))
+
+    delays = sorted(results.queue_delays)
+    print("Session start delay: p50 %.1fms, p99 %.1fms" % (1000 * percentile(delays, 50), 1000 * percentile(delays, 99)))
+
+    print("\n%-24s %8s %8s %8s %8s %8s" % ("step", "count", *["p%d ms" % percent for percent in PERCENTILES], "max ms"))
+    for step, latencies in sorted(results.latencies.items()):
+        latencies = sorted(latencies)
+        print("%-24s %8d %8.1f %8.1f %8.1f %8.1f" % (step, len(latencies), *[1000 * percentile(latencies, percent) for percent in PERCENTILES], 1000 * latencies[-1]))
+
+    if len(results.errors) > 0:
+        print("\nErrors:")
+        for (step, name), count in sorted(results.errors.items()):
+            print("\t%s: %s x%d" % (step, name, count))
+
+    if results.lock_samples > 0:
+        print("\nLock waits: seen in %.1f%% of samples, %.2f waiting on average, %d at most" %
+              (100 * results.lock_samples_waiting / results.lock_samples, results.lock_waiters_total / results.lock_samples, results.lock_waiters_max))
+
+
+def main() -> int:
+    """
+    Runs a scenario file from the command line.
+
+    :return: 0 on success
+    """
+    import sigmadb
+
+    if len(sys.argv) != 2:
+        print(__doc__)
+        return 1
+
+    credentials = sigmadb.load_credentials()
+    if credentials == None:
+        return 1
+    config = load_scenario_file(sys.argv[1])
+
+    # the flows print as they go, keep that out of the report
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        results, elapsed = run(credentials, config)
+    print_report(results, elapsed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,415 @@
+#!/bin/python3
+
+"""
+Background maintenance daemon.
+
+Keeps the derived data up to date outside the interactive request path by
+running jobs on their own schedule:
+
+partitions: create upcoming watched partitions, roll up and drop expired ones
+vacuum_analyze: VACUUM (ANALYZE) the tables that take the most writes
+leaderboard_warmup: run the leaderboard queries so their pages stay cached
+similarity: rebuild the "more like this" neighbours (needs numpy)
+catalog_snapshot: refresh the local catalog snapshot, if one is configured
+feed_trim: cut activity feed timelines back to their newest events
+
+Each job runs every so often (with some random jitter so jobs don't line up)
+and at most "maintenance_concurrency" jobs run at once, each worker on its
+own connection. With shards the jobs that keep up a user's data run on
+every shard in turn (SHARDED_JOBS), the rest on the directory. Jobs that
+rebuild a table copied to every shard sync it to the shards afterwards
+(SYNCED_JOBS). Jobs can
+also be run on demand, the daemon listens for them
+on the sigma_maintenance channel. After every job the daemon writes its
+metrics to a status file, so checking on it never touches the database or
+waits on a job.
+
+credentials.json may set:
+    "maintenance_intervals": {"similarity": 3600, ...}   seconds between runs of a job
+    "maintenance_jitter": 0.1                            fraction of the interval to vary by
+    "maintenance_concurrency": 2                         jobs running at once
+
+usage: maintenance.py [daemon|status|run <job>]
+"""
+
+import json
+import os
+import queue
+import random
+import select
+import sys
+import threading
+import time
+
+import catalog_snapshot
+import feed
+import movie_funcs
+import partitions
+import routing
+import shards
+import statements
+
+# Channel on-demand runs are requested on
+CHANNEL = "sigma_maintenance"
+
+STATUS_FILE = "maintenance_status.json"
+
+DEFAULT_JITTER = 0.1
+DEFAULT_CONCURRENCY = 2
+
+# Seconds a worker waits before connecting again after failing to
+RECONNECT_DELAY = 30
+
+# Jobs for tables every shard has its own rows of
+SHARDED_JOBS = {"partitions", "vacuum_analyze", "leaderboard_warmup", "feed_trim"}
+
+# Jobs rebuilding tables of shards.REPLICATED_TABLES on the directory, and those tables
+SYNCED_JOBS = {"similarity": ["movie_similar"]}
+
+# Tables that take the most inserts, updates and deletes
+HOT_TABLES = ["watched", "watched_user_movie_rollup", "rated", "following", "incollection", "moviecollection", "\"user\""]
+
+
+def run_partitions(conn, credentials: dict) -> str:
+    created, dropped = partitions.maintain(conn)
+    stray = partitions.default_rows(conn)
+    if stray > 0:
+        # shows up as a failure in the status until someone looks
+        raise RuntimeError("created %d, dropped %d partition(s), but %d event(s) in watched_default are outside every partition" % (len(created), len(dropped), stray))
+    return "created %d, dropped %d partition(s)" % (len(created), len(dropped))
+
+
+def run_vacuum_analyze(conn, credentials: dict) -> str:
+    # VACUUM can't run inside a transaction
+    conn.autocommit = True
+    try:
+        with conn.cursor() as curs:
+            for table in HOT_TABLES:
+                curs.execute("VACUUM (ANALYZE) {}".format(table))
+    finally:
+        conn.autocommit = False
+    return "vacuumed %d table(s)" % len(HOT_TABLES)
+
+
+def run_leaderboard_warmup(conn, credentials: dict) -> str:
+    with conn.cursor() as curs:
+        for name in [movie_funcs.TOP_20_LAST_90_DAYS, movie_funcs.TOP_5_RELEASES_OF_MONTH]:
+            statements.execute(curs, name)
+            curs.fetchall()
+    conn.commit()
+    return "warmed 2 leaderboard(s)"
+
+
+def run_similarity(conn, credentials: dict) -> str:
+    # numpy is only needed by this job
+    import similarity
+    return "stored %d neighbour(s)" % similarity.rebuild(conn)
+
+
+def run_catalog_snapshot(conn, credentials: dict) -> str:
+    if "catalog_snapshot" not in credentials:
+        return "no snapshot configured"
+    path = credentials["catalog_snapshot"]
+    if not os.path.exists(path):
+        return "exported %d movie(s)" % catalog_snapshot.export(conn, path)
+    return "refreshed %d movie(s)" % catalog_snapshot.refresh(conn, path)
+
+
+def run_feed_trim(conn, credentials: dict) -> str:
+    timeline_rows, activity_rows = feed.trim(conn)
+    return "trimmed %d timeline and %d activity row(s)" % (timeline_rows, activity_rows)
+
+
+# Job name: (function, default seconds between runs)
+JOBS = {
+    "partitions": (run_partitions, 24 * 60 * 60),
+    "vacuum_analyze": (run_vacuum_analyze, 6 * 60 * 60),
+    "leaderboard_warmup": (run_leaderboard_warmup, 10 * 60),
+    "similarity": (run_similarity, 24 * 60 * 60),
+    "catalog_snapshot": (run_catalog_snapshot, 60 * 60),
+    "feed_trim": (run_feed_trim, 60 * 60),
+}
+
+
+class Job():
+    def __init__(self, name: str, function, interval: float, jitter: float):
+        """
+        :param name: Name of the job.
+        :param function: Takes (connection to the primary, credentials), returns a short summary.
+        :param interval: Seconds between runs.
+        :param jitter: Fraction of the interval each wait may vary by.
+        """
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.jitter = jitter
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_seconds = None
+        self.last_started = None
+        self.last_result = None
+        self.next_run = time.time() + self.wait()
+
+    def wait(self) -> float:
+        """
+        Seconds until the next run, with jitter.
+        """
+        return self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def status(self) -> dict:
+        return {
+            "running": self.running,
+            "runs": self.runs,
+            "failures": self.failures,
+            "average_seconds": self.total_seconds / self.runs if self.runs > 0 else None,
+            "max_seconds": self.max_seconds,
+            "last_seconds": self.last_seconds,
+            "last_started": self.last_started,
+            "last_result": self.last_result,
+            "next_run": self.next_run,
+        }
+
+
+class Scheduler():
+    def __init__(self, credentials: dict):
+        """
+        :param credentials: The parsed credentials file, every worker connects with it.
+        """
+        self.credentials = credentials
+        jitter = float(credentials.get("maintenance_jitter", DEFAULT_JITTER))
+        intervals = credentials.get("maintenance_intervals", {})
+        self.jobs = {name: Job(name, function, float(intervals.get(name, interval)), jitter) for name, (function, interval) in JOBS.items()}
+        self.concurrency = int(credentials.get("maintenance_concurrency", DEFAULT_CONCURRENCY))
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.started = time.time()
+
+    def write_status(self) -> None:
+        """
+        Writes every job's metrics to the status file, replacing it in one
+        step so readers never see half of it.
+        """
+        with self.lock:
+            status = {"pid": os.getpid(), "started": self.started, "updated": time.time(),
+                      "jobs": {name: job.status() for name, job in self.jobs.items()}}
+        with open(STATUS_FILE + ".tmp", 'w') as sf:
+            json.dump(status, sf, indent=1)
+        os.replace(STATUS_FILE + ".tmp", STATUS_FILE)
+
+    def submit(self, job: Job) -> bool:
+        """
+        Queues a job unless it is already queued or running.
+
+        :return: Whether it was queued.
+        """
+        with self.lock:
+            if job.running:
+                return False
+            job.running = True
+        self.pending.put(job)
+        return True
+
+    def run_job(self, primaries: list, job: Job) -> None:
+        """
+        Runs a job and records how it went.
+
+        :param primaries: The primary of every shard, the directory first.
+        """
+        started = time.time()
+        with self.lock:
+            job.last_started = started
+        targets = primaries if job.name in SHARDED_JOBS else primaries[:1]
+        results = []
+        try:
+            for number, conn in enumerate(targets):
+                result = job.function(conn, self.credentials)
+                results.append(result if len(targets) == 1 else "shard %d: %s" % (number, result))
+            if job.name in SYNCED_JOBS and len(primaries) > 1:
+                changed = shards.sync_primaries(primaries, SYNCED_JOBS[job.name])
+                results.append("synced %d row(s) to %d shard(s)" % (sum(changed), len(changed)))
+            result = "; ".join(results)
+            failed = False
+        except Exception as e:
+            for conn in primaries:
+                # a lost connection can't be rolled back, the worker reconnects
+                if not conn.closed:
+                    conn.rollback()
+            result = "; ".join(results + ["%s: %s" % (type(e).__name__, e)])
+            failed = True
+        self.finish_job(job, started, result, failed)
+
+    def finish_job(self, job: Job, started: float, result: str, failed: bool) -> None:
+        """
+        Records a run of a job and schedules the next one.
+
+        :param job: The job, no longer running.
+        :param started: time.time() when the run started.
+        :param result: Its summary, or what went wrong.
+        :param failed: Whether the run failed.
+        """
+        seconds = time.time() - started
+        with self.lock:
+            job.running = False
+            job.runs += 1
+            job.failures += 1 if failed else 0
+            job.total_seconds += seconds
+            job.max_seconds = max(job.max_seconds, seconds)
+            job.last_seconds = seconds
+            job.last_result = result
+            job.next_run = time.time() + job.wait()
+        self.write_status()
+
+    def worker(self) -> None:
+        """
+        Runs queued jobs on its own connection until it gets None. A lost
+        connection is opened again. When it can't connect, the next job fails
+        with the error (instead of looking like it runs forever) and it tries
+        again after RECONNECT_DELAY.
+        """
+        import sigmadb
+
+        while True:
+            try:
+                with sigmadb.connect(self.credentials, quiet=True) as conn:
+                    primaries = routing.shard_primaries(conn)
+                    while not any(primary.closed for primary in primaries):
+                        job = self.pending.get()
+                        if job == None:
+                            return
+                        self.run_job(primaries, job)
+                continue
+            except Exception as e:
+                error = e
+
+            job = self.pending.get()
+            if job == None:
+                return
+            self.finish_job(job, time.time(), "couldn't connect, %s: %s" % (type(error).__name__, error), True)
+            time.sleep(RECONNECT_DELAY)
+
+    def run(self) -> None:
+        """
+        Schedules jobs until interrupted. Due jobs are queued for the
+        workers and on-demand requests arrive as notifications.
+        """
+        import sigmadb
+
+        workers = [threading.Thread(target=self.worker, daemon=True) for _ in range(self.concurrency)]
+        for thread in workers:
+            thread.start()
+
+        with sigmadb.connect(self.credentials) as conn:
+            listener = routing.primary_connection(conn)
+            listener.autocommit = True
+            with listener.cursor() as curs:
+                curs.execute("LISTEN " + CHANNEL)
+
+            self.write_status()
+            try:
+                while True:
+                    now = time.time()
+                    for job in self.jobs.values():
+                        if job.next_run <= now:
+                            self.submit(job)
+
+                    # sleep until the next job is due or a request comes in,
+                    # queued and running jobs are rescheduled once they finish
+                    with self.lock:
+                        due = [job.next_run for job in self.jobs.values() if not job.running]
+                    timeout = max(0.0, min(due, default=now + 60) - time.time())
+                    if select.select([listener], [], [], min(timeout, 60)) != ([], [], []):
+                        listener.poll()
+                        while listener.notifies:
+                            name = listener.notifies.pop(0).payload
+                            if name in self.jobs:
+                                self.submit(self.jobs[name])
+            finally:
+                for _ in workers:
+                    self.pending.put(None)
+
+
+def request_run(conn, name: str) -> None:
+    """
+    Asks a running daemon to run a job now.
+
+    :param conn: Connection to the primary.
+    :param name: Name of the job.
+    """
+    with conn.cursor() as curs:
+        curs.execute("SELECT pg_notify(%s, %s)", (CHANNEL, name))
+    conn.commit()
+
+
+def read_status() -> dict:
+    """
+    The daemon's last written status, None if it hasn't run here.
+    """
+    if not os.path.exists(STATUS_FILE):
+        return None
+    with open(STATUS_FILE, 'r') as sf:
+        return json.load(sf)
+
+
+def print_status() -> None:
+    """
+    Prints each job's metrics from the status file.
+    """
+    status = read_status()
+    if status == None:
+        print("The maintenance daemon hasn't run yet (python maintenance.py daemon)")
+        return
+
+    now = time.time()
+    print("Maintenance daemon (pid %s), last update %ds ago" % (status["pid"], now - status["updated"]))
+    for name, job in status["jobs"].items():
+        if job["running"]:
+            state = "running"
+        else:
+            state = "next in %ds" % max(0, job["next_run"] - now)
+        timing = ""
+        if job["runs"] > 0:
+            timing = ", last %.1fs, average %.1fs, max %.1fs" % (job["last_seconds"], job["average_seconds"], job["max_seconds"])
+        print("\t%s: %s, %d run(s), %d failure(s)%s" % (name, state, job["runs"], job["failures"], timing))
+        if job["last_result"] != None:
+            print("\t\t%s" % job["last_result"])
+
+
+def main() -> int:
+    """
+    Runs the daemon, shows its status or asks it to run a job.
+
+    :return: 0 on success
+    """
+    import sigmadb
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "status"
+    if command not in ["daemon", "status", "run"] or (command == "run" and (len(sys.argv) != 3 or sys.argv[2] not in JOBS)):
+        print(__doc__)
+        return 1
+
+    if command == "status":
+        print_status()
+        return 0
+
+    credentials = sigmadb.load_credentials()
+    if credentials == None:
+        return 1
+
+    if command == "run":
+        with sigmadb.connect(credentials) as conn:
+            request_run(routing.primary_connection(conn), sys.argv[2])
+        print("Asked the daemon to run %s" % sys.argv[2])
+        return 0
+
+    try:
+        Scheduler(credentials).run()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,289 @@
+#!/bin/python3
+
+"""
+Process-wide cache of movie facts.
+
+Browsing, watching, collections and recommendations all need the same
+facts about a movie (title, length, rating, release, genres, crew,
+directors, studios), and none of them change while someone is watching.
+The cache keeps them by movieid, one slotted Movie per movie, and evicts
+the least recently used once the entries add up to more than the budget
+("movie_cache_bytes" in credentials.json, 8 MiB by default). Browse
+results warm it as they stream past, and anything else missing is loaded
+in one query per call.
+
+Migration 5 adds triggers that NOTIFY sigma_movie_changed whenever a
+movie or one of its links changes (the movie's id as payload, or '*' when
+a genre, studio or crew member is renamed). The app LISTENs on its
+connection to the primary (see listen()) and drops the entries named
+before every lookup. Processes that don't listen keep entries until they
+are evicted.
+
+Rows read anywhere but the listening connection (a replica, or a shard's
+copy of the catalog) may be from before a change the primary has already
+announced. A movie invalidated less than replica_window seconds ago (the
+staleness a replica is allowed plus how long its lag is trusted, see
+routing.Router) is only cached again from the primary.
+"""
+
+import collections
+import sys
+import threading
+import time
+
+import psycopg2.extensions
+
+import routing
+import search
+
+# Channel the invalidation triggers notify on
+CHANNEL = "sigma_movie_changed"
+
+# Payload meaning every cached movie may be stale
+ALL_MOVIES = "*"
+
+DEFAULT_BUDGET = 8 * 1024 * 1024
+
+MOVIES_QUERY = "SELECT" + search.MOVIE_COLUMNS + "FROM \"movie\" AS m WHERE m.movieid = ANY(%s)"
+
+# Triggers on the tables movies are built from (see migration 5)
+CREATE_INVALIDATION_TRIGGERS = [
+    """
+    CREATE OR REPLACE FUNCTION movie_changed_notify() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            PERFORM pg_notify('""" + CHANNEL + """', OLD.movieid::text);
+        ELSE
+            PERFORM pg_notify('""" + CHANNEL + """', NEW.movieid::text);
+        END IF;
+        IF TG_OP = 'UPDATE' AND OLD.movieid != NEW.movieid THEN
+            PERFORM pg_notify('""" + CHANNEL + """', OLD.movieid::text);
+        END IF;
+        RETURN NULL;
+    END
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION movie_names_changed_notify() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM pg_notify('""" + CHANNEL + """', '""" + ALL_MOVIES + """');
+        RETURN NULL;
+    END
+    $$
+    """,
+] + [
+    """
+    CREATE TRIGGER {}_movie_changed
+    AFTER INSERT OR UPDATE OR DELETE ON {}
+    FOR EACH ROW EXECUTE FUNCTION movie_changed_notify()
+    """.format(table, table) for table in ["movie", "movierelease", "moviegenre", "actsin", "directed", "produced"]
+] + [
+    # a rename touches every movie linked to it, which would be one notification each
+    """
+    CREATE TRIGGER {}_movie_names_changed
+    AFTER UPDATE OR DELETE ON {}
+    FOR EACH STATEMENT EXECUTE FUNCTION movie_names_changed_notify()
+    """.format(table, table) for table in ["genre", "studio", "crewmember"]
+]
+
+
+class Movie():
+    __slots__ = ("movieid", "title", "length", "mpaarating", "first_release", "genres", "crew", "directors", "studios", "size")
+
+    def __init__(self, movieid: int, title: str, length: int, mpaarating: str, first_release, genres: str, crew: str, directors: str, studios: str):
+        """
+        The columns of search.MOVIE_COLUMNS, in order.
+        """
+        self.movieid = movieid
+        self.title = title
+        self.length = length
+        self.mpaarating = mpaarating
+        self.first_release = first_release
+        self.genres = genres
+        self.crew = crew
+        self.directors = directors
+        self.studios = studios
+        # roughly what the entry keeps alive
+        self.size = sys.getsizeof(self) + sum(sys.getsizeof(getattr(self, name)) for name in Movie.__slots__[1:-1])
+
+    def columns(self) -> tuple:
+        """
+        The movie as a row of search.MOVIE_COLUMNS.
+        """
+        return (self.movieid, self.title, self.length, self.mpaarating, self.first_release, self.genres, self.crew, self.directors, self.studios)
+
+
+class MovieCache():
+    def __init__(self, budget: int = DEFAULT_BUDGET):
+        """
+        :param budget: Bytes the entries may add up to before the least recently used are evicted.
+        """
+        self.budget = budget
+        self.movies = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # how long a replica may still show a movie from before its invalidation
+        self.replica_window = routing.DEFAULT_MAX_STALENESS + routing.DEFAULT_CHECK_INTERVAL
+        # movieid: time.monotonic() of its last invalidation, within replica_window
+        self.invalidated = {}
+        self.cleared_at = None
+
+    def lookup(self, movie_ids) -> dict:
+        """
+        The cached movies among some ids, marking them recently used.
+
+        :return: Movie by movieid, ids not cached are left out.
+        """
+        found = {}
+        with self.lock:
+            for movie_id in movie_ids:
+                movie = self.movies.get(movie_id)
+                if movie != None:
+                    self.movies.move_to_end(movie_id)
+                    found[movie_id] = movie
+            self.hits += len(found)
+            self.misses += len(set(movie_ids)) - len(found)
+        return found
+
+    def _recently_invalidated(self, movie_id: int) -> bool:
+        since = time.monotonic() - self.replica_window
+        changed = self.invalidated.get(movie_id)
+        return (changed != None and changed > since) or (self.cleared_at != None and self.cleared_at > since)
+
+    def put(self, movie: Movie, primary: bool = True) -> None:
+        """
+        Adds or replaces a movie, evicting the least recently used entries
+        to stay within budget.
+
+        :param primary: Whether the movie was read from the primary. Other
+                        rows are dropped if the movie changed within replica_window.
+        """
+        with self.lock:
+            if not primary and self._recently_invalidated(movie.movieid):
+                return
+            old = self.movies.pop(movie.movieid, None)
+            if old != None:
+                self.size -= old.size
+            self.movies[movie.movieid] = movie
+            self.size += movie.size
+            while self.size > self.budget and len(self.movies) > 1:
+                self.size -= self.movies.popitem(last=False)[1].size
+
+    def invalidate(self, movie_id: int) -> None:
+        with self.lock:
+            old = self.movies.pop(movie_id, None)
+            if old != None:
+                self.size -= old.size
+            now = time.monotonic()
+            # only the ones still inside the window matter
+            for expired in [key for key, changed in self.invalidated.items() if changed <= now - self.replica_window]:
+                del self.invalidated[expired]
+            self.invalidated[movie_id] = now
+
+    def clear(self) -> None:
+        with self.lock:
+            self.movies.clear()
+            self.size = 0
+            self.invalidated.clear()
+            self.cleared_at = time.monotonic()
+
+
+# Shared by every connection and thread in the process
+cache = MovieCache()
+
+# Connection to the primary LISTENing on CHANNEL, None if nothing listens
+_listener = None
+
+
+def listen(conn, credentials: dict) -> None:
+    """
+    Sets the cache's budget and starts listening for changed movies.
+
+    :param conn: A connection or Router, in autocommit (see transactions.interactive).
+    :param credentials: The parsed credentials file, may set "movie_cache_bytes".
+    """
+    global _listener
+
+    cache.budget = int(credentials.get("movie_cache_bytes", DEFAULT_BUDGET))
+    cache.replica_window = float(credentials.get("max_staleness", routing.DEFAULT_MAX_STALENESS)) + routing.DEFAULT_CHECK_INTERVAL
+    # standbys can't LISTEN, changes are only heard about on the primary
+    primary = routing.primary_connection(conn)
+    with primary.cursor() as curs:
+        curs.execute("LISTEN " + CHANNEL)
+    _listener = primary
+    # anything cached before now was never covered by invalidation
+    cache.clear()
+
+
+def sync() -> None:
+    """
+    Drops the movies the listening connection has been told changed.
+    """
+    listener = _listener
+    if listener == None:
+        return
+    # reading the socket mid-transaction would upset the transaction's own results
+    if listener.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        listener.poll()
+    while listener.notifies:
+        notify = listener.notifies.pop(0)
+        if notify.channel != CHANNEL:
+            continue
+        if notify.payload == ALL_MOVIES:
+            cache.clear()
+        else:
+            cache.invalidate(int(notify.payload))
+
+
+def is_primary(conn) -> bool:
+    """
+    Whether rows read on a connection are as new as the invalidations heard,
+    i.e. it is the listening connection or nothing listens.
+    """
+    return _listener == None or conn is _listener
+
+
+def warm(rows, conn=None) -> None:
+    """
+    Caches movies from rows that start with the columns of
+    search.MOVIE_COLUMNS, e.g. browse results.
+
+    :param conn: The connection the rows were read on, None for the primary.
+    """
+    primary = conn == None or is_primary(conn)
+    for row in rows:
+        cache.put(Movie(*row[:len(Movie.__slots__) - 1]), primary)
+
+
+def get_many(conn, movie_ids) -> dict:
+    """
+    The facts about some movies, loading the ones not cached in one query.
+
+    :param conn: Connection to the database, used only for the misses.
+    :param movie_ids: The movies wanted.
+    :return: Movie by movieid, movies that don't exist are left out.
+    """
+    sync()
+    movie_ids = list(movie_ids)
+    found = cache.lookup(movie_ids)
+    missing = [movie_id for movie_id in set(movie_ids) if movie_id not in found]
+    if len(missing) > 0:
+        primary = is_primary(conn)
+        with conn.cursor() as curs:
+            curs.execute(MOVIES_QUERY, (missing,))
+            for row in curs.fetchall():
+                movie = Movie(*row)
+                cache.put(movie, primary)
+                found[movie.movieid] = movie
+    return found
+
+
+def get(conn, movie_id: int) -> Movie:
+    """
+    The facts about one movie, None if it doesn't exist.
+    """
+    return get_many(conn, [movie_id]).get(movie_id)
@@ -4,10 +4,20 @@
 Functions to help with movies
 """
 
+import collections
 import datetime
 from enum import IntEnum
 
+import feed
 import input_utils
+import movie_cache
+import prefetch
+import routing
+import search
+import statements
+import streaming
+import transactions
+import viewer_sketches
 
 class SortOrder(IntEnum):
     ASCENDING = 0
@@ -45,207 +55,479 @@ class SortParameter():
         return ""
 
 
-def browse_movies(conn) -> int:
+def default_sort_parameters() -> list[SortParameter]:
     """
-    Browses the list of movies and optionally gives the user the opportunity
-    to select a movie to rate/view it.
+    The sort options offered when browsing movies, in priority order.
+    """
+    return [SortParameter("title", "title", SortOrder.ASCENDING),\
+            SortParameter("release", "first_release", SortOrder.ASCENDING),\
+            SortParameter("studios", "studios", SortOrder.NONE),\
+            SortParameter("genres", "genres", SortOrder.NONE)]
 
-    Rating and viewing are not handled in this method.
 
-    :param conn: Connection to database.
-    :return: The movie id the user wants to view or -1 if they exited.
+MOVIE_FORMAT_RATING = "%s - Title: '%s', Runtime (min): %s, MPAA Rating: %s, Release Date: %s, Genres: %s, Crew Member(s): '%s', Director(s): '%s', Studios(s): '%s', Average User Rating: %.1f"
+MOVIE_FORMAT_NORATING = "%s - Title: '%s', Runtime (min): %s, MPAA Rating: %s, Release Date: %s, Genres: %s, Crew Member(s): '%s', Director(s): '%s', Studios(s): '%s', Average User Rating: N/A"
+MOVIE_FORMAT_VIEWERS = ", Unique Viewers: ~%d"
+
+def print_movie(index: int, result: tuple) -> None:
     """
+    Prints one movie from a browse result.
 
-    print("What would you like to search by?")
+    :param index: The number the user selects the movie by.
+    :param result: (movieid, title, length, mpaarating, first_release, genres, crew, directors, studios, avg_rating),
+                   optionally followed by the approximate unique viewers
+    """
+    viewers = ""
+    if len(result) > 10:
+        viewers = MOVIE_FORMAT_VIEWERS % round(result[10] or 0)
+        result = result[:10]
+    if result[-1] != None:
+        print(MOVIE_FORMAT_RATING % ((index,) + tuple(result[1:])) + viewers)
+    else:
+        print(MOVIE_FORMAT_NORATING % ((index,) + tuple(result[1:-1])) + viewers)
+
+
+# Hot queries, prepared once per connection (see statements.py)
+RATE_SELECT = statements.register("rate_select", "SELECT rating FROM rated WHERE userid = %s AND movieid = %s")
+RATE_UPDATE = statements.register("rate_update", "UPDATE rated SET rating = %s WHERE userid = %s AND movieid = %s")
+RATE_INSERT = statements.register("rate_insert", "INSERT INTO rated (userid, movieid, rating) VALUES (%s, %s, %s)")
+
+WATCH_INSERT = statements.register("watch_insert", "INSERT INTO watched (userid, movieid, dateTime, watchDuration) VALUES (%s, %s, %s, %s)")
+
+# Rankings return movie ids, the titles come from movie_cache. They rank
+# by unique viewers, so one person re-watching a movie doesn't lift it
+# (approximate, from the sketches in viewer_sketches.py). The *_VIEWERS
+# queries count every movie, they are what each shard returns when the
+# leaderboards are gathered (see ranking()). The sketch leaderboards gather
+# the bits set in every movie's sketch (*_BITS) and then the sketches of
+# the movies that can make the top (*_SKETCHES, see sketch_ranking()).
+TOP_20_LAST_90_DAYS = statements.register("top_20_last_90_days", """
+    SELECT v.movieid, v.viewers
+    FROM movie_unique_viewers((CURRENT_DATE - INTERVAL '90 days')::date, CURRENT_DATE) AS v
+    ORDER BY v.viewers DESC, v.movieid
+    LIMIT 20
+    """)
 
-    search_type = input_utils.get_input_matching("1 - Title\n2 - Release Date\n3 - Cast Member\n4 - Studio Name\n5 - Genre\n> ", regex="[12345]")
+LAST_90_DAYS_BITS = """
+    SELECT v.movieid, bit_count(bit_or(v.registers))::integer
+    FROM watched_movie_viewers_daily AS v
+    WHERE v.day BETWEEN (CURRENT_DATE - INTERVAL '90 days')::date AND CURRENT_DATE
+    GROUP BY v.movieid
+    """
 
-    with conn.cursor() as curs:
-        # This query concatenates genres together, but it only lists the earlieast release date
-        query = """
+LAST_90_DAYS_SKETCHES = """
+    SELECT v.movieid, bit_or(v.registers)
+    FROM watched_movie_viewers_daily AS v
+    WHERE v.day BETWEEN (CURRENT_DATE - INTERVAL '90 days')::date AND CURRENT_DATE
+    AND v.movieid = ANY(%s)
+    GROUP BY v.movieid
+    """
+
+# The rollups are bounded by distinct (user, movie) pairs rather than views
+# and cover all time, including watch events past retention. One row per
+# pair makes the count of followers who watched exact.
+FOLLOWER_VIEWERS = """
+    SELECT rollup.movieid, COUNT(*) AS viewers
+    FROM watched_user_movie_rollup AS rollup
+    JOIN following ON rollup.userid = following.followerid
+    WHERE following.followingid = %s
+    GROUP BY rollup.movieid
+    """
+
+TOP_20_AMONG_FOLLOWERS = statements.register("top_20_among_followers", FOLLOWER_VIEWERS + """
+    ORDER BY viewers DESC, rollup.movieid
+    LIMIT 20
+    """)
+
+RELEASES_OF_MONTH = """
+    WHERE v.movieid IN
+    (
+        SELECT movierelease.movieid
+        FROM movierelease
+        WHERE movierelease.releasedate >= date_trunc('month', CURRENT_DATE)
+        AND movierelease.releasedate < date_trunc('month', CURRENT_DATE) + INTERVAL '1 month'
+    )
+    """
+
+TOP_5_RELEASES_OF_MONTH = statements.register("top_5_releases_of_month", """
+    SELECT v.movieid, hll_estimate(v.registers) AS viewers
+    FROM watched_movie_viewers AS v
+    """ + RELEASES_OF_MONTH + """
+    ORDER BY viewers DESC, v.movieid
+    LIMIT 5
+    """)
+
+RELEASES_OF_MONTH_BITS = """
+    SELECT v.movieid, bit_count(v.registers)::integer
+    FROM watched_movie_viewers AS v
+    """ + RELEASES_OF_MONTH
+
+# some movies' sketches over all time, also for browsing with shards
+ALL_TIME_SKETCHES = """
+    SELECT v.movieid, v.registers
+    FROM watched_movie_viewers AS v
+    WHERE v.movieid = ANY(%s)
+    """
+
+# Recommendation algorithm:
+# Get all movies I watched
+# Get all the users that watched those movies
+# Get movies that they watched (that I haven't)
+# Get top ten movies by rating from that
+FOR_YOU = statements.register("for_you", """
+    SELECT m.movieid,
+    (
         SELECT
-            movieid, title, length, mpaarating,
-            (
-                SELECT
-                    MIN(releasedate)
-                FROM
-                    "movierelease"
-                WHERE
-                    movierelease.movieid = m.movieid
-            ) AS first_release,
-            (
-                SELECT
-                    STRING_AGG(g.genrename, ', ' ORDER BY g.genrename)
-                FROM
-                    "genre" AS g
-                WHERE
-                    g.genreid IN
-                    (
-                        SELECT genreid FROM "moviegenre" WHERE moviegenre.movieid = m.movieid
-                    )
-            ) as genres,
-            (
-                SELECT
-                    STRING_AGG(CONCAT(c.firstname, ' ', c.lastname), ', ' ORDER BY CONCAT(c.firstname, ' ', c.lastname))
-                FROM
-                    "crewmember" AS c
-                WHERE
-                    c.crewid IN
-                    (
-                        SELECT crewid FROM "actsin" WHERE actsin.movieid = m.movieid
-                    )
-            ) AS crew,
-            (
-                SELECT
-                    STRING_AGG(CONCAT(c.firstname, ' ', c.lastname), ', ' ORDER BY CONCAT(c.firstname, ' ', c.lastname))
-                FROM
-                    "crewmember" AS c
-                WHERE
-                    c.crewid IN
-                    (
-                        SELECT crewid FROM "directed" WHERE directed.movieid = m.movieid
-                    )
-            ) AS directors,
-            (
-                SELECT
-                    STRING_AGG(s.name, ', ' ORDER BY s.name)
-                FROM
-                    "studio" AS s
-                WHERE
-                    s.studioid IN
-                    (
-                        SELECT studioid FROM "produced" WHERE produced.movieid = m.movieid
-                    )
-            ) AS studios,
+            AVG(rating)
+        FROM
+            "rated"
+        WHERE
+            rated.movieid = m.movieid
+    ) AS avg_rating
+    FROM movie AS m
+    WHERE m.movieid IN
+    (
+        SELECT theywatched.movieid
+        FROM watched_user_movie_rollup AS theywatched
+        WHERE theywatched.userid IN
+        (
+            SELECT wewatched.userid
+            FROM watched_user_movie_rollup AS wewatched
+            WHERE wewatched.movieid IN
             (
-                SELECT
-                    AVG(rating)
-                FROM
-                    "rated"
-                WHERE
-                    rated.movieid = m.movieid
-            ) AS avg_rating
-        FROM "movie" AS m
-        """
-        args = []
+                SELECT iwatched.movieid
+                FROM watched_user_movie_rollup AS iwatched
+                WHERE iwatched.userid = %s
+            )
+            AND wewatched.userid != %s
+        )
+        EXCEPT
+        SELECT iwatched.movieid
+        FROM watched_user_movie_rollup AS iwatched
+        WHERE iwatched.userid = %s
+    )
+    ORDER BY avg_rating DESC
+    LIMIT 20
+    """)
+
+# Content-based neighbours precomputed by similarity.py
+MORE_LIKE_THIS = statements.register("more_like_this", """
+    SELECT movie_similar.similarid, movie_similar.score
+    FROM movie_similar
+    WHERE movie_similar.movieid = %s
+    ORDER BY movie_similar.rank
+    """)
+
+# For users whose co-viewers turned up nothing: the neighbours of what they
+# watched or rated well, closest overall first
+SIMILAR_TO_HISTORY = statements.register("similar_to_history", """
+    SELECT movie_similar.similarid
+    FROM movie_similar
+    WHERE movie_similar.movieid IN
+    (
+        SELECT movieid FROM watched_user_movie_rollup WHERE userid = %s
+        UNION
+        SELECT movieid FROM rated WHERE userid = %s AND rating >= 3
+    )
+    AND movie_similar.similarid NOT IN (SELECT movieid FROM watched_user_movie_rollup WHERE userid = %s)
+    GROUP BY movie_similar.similarid
+    ORDER BY SUM(movie_similar.score) DESC
+    LIMIT 20
+    """)
+
+
+WATCHED_QUERY = "SELECT movieid FROM watched_user_movie_rollup WHERE userid = %s"
+
+def fetch_watched(conn, user_id) -> set[int]:
+    """
+    The ids of every movie a user has watched.
+    """
+    with conn.cursor() as curs:
+        curs.execute(WATCHED_QUERY, (user_id,))
+        return set(movieid for (movieid,) in curs.fetchall())
+
+
+def fetch_recommended(conn, user_id) -> list[int]:
+    """
+    The ids of the movies recommended for a user: what their co-viewers
+    rate best, else the neighbours of their history, else what's popular.
+    """
+    with conn.cursor() as curs:
+        statements.execute(curs, FOR_YOU, (user_id, user_id, user_id))
+        results = curs.fetchall()
+
+        if results == None or len(results) == 0:
+            statements.execute(curs, SIMILAR_TO_HISTORY, (user_id, user_id, user_id))
+            results = curs.fetchall()
+
+        if results == None or len(results) == 0:
+            statements.execute(curs, TOP_20_LAST_90_DAYS)
+            results = curs.fetchall()
+
+    return [result[0] for result in results]
+
+
+# Loaded right after login (see prefetch.py)
+WATCHED = prefetch.register("watched", fetch_watched)
+FOR_YOU_IDS = prefetch.register("for_you", fetch_recommended)
+
+
+def ranking(conn, statement: str, shard_query: str, args: tuple, limit: int) -> list[tuple]:
+    """
+    A leaderboard of (movieid, viewers), most viewers first.
+
+    With shards every shard's counts are added up. A user lives on one
+    shard, so the sums are exact for the rollups. A shard's own top list
+    can miss movies that are only near the top overall, so each returns
+    every movie.
+
+    :param conn: Connection or ShardRouter.
+    :param statement: Registered statement giving the leaderboard from one database.
+    :param shard_query: The same counts for every movie, without ORDER BY or LIMIT.
+    :param args: Arguments of both.
+    :param limit: Rows in the leaderboard.
+    """
+    if isinstance(conn, routing.ShardRouter):
+        viewers = collections.Counter()
+        for movie_id, count in routing.gather(conn, shard_query, args):
+            viewers[movie_id] += count
+        return sorted(viewers.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+    with conn.cursor() as curs:
+        statements.execute(curs, statement, args)
+        results = curs.fetchall()
+    conn.commit()
+    return results
+
+
+def sketch_ranking(conn, statement: str, bits_query: str, sketch_query: str, args: tuple, limit: int) -> list[tuple]:
+    """
+    ranking() for the unique viewers leaderboards. A moved user's viewers
+    stay in their old shard's sketches too, so adding up the shards'
+    estimates would count them twice. The shards' sketches are ORed
+    together instead, which counts every viewer once.
+
+    Only movies that can make the top are merged: a merged sketch has at
+    least as many bits set as its largest part and at most as many as all of
+    them, and the estimate grows with the bits.
+
+    :param conn: Connection or ShardRouter.
+    :param statement: Registered statement giving the leaderboard from one database.
+    :param bits_query: (movieid, bits set) for every movie on one shard.
+    :param sketch_query: (movieid, registers) on one shard, the movie ids are its last argument.
+    :param args: Arguments of all three, but for the movie ids.
+    :param limit: Rows in the leaderboard.
+    """
+    if not isinstance(conn, routing.ShardRouter):
+        return ranking(conn, statement, bits_query, args, limit)
+
+    most = collections.Counter()
+    least = collections.Counter()
+    for movie_id, bits in routing.gather(conn, bits_query, args):
+        most[movie_id] += bits
+        least[movie_id] = max(least[movie_id], bits)
+    if len(least) == 0:
+        return []
+    cutoff = sorted(least.values(), reverse=True)[min(limit, len(least)) - 1]
+    candidates = [movie_id for movie_id, bits in most.items() if bits >= cutoff]
+
+    sketches = viewer_sketches.merge(routing.gather(conn, sketch_query, args + (candidates,)))
+    viewers = viewer_sketches.estimates(routing.connection_for(conn), sketches)
+    return sorted(viewers.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+
+def titles(conn, movie_ids: list[int]) -> list[str]:
+    """
+    The titles of some movies, in the same order, from movie_cache.
+
+    :param conn: Connection to the database, used only for movies not cached.
+    :param movie_ids: The movies.
+    """
+    movies = movie_cache.get_many(conn, movie_ids)
+    return [movies[movie_id].title if movie_id in movies else "(removed)" for movie_id in movie_ids]
+
+
+def get_date(label: str) -> datetime.date:
+    """
+    Asks for a date one part at a time.
+
+    :param label: Put in front of each prompt, e.g. 'From '.
+    """
+    year = input_utils.get_input_matching(label + "Year: ", regex="^\d+$")
+    month = input_utils.get_input_matching(label + "Month (1-12): ", regex="^(0?[1-9]|1[0-2])$")
+    day = input_utils.get_input_matching(label + "Day (1-31): ", regex="^(0?[1-9]|[12][0-9]|3[01])$")
+    return datetime.date(int(year), int(month), int(day))
+
+
+# With shards, what each shard adds to the browse results' average rating
+# (BROWSE_COLUMNS only counts one database's users), the unique viewers
+# come from ALL_TIME_SKETCHES
+BROWSE_SHARD_RATINGS = """
+    SELECT r.movieid, SUM(r.rating), COUNT(*)
+    FROM rated AS r
+    WHERE r.movieid = ANY(%s)
+    GROUP BY r.movieid
+    """
+
+
+def gather_browse_columns(conn, results: list[tuple]) -> list[tuple]:
+    """
+    Replaces the average rating and unique viewers of browse results with
+    every shard's. A user lives on one shard, so the ratings add up like in
+    ranking(), and the sketches are merged like in sketch_ranking().
+
+    :param conn: ShardRouter.
+    :param results: Rows of search.BROWSE_COLUMNS.
+    :return: The rows with avg_rating and unique_viewers over all shards.
+    """
+    movie_ids = [result[0] for result in results]
+    ratings = collections.Counter()
+    counts = collections.Counter()
+    for movie_id, total, count in routing.gather(conn, BROWSE_SHARD_RATINGS, (movie_ids,)):
+        ratings[movie_id] += total
+        counts[movie_id] += count
+    sketches = viewer_sketches.merge(routing.gather(conn, ALL_TIME_SKETCHES, (movie_ids,)))
+    viewers = viewer_sketches.estimates(routing.connection_for(conn), sketches)
+
+    return [tuple(result[:9]) + (ratings[result[0]] / counts[result[0]] if counts[result[0]] > 0 else None, viewers.get(result[0], 0))
+            for result in results]
+
+
+def ask_search() -> search.MovieSearch:
+    """
+    Asks for things to search movies by until the user searches, every one
+    of them must match.
+
+    :return: The search.
+    """
+    movie_search = search.MovieSearch()
+    filters = []
+    while True:
+        if len(filters) > 0:
+            print("\nSearching for movies matching: " + ", ".join(filters))
+        print("Add something to search by, or search now:")
+        search_type = input_utils.get_input_matching("1 - Title\n2 - Release Date\n3 - Cast Member\n4 - Studio Name\n5 - Genre(s)\n6 - Release Date Range\n7 - Release Year\n8 - Director\n9 - MPAA Rating(s)\nl - Runtime Range\nr - Minimum Average Rating\ns - Search\n> ", regex="^[123456789lrs]$")
+
         match search_type:
             case "1":
-                query += "WHERE LOWER(m.title) LIKE LOWER(%s)"
-                args.append("%{}%".format(input_utils.get_input_matching("Movie Name: ")))
+                text = input_utils.get_input_matching("Movie Name: ")
+                movie_search.title(text)
+                filters.append("title '%s'" % text)
             case "2":
-                year = input_utils.get_input_matching("Year: ", regex="^\d+$")
-                month = input_utils.get_input_matching("Month (1-12): ", regex="^(0?[1-9]|1[0-2])$")
-                day = input_utils.get_input_matching("Day (1-31): ", regex="^(0?[1-9]|[12][0-9]|3[01])$")
-                query += """
-                    WHERE m.movieid IN
-                    (
-                        SELECT
-                            mr.movieid
-                        FROM
-                            "movierelease" AS mr
-                        WHERE
-                            mr.releasedate = %s
-                    )
-                """
-                args.append(datetime.date(int(year), int(month), int(day)))
+                date = get_date("")
+                movie_search.released_between(date, date)
+                filters.append("released %s" % date)
             case "3":
-                query += """
-                    WHERE m.movieid IN
-                    (
-                        SELECT
-                            a.movieid
-                        FROM
-                            "actsin" AS a
-                        LEFT JOIN
-                            "crewmember" AS c ON (a.crewid = c.crewid)
-                        WHERE
-                            LOWER(c.firstname) LIKE LOWER(%s) AND LOWER(c.lastname) LIKE LOWER(%s)
-                    )
-                """
-                args.append("%{}%".format(input_utils.get_input_matching("Cast Member's First Name: ")))
-                args.append("%{}%".format(input_utils.get_input_matching("Cast Member's Last Name: ")))
+                first_name = input_utils.get_input_matching("Cast Member's First Name: ")
+                last_name = input_utils.get_input_matching("Cast Member's Last Name: ")
+                movie_search.cast(first_name, last_name)
+                filters.append("cast '%s %s'" % (first_name, last_name))
             case "4":
-                query += """
-                    WHERE m.movieid IN
-                    (
-                        SELECT
-                            p.movieid
-                        FROM
-                            "produced" AS p
-                        LEFT JOIN
-                            "studio" AS s ON (p.studioid = s.studioid)
-                        WHERE
-                            LOWER(s.name) LIKE LOWER(%s)
-                    )
-                """
-                args.append("%{}%".format(input_utils.get_input_matching("Studio Name: ")))
+                name = input_utils.get_input_matching("Studio Name: ")
+                movie_search.studio(name)
+                filters.append("studio '%s'" % name)
             case "5":
-                query += """
-                    WHERE m.movieid IN
-                    (
-                        SELECT
-                            mg.movieid
-                        FROM
-                            "moviegenre" AS mg
-                        LEFT JOIN
-                            "genre" AS g ON (mg.genreid = g.genreid)
-                        WHERE
-                            LOWER(g.genrename) LIKE LOWER(%s)
-                    )
-                """
-                args.append("%{}%".format(input_utils.get_input_matching("Genre: ")))
-
-        output_format_rating = "%s - Title: '%s', Runtime (min): %s, MPAA Rating: %s, Release Date: %s, Genres: %s, Crew Member(s): '%s', Director(s): '%s', Studios(s): '%s', Average User Rating: %.1f"
-        output_format_norating = "%s - Title: '%s', Runtime (min): %s, MPAA Rating: %s, Release Date: %s, Genres: %s, Crew Member(s): '%s', Director(s): '%s', Studios(s): '%s', Average User Rating: N/A"
-
-        sort_parameters = [SortParameter("title", "title", SortOrder.ASCENDING),\
-                    SortParameter("release", "first_release", SortOrder.ASCENDING),\
-                    SortParameter("studios", "studios", SortOrder.NONE),\
-                    SortParameter("genres", "genres", SortOrder.NONE)]
+                names = [name.strip() for name in input_utils.get_input_matching("Genre(s), separated by commas: ").split(",") if name.strip() != ""]
+                movie_search.genres(names)
+                filters.append("genre %s" % " or ".join("'%s'" % name for name in names))
+            case "6":
+                first = get_date("From ")
+                last = get_date("To ")
+                movie_search.released_between(first, last)
+                filters.append("released %s to %s" % (first, last))
+            case "7":
+                year = int(input_utils.get_input_matching("Year: ", regex="^\d+$"))
+                movie_search.year(year)
+                filters.append("released in %d" % year)
+            case "8":
+                first_name = input_utils.get_input_matching("Director's First Name: ")
+                last_name = input_utils.get_input_matching("Director's Last Name: ")
+                movie_search.director(first_name, last_name)
+                filters.append("director '%s %s'" % (first_name, last_name))
+            case "9":
+                ratings = [rating.strip() for rating in input_utils.get_input_matching("MPAA Rating(s), separated by commas: ").split(",") if rating.strip() != ""]
+                movie_search.mpaa(ratings)
+                filters.append("rated %s" % " or ".join(ratings))
+            case "l":
+                shortest = int(input_utils.get_input_matching("Shortest (min): ", regex="^\d+$"))
+                longest = int(input_utils.get_input_matching("Longest (min): ", regex="^\d+$"))
+                movie_search.runtime(shortest, longest)
+                filters.append("%d to %d min" % (shortest, longest))
+            case "r":
+                rating = int(input_utils.get_input_matching("Minimum average rating (0-5): ", regex="^[0-5]$"))
+                movie_search.min_rating(rating)
+                filters.append("average rating %d+" % rating)
+            case "s":
+                return movie_search
+
+
+@routing.scatter
+def browse_movies(conn) -> int:
+    """
+    Browses the list of movies and optionally gives the user the opportunity
+    to select a movie to rate/view it.
+
+    Rating and viewing are not handled in this method.
+
+    :param conn: Connection to database, or ShardRouter.
+    :return: The movie id the user wants to view or -1 if they exited.
+    """
+
+    movie_search = ask_search()
+    sort_parameters = default_sort_parameters()
+    # the catalog is searched on the directory
+    directory = routing.connection_for(conn)
+
+    skip_query = False
+    while True:
+        if not skip_query:
+            # filtering, sorting and the limit all happen before the display columns are computed
+            query, args = movie_search.compile([param.query_text() for param in sort_parameters if param.query_text() != ""])
+
+            # rows are printed as they stream in, only the ids are kept for selection
+            results = streaming.stream_rows(directory, query, args)
+            if isinstance(conn, routing.ShardRouter):
+                results = list(results)
+                directory.commit()
+                results = gather_browse_columns(conn, results)
+            movie_ids = []
+            for result in results:
+                print_movie(len(movie_ids), result)
+                movie_ids.append(result[0])
+                # the rows carry everything movie_cache keeps
+                movie_cache.warm([result], directory)
+            directory.commit()
 
         skip_query = False
-        while True:
-            sort_params_string = ", ".join([param.query_text() for param in sort_parameters if param.query_text() != ""])
-            display_sorting = ""
-            if sort_params_string != "":
-                display_sorting = " ORDER BY " + sort_params_string
-
-            if not skip_query:
-                curs.execute(query + display_sorting, args)
-                results = curs.fetchall()
-
-                for i in range(0, len(results)):
-                    result = results[i]
-                    if result[-1] != None:
-                        print(output_format_rating % ((i,) + result[1:]))
-                    else:
-                        print(output_format_norating %  ((i,) + result[1:-1]))
-
-            skip_query = False
-
-            print("\nFound %s result(s)" % len(results))
-            input_text = "\nSorted by " + ", ".join([order.display_text() for order in sort_parameters]) + "\nSelect a movie by its number, 'e' to go back to the menu, or enter of the sort options above\n> "
-            user_input = input_utils.get_input_matching(input_text, regex='^(?:\d+|[etrsg])$')
-
-            if user_input.isdigit():
-                selected_film = int(user_input)
-                if selected_film >= len(results):
-                    print("Movie not in list!")
-                    skip_query = True
-                else:
-                    # user input is not the actual movie id, need to convert here
-                    return results[selected_film][0]
-
-            elif user_input == 'e':
-                return -1
+
+        print("\nFound %s result(s)" % len(movie_ids))
+        if len(movie_ids) == movie_search.limit:
+            print("Only the first %s are shown, add more to search by to narrow it down" % movie_search.limit)
+        if isinstance(conn, routing.ShardRouter) and any(name == "min_rating" for name, _ in movie_search.criteria):
+            print("The minimum rating filter only counted ratings kept on the main database")
+        input_text = "\nSorted by " + ", ".join([order.display_text() for order in sort_parameters]) + "\nSelect a movie by its number, 'e' to go back to the menu, or enter of the sort options above\n> "
+        user_input = input_utils.get_input_matching(input_text, regex='^(?:\d+|[etrsg])$')
+
+        if user_input.isdigit():
+            selected_film = int(user_input)
+            if selected_film >= len(movie_ids):
+                print("Movie not in list!")
+                skip_query = True
             else:
-                for sort_param in sort_parameters:
-                    if sort_param.name[0] == user_input:
-                        sort_param.order += 1
-                        # wrap around sort orders
-                        sort_param.order %= 3
+                # user input is not the actual movie id, need to convert here
+                return movie_ids[selected_film]
 
+        elif user_input == 'e':
+            return -1
+        else:
+            for sort_param in sort_parameters:
+                if sort_param.name[0] == user_input:
+                    sort_param.order += 1
+                    # wrap around sort orders
+                    sort_param.order %= 3
 
+
+@routing.read_write
 def rate_movie(conn, user_id, movie_id):
     """
     Assigns a movie a (0-5 star) rating given by a user.
@@ -257,26 +539,37 @@ def rate_movie(conn, user_id, movie_id):
 
     rating = int(input_utils.get_input_matching("Enter a rating (0-5): ", regex="^[0-5]$"))
 
-    with conn.cursor() as curs:
+    if transactions.run_write(conn, save_rating, user_id, movie_id, rating, datetime.datetime.now()):
+        print(f"Updated your rating for this movie to {rating} stars!")
+    else:
+        print(f"You gave this movie a {rating} star rating!")
+    # "profile" is user_funcs.PROFILE, which lists the top ratings
+    prefetch.refresh(user_id, FOR_YOU_IDS, "profile")
 
-        # Check if the user already rated this movie
-        curs.execute("SELECT rating FROM rated WHERE userid = %s AND movieid = %s", (user_id, movie_id))
-        existing_rating = curs.fetchone()
+    return
 
-        if existing_rating:
-            # If the user has already rated this movie, update their rating
-            curs.execute("UPDATE rated SET rating = %s WHERE userid = %s AND movieid = %s", (rating, user_id, movie_id))
-            print(f"Updated your rating for this movie to {rating} stars!")
-        else:
-            # Otherwise, assign the movie a new rating
-            curs.execute("INSERT INTO rated (userid, movieid, rating) VALUES (%s, %s, %s)", (user_id, movie_id, rating))
-            print(f"You gave this movie a {rating} star rating!")
 
-        conn.commit()
+def save_rating(curs, user_id, movie_id, rating, date_rated) -> bool:
+    """
+    Transaction body for rate_movie.
 
-        return
+    :return: Whether an earlier rating was replaced.
+    """
+    feed.publish(curs, user_id, "rate", [(movie_id, rating)], date_rated)
+
+    # Check if the user already rated this movie
+    statements.execute(curs, RATE_SELECT, (user_id, movie_id))
+    if curs.fetchone():
+        # If the user has already rated this movie, update their rating
+        statements.execute(curs, RATE_UPDATE, (rating, user_id, movie_id))
+        return True
+
+    # Otherwise, assign the movie a new rating
+    statements.execute(curs, RATE_INSERT, (user_id, movie_id, rating))
+    return False
 
 
+@routing.read_write
 def watch_movie(conn, user_id, movie_id):
     """
     Allows the user to watch a movie and record when
@@ -287,26 +580,59 @@ def watch_movie(conn, user_id, movie_id):
     :param movie_id: The ID of the movie being watched.
     """
 
+    movie = movie_cache.get(conn, movie_id)
+    if movie == None:
+        print("That movie no longer exists!")
+        return
+    movie_length = movie.length
+
     date_watched = datetime.datetime.now()
+    transactions.run_write(conn, record_watch, user_id, movie_id, date_watched, movie_length)
+    prefetch.refresh(user_id, WATCHED, FOR_YOU_IDS)
 
-    with conn.cursor() as curs:
+    date_and_time = date_watched.strftime("%m/%d/%Y at %I:%M %p")
 
-        # Get the movie's length
-        curs.execute("SELECT length FROM movie WHERE movieid = %s", (movie_id,))
-        movie_length = curs.fetchone()[0]
+    print(f"You watched this movie on {date_and_time} for {movie_length} minutes!")
 
-        curs.execute("INSERT INTO watched (userid, movieid, dateTime, watchDuration) VALUES (%s, %s, %s, %s)",
-                     (user_id, movie_id, date_watched, movie_length))
+    return
 
-        conn.commit()
 
-    date_and_time = date_watched.strftime("%m/%d/%Y at %I:%M %p")
+def record_watch(curs, user_id, movie_id, date_watched, movie_length) -> None:
+    """
+    Transaction body for watch_movie, the movie's length is recorded as the
+    watch duration.
+    """
+    statements.execute(curs, WATCH_INSERT, (user_id, movie_id, date_watched, movie_length))
+    feed.publish(curs, user_id, "watch", [(movie_id, movie_length)], date_watched)
 
-    print(f"You watched this movie on {date_and_time} for {movie_length} minutes!")
+
+@routing.read_only
+def more_like_this(conn, movie_id, user_id=None):
+    """
+    Shows the movies most like a movie by genre, cast, directors and studios.
+
+    :param conn: Connection to the database.
+    :param movie_id: The ID of the movie to match.
+    :param user_id: The logged in user's ID, movies they have seen are marked.
+    """
+    with conn.cursor() as curs:
+        statements.execute(curs, MORE_LIKE_THIS, (movie_id,))
+        results = curs.fetchall()
+
+    if len(results) == 0:
+        print("No similar movies yet, check back later.")
+    else:
+        print("More like this:")
+        watched = prefetch.get(user_id, WATCHED) if user_id != None else None
+        names = titles(conn, [similar_id for similar_id, score in results])
+        for i, (title, (similar_id, score)) in enumerate(zip(names, results), start=1):
+            seen = " (watched)" if watched != None and similar_id in watched else ""
+            print(f"{i}. {title} ({score:.0%} match){seen}")
 
     return
 
 
+@routing.scatter
 def top_20_last_90_days(conn):
     """
     Shows the user a list of the top 20 most popular movies in the
@@ -315,27 +641,16 @@ def top_20_last_90_days(conn):
     :param conn: Connection to the database.
     """
 
-    with conn.cursor() as curs:
+    watched_count = sketch_ranking(conn, TOP_20_LAST_90_DAYS, LAST_90_DAYS_BITS, LAST_90_DAYS_SKETCHES, (), 20)
 
-        curs.execute("""
-                    SELECT movie.title
-                    FROM movie
-                    JOIN watched ON movie.movieid = watched.movieid
-                    WHERE watched.dateTime >= CURRENT_DATE - INTERVAL '90 days'
-                    GROUP BY movie.movieid
-                    ORDER BY COUNT(watched.movieid) DESC
-                    LIMIT 20
-                    """)
-        watched_count = curs.fetchall()
-
-        conn.commit()
-
-    print("Top 20 movies by total viewings (last 90 days):")
-    for i, (title,) in enumerate(watched_count, start=1):
-        print(f"{i}. {title}")
+    print("Top 20 movies by unique viewers (last 90 days):")
+    names = titles(routing.connection_for(conn), [movie_id for movie_id, viewers in watched_count])
+    for i, (title, (movie_id, viewers)) in enumerate(zip(names, watched_count), start=1):
+        print(f"{i}. {title} (~{viewers:.0f} viewers)")
 
     return
 
+@routing.scatter
 def top_20_among_followers(conn, user_id):
     """
     Shows the user a list of the top 20 most popular movies
@@ -344,29 +659,18 @@ def top_20_among_followers(conn, user_id):
     :param conn: Connection to the database.
     """
 
-    with conn.cursor() as curs:
-
-        curs.execute("""
-                    SELECT movie.title
-                    FROM movie
-                    JOIN watched ON movie.movieid = watched.movieid
-                    JOIN following ON watched.userid = following.followerid
-                    WHERE following.followingid = %s
-                    GROUP BY movie.movieid
-                    ORDER BY COUNT(watched.movieid) DESC
-                    LIMIT 20
-                    """, (user_id,))
-        watched_count = curs.fetchall()
-
-        conn.commit()
+    # followers live on any shard, each one counts its own
+    watched_count = ranking(conn, TOP_20_AMONG_FOLLOWERS, FOLLOWER_VIEWERS, (user_id,), 20)
 
     print("Top 20 movies among your followers:")
-    for i, (title,) in enumerate(watched_count, start=1):
-        print(f"{i}. {title}")
+    names = titles(routing.connection_for(conn, user_id), [movie_id for movie_id, viewers in watched_count])
+    for i, (title, (movie_id, viewers)) in enumerate(zip(names, watched_count), start=1):
+        print(f"{i}. {title} ({viewers} followers watched)")
 
     return
 
 
+@routing.scatter
 def top_5_releases_of_month(conn):
     """
     Shows the user a list of the top 5 most popular new releases
@@ -375,33 +679,20 @@ def top_5_releases_of_month(conn):
     :param conn: Connection to the database.
     """
 
-    with conn.cursor() as curs:
-
-        curs.execute("""
-                    SELECT movie.title
-                    FROM movie
-                    JOIN watched ON movie.movieid = watched.movieid
-                    JOIN movierelease ON movie.movieid = movierelease.movieid
-                    WHERE movierelease.releasedate >= date_trunc('month', CURRENT_DATE)
-                    AND movierelease.releasedate < date_trunc('month', CURRENT_DATE) + INTERVAL '1 month'
-                    GROUP BY movie.movieid
-                    ORDER BY COUNT(watched.movieid) DESC
-                    LIMIT 5
-                    """)
-        watched_count = curs.fetchall()
-
-        conn.commit()
+    watched_count = sketch_ranking(conn, TOP_5_RELEASES_OF_MONTH, RELEASES_OF_MONTH_BITS, ALL_TIME_SKETCHES, (), 5)
 
     if not watched_count:
         print("No new releases this month.")
     else:
         print("Top 5 new releases this month:")
-        for i, (title,) in enumerate(watched_count, start=1):
-            print(f"{i}. {title}")
+        names = titles(routing.connection_for(conn), [movie_id for movie_id, viewers in watched_count])
+        for i, (title, (movie_id, viewers)) in enumerate(zip(names, watched_count), start=1):
+            print(f"{i}. {title} (~{viewers:.0f} viewers)")
 
     return
 
 
+@routing.read_only
 def view_recommended(conn, user_id):
     """
     Shows a list of recommended films for the user.
@@ -411,67 +702,11 @@ def view_recommended(conn, user_id):
     :param user_id: The current logged in user's ID
     """
 
-    """
-    Recommendation algorithm:
-    Get all movies I watched
-    Get all the users that watched those movies
-    Get movies that they watched (that I haven't)
-    Get top ten movies by rating from that
-    """
-
-    for_you_query = """
-    SELECT m.title, m.length,
-    (
-        SELECT
-            AVG(rating)
-        FROM
-            "rated"
-        WHERE
-            rated.movieid = m.movieid
-    ) AS avg_rating
-    FROM movie AS m
-    WHERE m.movieid IN
-    (
-        SELECT theywatched.movieid
-        FROM watched AS theywatched
-        WHERE theywatched.userid IN
-        (
-            SELECT wewatched.userid
-            FROM watched AS wewatched
-            WHERE wewatched.movieid IN
-            (
-                SELECT iwatched.movieid
-                FROM watched AS iwatched
-                WHERE iwatched.userid = %s
-            )
-            AND wewatched.userid != %s
-        )
-        EXCEPT
-        SELECT iwatched.movieid
-        FROM watched AS iwatched
-        WHERE iwatched.userid = %s
-    )
-    ORDER BY avg_rating DESC
-    LIMIT 20
-    """
-
     # display 'for you' page
-    with conn.cursor() as curs:
-        print("For You:")
-        curs.execute(for_you_query, (user_id, user_id, user_id))
-        results = curs.fetchall()
-
-        if results == None or len(results) == 0:
-            curs.execute("""
-                    SELECT movie.title
-                    FROM movie
-                    JOIN watched ON movie.movieid = watched.movieid
-                    WHERE watched.dateTime >= CURRENT_DATE - INTERVAL '90 days'
-                    GROUP BY movie.movieid
-                    ORDER BY COUNT(watched.movieid) DESC
-                    LIMIT 20
-                    """)
-            results = curs.fetchall()
+    print("For You:")
+    movie_ids = prefetch.get(user_id, FOR_YOU_IDS)
+    if movie_ids == None:
+        movie_ids = fetch_recommended(conn, user_id)
 
-        for i in range(len(results)):
-            print(f"{i + 1}. {results[i][0]}")
+    for i, title in enumerate(titles(conn, movie_ids), start=1):
+        print(f"{i}. {title}")
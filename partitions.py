@@ -0,0 +1,320 @@
+#!/bin/python3
+
+"""
+Monthly partitions of the watched table, rollups and retention.
+
+watched is range partitioned by datetime with one partition per month
+(watched_yYYYYmMM) plus a default partition that should stay empty. Future
+partitions are created ahead of time. If maintenance fell behind and a
+month's events landed in the default partition, they are moved into the
+month's partition when it is created. Two compact summary tables outlive
+the raw events:
+
+watched_user_movie_rollup: views, minutes and first/last watch per (user, movie)
+watched_movie_daily: views, minutes and distinct viewers per (movie, day)
+
+watched_user_movie_rollup covers all time, a trigger on watched keeps it up
+to date as watch events land. Once a month falls out of the retention
+window it is rolled up into watched_movie_daily and its partition is
+dropped.
+
+The leaderboards over recent windows prune down to the last few partitions,
+queries over all time read watched_user_movie_rollup instead of raw events.
+
+usage: partitions.py
+"""
+
+import datetime
+import re
+import sys
+
+import routing
+
+# How many months of raw watch events to keep, counting the current one.
+# Must cover the longest window a leaderboard looks at (90 days).
+RETENTION_MONTHS = 12
+
+# How many months ahead of the current one to have partitions ready for
+MONTHS_AHEAD = 3
+
+PARTITION_PATTERN = re.compile(r"^watched_y(\d{4})m(\d{2})$")
+
+CREATE_ROLLUP_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS watched_user_movie_rollup (
+        userid integer NOT NULL,
+        movieid integer NOT NULL,
+        views bigint NOT NULL,
+        total_duration bigint NOT NULL,
+        first_watched timestamp NOT NULL,
+        last_watched timestamp NOT NULL,
+        PRIMARY KEY (userid, movieid)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS watched_user_movie_rollup_movieid_idx ON watched_user_movie_rollup (movieid, userid)",
+    """
+    CREATE TABLE IF NOT EXISTS watched_movie_daily (
+        movieid integer NOT NULL,
+        day date NOT NULL,
+        views bigint NOT NULL,
+        total_duration bigint NOT NULL,
+        viewers integer NOT NULL,
+        PRIMARY KEY (movieid, day)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS watched_movie_daily_day_idx ON watched_movie_daily (day)",
+]
+
+ROLLUP_USER_MOVIE = """
+INSERT INTO watched_user_movie_rollup (userid, movieid, views, total_duration, first_watched, last_watched)
+SELECT userid, movieid, COUNT(*), COALESCE(SUM(watchduration), 0), MIN(datetime), MAX(datetime)
+FROM {}
+GROUP BY userid, movieid
+ON CONFLICT (userid, movieid) DO UPDATE SET
+    views = watched_user_movie_rollup.views + EXCLUDED.views,
+    total_duration = watched_user_movie_rollup.total_duration + EXCLUDED.total_duration,
+    first_watched = LEAST(watched_user_movie_rollup.first_watched, EXCLUDED.first_watched),
+    last_watched = GREATEST(watched_user_movie_rollup.last_watched, EXCLUDED.last_watched)
+"""
+
+# Keeps watched_user_movie_rollup current. Statement level, so a collection's
+# "watch all" is one upsert, and grouped, so no pair is upserted twice.
+CREATE_ROLLUP_TRIGGER = [
+    """
+    CREATE OR REPLACE FUNCTION watched_rollup_insert() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        """ + ROLLUP_USER_MOVIE.format("new_rows") + """;
+        RETURN NULL;
+    END
+    $$
+    """,
+    """
+    CREATE TRIGGER watched_rollup
+    AFTER INSERT ON watched
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION watched_rollup_insert()
+    """,
+]
+
+ROLLUP_MOVIE_DAILY = """
+INSERT INTO watched_movie_daily (movieid, day, views, total_duration, viewers)
+SELECT movieid, datetime::date, COUNT(*), COALESCE(SUM(watchduration), 0), COUNT(DISTINCT userid)
+FROM {}
+GROUP BY movieid, datetime::date
+ON CONFLICT (movieid, day) DO UPDATE SET
+    views = watched_movie_daily.views + EXCLUDED.views,
+    total_duration = watched_movie_daily.total_duration + EXCLUDED.total_duration,
+    -- a day only lives in one partition, so this only adds up when a rollup is repeated
+    viewers = GREATEST(watched_movie_daily.viewers, EXCLUDED.viewers)
+"""
+
+
+# Whether any of a month's events sit in the default partition
+DEFAULT_MONTH_ROWS = "SELECT 1 FROM watched_default WHERE datetime >= %s AND datetime < %s LIMIT 1"
+
+# Inserted straight into the partition, so the statement triggers on watched
+# don't count the moved events a second time
+MOVE_FROM_DEFAULT = """
+INSERT INTO {} SELECT * FROM watched_default WHERE datetime >= %s AND datetime < %s
+"""
+
+DELETE_FROM_DEFAULT = "DELETE FROM watched_default WHERE datetime >= %s AND datetime < %s"
+
+COUNT_DEFAULT_ROWS = "SELECT COUNT(*) FROM watched_default"
+
+
+def month_start(day: datetime.date) -> datetime.date:
+    """
+    The first day of the month a date is in.
+    """
+    return day.replace(day=1)
+
+
+def add_months(month: datetime.date, count: int) -> datetime.date:
+    """
+    Moves the first day of a month forwards (or backwards) by whole months.
+    """
+    index = month.year * 12 + month.month - 1 + count
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: datetime.date) -> str:
+    """
+    The name of the partition holding a month.
+    """
+    return "watched_y%04dm%02d" % (month.year, month.month)
+
+
+def existing_partitions(curs) -> dict:
+    """
+    The monthly partitions of watched.
+
+    :param curs: Cursor to query with.
+    :return: Partition name keyed by the month it holds.
+    """
+    curs.execute("""
+        SELECT c.relname
+        FROM pg_inherits AS i
+        JOIN pg_class AS c ON (c.oid = i.inhrelid)
+        WHERE i.inhparent = 'watched'::regclass
+        """)
+    partitions = {}
+    for (name,) in curs.fetchall():
+        match = PARTITION_PATTERN.match(name)
+        if match:
+            partitions[datetime.date(int(match.group(1)), int(match.group(2)), 1)] = name
+    return partitions
+
+
+def ensure_partitions(curs, first: datetime.date, last: datetime.date) -> list[str]:
+    """
+    Creates any missing monthly partitions between two months (inclusive).
+
+    :param curs: Cursor to run with.
+    :param first: A day in the first month.
+    :param last: A day in the last month.
+    :return: The partitions that were created.
+    """
+    existing = existing_partitions(curs)
+    created = []
+    month = month_start(first)
+    while month <= last:
+        if month not in existing:
+            name = partition_name(month)
+            end = add_months(month, 1)
+            curs.execute(DEFAULT_MONTH_ROWS, (month, end))
+            if curs.fetchone() == None:
+                curs.execute("CREATE TABLE {} PARTITION OF watched FOR VALUES FROM (%s) TO (%s)".format(name), (month, end))
+            else:
+                # attaching a range the default partition has rows in fails,
+                # so the month's rows are moved over before attaching
+                curs.execute("LOCK TABLE watched IN SHARE ROW EXCLUSIVE MODE")
+                curs.execute("CREATE TABLE {} (LIKE watched INCLUDING DEFAULTS INCLUDING CONSTRAINTS)".format(name))
+                curs.execute(MOVE_FROM_DEFAULT.format(name), (month, end))
+                curs.execute(DELETE_FROM_DEFAULT, (month, end))
+                curs.execute("ALTER TABLE watched ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)".format(name), (month, end))
+            created.append(name)
+        month = add_months(month, 1)
+    return created
+
+
+def default_rows(conn) -> int:
+    """
+    How many events sit in the default partition, outside every month that
+    has a partition. It should be 0, anything else is worth a look.
+
+    :param conn: Connection to the primary.
+    """
+    with conn.cursor() as curs:
+        curs.execute(COUNT_DEFAULT_ROWS)
+        count = curs.fetchone()[0]
+    conn.commit()
+    return count
+
+
+def partition_watched(curs) -> None:
+    """
+    Migration step: rebuilds watched as a monthly partitioned table.
+
+    Columns, defaults and checks are copied with LIKE, keys and foreign keys
+    are carried over when they include datetime (a partitioned table's
+    unique constraints must contain the partition key). The indexes on
+    watched from earlier migrations are recreated by the caller.
+
+    :param curs: Cursor inside the migration's transaction.
+    """
+    curs.execute("""
+        SELECT conname, contype, pg_get_constraintdef(oid), pg_get_constraintdef(oid) LIKE '%datetime%'
+        FROM pg_constraint
+        WHERE conrelid = 'watched'::regclass AND contype IN ('p', 'u', 'f')
+        """)
+    constraints = curs.fetchall()
+
+    curs.execute("SELECT MIN(datetime), MAX(datetime) FROM watched")
+    oldest, newest = curs.fetchone()
+
+    curs.execute("CREATE TABLE watched_partitioned (LIKE watched INCLUDING DEFAULTS INCLUDING CONSTRAINTS) PARTITION BY RANGE (datetime)")
+    curs.execute("CREATE TABLE watched_default PARTITION OF watched_partitioned DEFAULT")
+    curs.execute("ALTER TABLE watched RENAME TO watched_unpartitioned")
+    curs.execute("ALTER TABLE watched_partitioned RENAME TO watched")
+
+    today = datetime.date.today()
+    ensure_partitions(curs, oldest.date() if oldest != None else today, add_months(month_start(today), MONTHS_AHEAD))
+
+    curs.execute("INSERT INTO watched SELECT * FROM watched_unpartitioned")
+    curs.execute("DROP TABLE watched_unpartitioned")
+
+    for name, kind, definition, has_datetime in constraints:
+        if kind != "f" and not has_datetime:
+            continue
+        curs.execute("ALTER TABLE watched ADD CONSTRAINT {} {}".format(name, definition))
+
+
+def maintain(conn, today: datetime.date = None) -> tuple[list[str], list[str]]:
+    """
+    Creates upcoming partitions, then rolls up and drops the partitions that
+    fell out of the retention window. Each expired month is rolled up and
+    dropped in the same transaction, so its events are always counted
+    exactly once. (watched_user_movie_rollup already has them, see
+    CREATE_ROLLUP_TRIGGER.)
+
+    :param conn: Connection to the primary.
+    :param today: The current date. Leave None for today.
+    :return: (partitions created, partitions rolled up and dropped)
+    """
+    if today == None:
+        today = datetime.date.today()
+    current = month_start(today)
+
+    with conn.cursor() as curs:
+        # dropping a month before the trigger existed would lose it from watched_user_movie_rollup
+        curs.execute("SELECT 1 FROM pg_trigger WHERE tgname = 'watched_rollup' AND tgrelid = 'watched'::regclass")
+        if curs.fetchone() == None:
+            conn.rollback()
+            raise RuntimeError("watched_rollup trigger is missing, run schema.py migrate first")
+
+        created = ensure_partitions(curs, current, add_months(current, MONTHS_AHEAD))
+        conn.commit()
+
+        dropped = []
+        cutoff = add_months(current, 1 - RETENTION_MONTHS)
+        for month, name in sorted(existing_partitions(curs).items()):
+            if month >= cutoff:
+                break
+            curs.execute(ROLLUP_MOVIE_DAILY.format(name))
+            curs.execute("DROP TABLE {}".format(name))
+            conn.commit()
+            dropped.append(name)
+
+    conn.commit()
+    return created, dropped
+
+
+def main() -> int:
+    """
+    Runs partition maintenance from the command line.
+
+    :return: 0 on success
+    """
+    import sigmadb
+
+    credentials = sigmadb.load_credentials()
+    if credentials == None:
+        return 1
+
+    with sigmadb.connect(credentials) as conn:
+        created, dropped = maintain(routing.primary_connection(conn))
+        stray = default_rows(routing.primary_connection(conn))
+
+    for name in created:
+        print("Created %s" % name)
+    for name in dropped:
+        print("Rolled up and dropped %s" % name)
+    if stray > 0:
+        print("Warning: %d event(s) in watched_default are outside every partition" % stray)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,394 @@
+#!/bin/python3
+
+"""
+Query plan regression suite.
+
+Brings a scratch database's schema up to date (schema.py), loads scaled
+synthetic data inside a transaction, captures the EXPLAIN plan of every hot
+query in movie_funcs and user_funcs and fails when one of them falls back to
+a sequential scan of a large table or a nested loop that blows up. The
+approximate queries are also timed against the exact queries they replace
+(BENCHMARKS) and fail unless they are faster by BENCHMARK_MARGIN. The data is rolled back at the
+end, but the migrations are not, so point this at a scratch copy of the
+database rather than p320_10 itself.
+
+usage: plan_check.py [scale] [plan directory]
+"""
+
+import datetime
+import json
+import os
+import sys
+
+import feed
+import movie_cache
+import movie_funcs
+import partitions
+import routing
+import schema
+import search
+import statements
+import user_funcs
+
+# Rows generated per unit of scale
+MOVIES_PER_SCALE = 1000
+USERS_PER_SCALE = 1000
+WATCHES_PER_USER = 50
+RATINGS_PER_USER = 10
+FOLLOWS_PER_USER = 10
+COLLECTIONS_PER_USER = 2
+MOVIES_PER_COLLECTION = 10
+GENRES = 20
+
+# Tables that must never be read with a sequential scan on a hot path
+LARGE_TABLES = {"movie", "movierelease", "moviegenre", "actsin", "directed", "crewmember", "produced",
+                "rated", "watched", "following", "user", "moviecollection", "incollection",
+                "watched_user_movie_rollup", "watched_movie_viewers_daily", "watched_movie_viewers"}
+
+# A nested loop whose outer side is estimated above this many rows has to
+# look its inner side up through an index
+NESTED_LOOP_OUTER_LIMIT = 1000
+
+# No nested loop should be estimated to produce more rows than this
+NESTED_LOOP_ROW_LIMIT = 1000000
+
+INDEX_LOOKUPS = {"Index Scan", "Index Only Scan", "Bitmap Heap Scan", "Memoize"}
+
+# What the 90-day leaderboard counted before the viewer sketches
+EXACT_TOP_20_LAST_90_DAYS = """
+    SELECT w.movieid, COUNT(DISTINCT w.userid) AS viewers
+    FROM watched AS w
+    WHERE w.datetime >= CURRENT_DATE - INTERVAL '90 days'
+    GROUP BY w.movieid
+    ORDER BY viewers DESC, w.movieid
+    LIMIT 20
+"""
+
+# (label, approximate query, the exact query it replaces)
+BENCHMARKS = [
+    ("top_20_last_90_days", statements.get(movie_funcs.TOP_20_LAST_90_DAYS).query, EXACT_TOP_20_LAST_90_DAYS),
+]
+
+# Each benchmarked query runs once to warm the caches (the data was only
+# just loaded), then this many times, and the fastest run counts
+BENCHMARK_RUNS = 3
+
+# The approximate query has to take less than this share of the exact one's
+# time, so a near tie doesn't pass or fail depending on the run
+BENCHMARK_MARGIN = 0.9
+
+# Tables are filled in dependency order. %(name0)s is the largest id already
+# in the table so generated rows never collide with real ones.
+SCALED_DATA = [
+    ("genre", "genreid", """
+        INSERT INTO genre (genreid, genrename)
+        SELECT %(genre0)s + g, 'Scaled Genre ' || g FROM generate_series(1, %(genres)s) AS g
+    """),
+    ("studio", "studioid", """
+        INSERT INTO studio (studioid, name)
+        SELECT %(studio0)s + g, 'Scaled Studio ' || g FROM generate_series(1, %(studios)s) AS g
+    """),
+    ("crewmember", "crewid", """
+        INSERT INTO crewmember (crewid, firstname, lastname)
+        SELECT %(crewmember0)s + g, 'First ' || g, 'Last ' || g FROM generate_series(1, %(crew)s) AS g
+    """),
+    ("movie", "movieid", """
+        INSERT INTO movie (movieid, title, length, mpaarating)
+        SELECT %(movie0)s + g, 'Scaled Movie ' || g, 60 + g %% 120, (ARRAY['G', 'PG', 'PG-13', 'R'])[1 + g %% 4]
+        FROM generate_series(1, %(movies)s) AS g
+    """),
+    ("user", "userid", """
+        INSERT INTO "user" (userid, firstname, lastname, username, password, email, creationdate, lastaccessdate)
+        SELECT %(user0)s + g, 'First', 'Last', 'scaled_user_' || (%(user0)s + g), 'x', 'scaled_user_' || (%(user0)s + g) || '@example.com', now(), now()
+        FROM generate_series(1, %(users)s) AS g
+    """),
+    ("movierelease", None, """
+        INSERT INTO movierelease (movieid, releasedate)
+        SELECT %(movie0)s + g, DATE '2000-01-01' + (g * 37) %% 9000 FROM generate_series(1, %(movies)s) AS g
+    """),
+    ("moviegenre", None, """
+        INSERT INTO moviegenre (movieid, genreid)
+        SELECT %(movie0)s + g, %(genre0)s + 1 + (g + k * 7) %% %(genres)s
+        FROM generate_series(1, %(movies)s) AS g, generate_series(0, 1) AS k
+    """),
+    ("actsin", None, """
+        INSERT INTO actsin (crewid, movieid)
+        SELECT %(crewmember0)s + 1 + (g * 5 + k) %% %(crew)s, %(movie0)s + g
+        FROM generate_series(1, %(movies)s) AS g, generate_series(0, 4) AS k
+    """),
+    ("directed", None, """
+        INSERT INTO directed (crewid, movieid)
+        SELECT %(crewmember0)s + 1 + (g * 13) %% %(crew)s, %(movie0)s + g FROM generate_series(1, %(movies)s) AS g
+    """),
+    ("produced", None, """
+        INSERT INTO produced (studioid, movieid)
+        SELECT %(studio0)s + 1 + g %% %(studios)s, %(movie0)s + g FROM generate_series(1, %(movies)s) AS g
+    """),
+    ("watched", None, """
+        INSERT INTO watched (userid, movieid, datetime, watchduration)
+        SELECT %(user0)s + 1 + (g * 7919) %% %(users)s,
+               %(movie0)s + 1 + floor(%(movies)s * power(((g * 104729 + g / %(users)s * 7) %% %(movies)s)::float8 / %(movies)s, 3))::integer,
+               now() - g * (INTERVAL '5 years' / %(watches)s), 90
+        -- each pass over the users shifts their movies, and the cube piles
+        -- the watches onto the low ids so the leaderboards have a top. g is
+        -- a bigint, times the multipliers it passes the integer range.
+        FROM generate_series(1::bigint, %(watches)s) AS g
+    """),
+    ("rated", None, """
+        INSERT INTO rated (userid, movieid, rating)
+        SELECT %(user0)s + 1 + g %% %(users)s, %(movie0)s + 1 + (g / %(users)s) %% %(movies)s, g %% 6
+        FROM generate_series(0, %(ratings)s - 1) AS g
+    """),
+    ("following", None, """
+        INSERT INTO following (followerid, followingid)
+        SELECT %(user0)s + 1 + g %% %(users)s, %(user0)s + 1 + (g %% %(users)s + 1 + g / %(users)s) %% %(users)s
+        FROM generate_series(0, %(follows)s - 1) AS g
+    """),
+    ("moviecollection", "collectionid", """
+        INSERT INTO moviecollection (collectionid, name, madeby)
+        SELECT %(moviecollection0)s + g, 'Scaled Collection ' || g, %(user0)s + 1 + g %% %(users)s
+        FROM generate_series(1, %(collections)s) AS g
+    """),
+    ("incollection", None, """
+        INSERT INTO incollection (movieid, collectionid)
+        SELECT %(movie0)s + 1 + (g * 31 + k) %% %(movies)s, %(moviecollection0)s + g
+        FROM generate_series(1, %(collections)s) AS g, generate_series(0, %(per_collection)s - 1) AS k
+    """),
+]
+
+
+class Check():
+    def __init__(self, label: str, query: str, args: tuple = (), allow_seq_scan: set = set(), max_partitions: int = None):
+        """
+        :param label: Name of the check, also the name of its captured plan.
+        :param query: The query to explain.
+        :param args: Arguments for the query (may refer to ids, see checks()).
+        :param allow_seq_scan: Large tables this query may scan anyway.
+        :param max_partitions: Most partitions of watched the plan may read, None for no limit.
+        """
+        self.label = label
+        self.query = query
+        self.args = args
+        self.allow_seq_scan = allow_seq_scan
+        self.max_partitions = max_partitions
+
+
+def checks(ids: dict) -> list[Check]:
+    """
+    The hot queries, with arguments that hit the generated data.
+
+    :param ids: The largest id in each table before the data was generated.
+    """
+    movie = ids["movie0"] + 1
+    user = ids["user0"] + 1
+    collection = ids["moviecollection0"] + 1
+
+    return [
+        Check("browse_title", *search.MovieSearch().title("scaled movie 12").compile(["title ASC"])),
+        Check("browse_release", *search.MovieSearch().released_between(datetime.date(2000, 1, 1), datetime.date(2000, 3, 1)).compile(["first_release ASC"])),
+        Check("browse_cast", *search.MovieSearch().cast("first 12", "last 12").compile(["title ASC"])),
+        Check("browse_director", *search.MovieSearch().director("first 13", "last 13").compile(["title ASC"])),
+        Check("browse_studio", *search.MovieSearch().studio("scaled studio 12").compile(["title ASC"])),
+        # one genre in twenty is too broad for an index to beat reading movie
+        Check("browse_genre", *search.MovieSearch().genres(["scaled genre 12"]).compile(["title ASC"]), {"movie"}),
+        Check("browse_combined", *search.MovieSearch().year(2001).genres(["scaled genre 3", "scaled genre 4"]).runtime(90, 150).mpaa(["PG", "R"]).min_rating(2).compile(["title ASC", "first_release DESC"])),
+        Check("rate_select", statements.get(movie_funcs.RATE_SELECT).query, (user, movie)),
+        Check("movie_cache_load", movie_cache.MOVIES_QUERY, ([movie, movie + 1, movie + 2],)),
+        # reads the daily viewer sketches, not the partitions
+        Check("top_20_last_90_days", statements.get(movie_funcs.TOP_20_LAST_90_DAYS).query, max_partitions=0),
+        Check("top_20_among_followers", statements.get(movie_funcs.TOP_20_AMONG_FOLLOWERS).query, (user,)),
+        Check("top_5_releases_of_month", statements.get(movie_funcs.TOP_5_RELEASES_OF_MONTH).query),
+        # co-viewers of everything a user watched is most of the table by design
+        Check("for_you", statements.get(movie_funcs.FOR_YOU).query, (user, user, user), {"watched_user_movie_rollup"}),
+        Check("more_like_this", statements.get(movie_funcs.MORE_LIKE_THIS).query, (movie,)),
+        Check("similar_to_history", statements.get(movie_funcs.SIMILAR_TO_HISTORY).query, (user, user, user)),
+        Check("login_select", statements.get(user_funcs.LOGIN_SELECT).query, ("scaled_user_%d" % user, "x")),
+        Check("following_page", user_funcs.FOLLOWING_PAGE_QUERY, (user, 10, 0)),
+        Check("feed_page", feed.FEED_PAGE_QUERY, {"userid": user, "before": feed.FIRST_PAGE, "limit": feed.PAGE_SIZE}),
+        Check("collection_movies", user_funcs.COLLECTION_MOVIES_QUERY, (collection,)),
+        Check("collections", user_funcs.GET_COLLECTIONS_QUERY, (user,)),
+        Check("profile_collections", user_funcs.GET_NUM_COLLECTIONS, (user,)),
+        Check("profile_followers", user_funcs.GET_NUM_FOLLOWERS, (user,)),
+        Check("profile_following", user_funcs.GET_NUM_FOLLOWING, (user,)),
+        Check("profile_top_ratings", user_funcs.TEN_HIGHEST_RATINGS, (user,)),
+    ]
+
+
+def load_scaled_data(curs, scale: int) -> dict:
+    """
+    Generates synthetic rows in every table the hot queries touch and
+    refreshes the planner's statistics.
+
+    :param curs: Cursor inside the transaction that will be rolled back.
+    :param scale: How much data to generate.
+    :return: The largest id in each table before the data was generated.
+    """
+    users = USERS_PER_SCALE * scale
+    params = {
+        "genres": GENRES,
+        "movies": MOVIES_PER_SCALE * scale,
+        "studios": max(MOVIES_PER_SCALE * scale // 10, 1),
+        "crew": MOVIES_PER_SCALE * scale * 2,
+        "users": users,
+        "watches": users * WATCHES_PER_USER,
+        "ratings": users * RATINGS_PER_USER,
+        "follows": users * FOLLOWS_PER_USER,
+        "collections": users * COLLECTIONS_PER_USER,
+        "per_collection": MOVIES_PER_COLLECTION,
+    }
+
+    # the generated watch history goes back five years
+    today = datetime.date.today()
+    partitions.ensure_partitions(curs, today.replace(year=today.year - 5, day=1), today)
+
+    for table, id_column, insert in SCALED_DATA:
+        if id_column != None:
+            curs.execute("SELECT COALESCE(MAX({}), 0) FROM \"{}\"".format(id_column, table))
+            params[table + "0"] = curs.fetchone()[0]
+        curs.execute(insert, params)
+        print("Loaded %s row(s) into %s" % (curs.rowcount, table))
+
+    curs.execute("ANALYZE " + ", ".join("\"{}\"".format(table) for table, _, _ in SCALED_DATA))
+    return params
+
+
+def scanned_partitions(node: dict) -> set:
+    """
+    The partitions of watched a plan reads (after pruning).
+
+    :param node: A plan node from EXPLAIN (FORMAT JSON).
+    """
+    scanned = set()
+    name = node.get("Relation Name", "")
+    if partitions.PARTITION_PATTERN.match(name) or name == "watched_default":
+        scanned.add(name)
+    for child in node.get("Plans", []):
+        scanned |= scanned_partitions(child)
+    return scanned
+
+
+def plan_problems(node: dict, allow_seq_scan: set) -> list[str]:
+    """
+    Walks a JSON plan looking for regressions.
+
+    :param node: A plan node from EXPLAIN (FORMAT JSON).
+    :param allow_seq_scan: Large tables that may be scanned anyway.
+    :return: A description of every problem found.
+    """
+    problems = []
+    node_type = node["Node Type"]
+    children = node.get("Plans", [])
+
+    if node_type == "Seq Scan" and node.get("Relation Name") in LARGE_TABLES - allow_seq_scan:
+        problems.append("sequential scan on %s (%s rows)" % (node["Relation Name"], node["Plan Rows"]))
+
+    if node_type == "Nested Loop":
+        outer = [child for child in children if child.get("Parent Relationship") == "Outer"]
+        inner = [child for child in children if child.get("Parent Relationship") == "Inner"]
+        if node["Plan Rows"] > NESTED_LOOP_ROW_LIMIT:
+            problems.append("nested loop producing %s rows" % node["Plan Rows"])
+        elif outer and inner and outer[0]["Plan Rows"] > NESTED_LOOP_OUTER_LIMIT and inner[0]["Node Type"] not in INDEX_LOOKUPS:
+            problems.append("nested loop over %s outer rows without an index on the inner side (%s)" % (outer[0]["Plan Rows"], inner[0]["Node Type"]))
+
+    for child in children:
+        problems += plan_problems(child, allow_seq_scan)
+    return problems
+
+
+def execution_ms(curs, query: str) -> float:
+    """
+    The fastest of BENCHMARK_RUNS executions of a query after a warm-up run,
+    as measured by the server (EXPLAIN ANALYZE, so no rows travel).
+    """
+    curs.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + query)
+    best = None
+    for _ in range(BENCHMARK_RUNS):
+        curs.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + query)
+        plan = curs.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        if best == None or plan[0]["Execution Time"] < best:
+            best = plan[0]["Execution Time"]
+    return best
+
+
+def run(conn, scale: int, plan_directory: str = None) -> int:
+    """
+    Runs the whole suite.
+
+    :param conn: Connection to a scratch database.
+    :param scale: How much data to generate.
+    :param plan_directory: Where to save the captured plans. Leave None to skip.
+    :return: The number of failed checks.
+    """
+    for migration in schema.migrate(conn):
+        print("Applied migration %d: %s" % (migration.version, migration.description))
+
+    if plan_directory != None:
+        os.makedirs(plan_directory, exist_ok=True)
+
+    failures = 0
+    try:
+        with conn.cursor() as curs:
+            ids = load_scaled_data(curs, scale)
+
+            for check in checks(ids):
+                curs.execute("EXPLAIN (FORMAT JSON) " + check.query, check.args)
+                plan = curs.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+
+                if plan_directory != None:
+                    with open(os.path.join(plan_directory, check.label + ".json"), "w") as plan_file:
+                        json.dump(plan, plan_file, indent=2)
+
+                problems = plan_problems(plan[0]["Plan"], check.allow_seq_scan)
+                if check.max_partitions != None:
+                    scanned = scanned_partitions(plan[0]["Plan"])
+                    if len(scanned) > check.max_partitions:
+                        problems.append("reads %d partitions of watched, expected at most %d" % (len(scanned), check.max_partitions))
+                if problems:
+                    failures += 1
+                    print("FAIL %s: %s" % (check.label, "; ".join(problems)))
+                else:
+                    print("ok   %s (cost %s)" % (check.label, plan[0]["Plan"]["Total Cost"]))
+
+            for label, approximate, exact in BENCHMARKS:
+                approximate_ms = execution_ms(curs, approximate)
+                exact_ms = execution_ms(curs, exact)
+                if approximate_ms >= exact_ms * BENCHMARK_MARGIN:
+                    failures += 1
+                    print("FAIL %s: %.1f ms, not faster than the exact count (%.1f ms)" % (label, approximate_ms, exact_ms))
+                else:
+                    print("ok   %s: %.1f ms, the exact count takes %.1f ms" % (label, approximate_ms, exact_ms))
+    finally:
+        # never keep the generated data
+        conn.rollback()
+
+    return failures
+
+
+def main() -> int:
+    """
+    Runs the suite from the command line.
+
+    :return: 0 when every check passes
+    """
+    import sigmadb
+
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    plan_directory = sys.argv[2] if len(sys.argv) > 2 else None
+
+    credentials = sigmadb.load_credentials()
+    if credentials == None:
+        return 1
+
+    with sigmadb.connect(credentials) as conn:
+        failures = run(routing.primary_connection(conn), scale, plan_directory)
+
+    print("\n%d check(s) failed" % failures)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
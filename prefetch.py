@@ -0,0 +1,218 @@
+#!/bin/python3
+
+"""
+Per-session prefetching.
+
+Right after login the app starts loading what the menus show first: the
+user's collections, profile, followed users, watched movies and "for you"
+list. Each is loaded on a background worker, so the first visit to a menu
+is served from memory instead of waiting on a query. A session opens one
+tunnel, and each worker connects to only the database holding the user's
+rows (connections.open_user_database), reading from its replicas when
+there are any. The functions that write call refresh() once their change
+has committed, which loads the affected values again. A reload first
+notes the primary's WAL position, so it never reads from a replica that
+hasn't replayed the session's own writes.
+
+A menu waits at most "prefetch_wait" seconds for a value that is still
+loading, then queries it itself.
+
+Modules register what can be prefetched, much like statements.py:
+
+    COLLECTIONS = prefetch.register("collections", fetch_collections)
+
+and read it back with get(userid, name), falling back to querying
+themselves when it returns None (no session started for that user, e.g.
+under loadgen, the fetch failed or is taking too long).
+
+credentials.json may set "prefetch_workers" (default 2, 0 turns it off)
+and "prefetch_wait" (seconds, default 2).
+"""
+
+import concurrent.futures
+import contextlib
+import queue
+import threading
+
+import connections
+import profiling
+import routing
+import transactions
+
+DEFAULT_WORKERS = 2
+DEFAULT_WAIT = 2.0
+
+# Name: function(conn, userid) returning the value
+_fetchers = {}
+
+# Started sessions by userid
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def register(name: str, fetch) -> str:
+    """
+    Adds something to prefetch for every session.
+
+    :param name: Name to get it by.
+    :param fetch: Takes (connection in autocommit, userid), returns the value. It must only read.
+    :return: The name, for use with get() and refresh().
+    """
+    if name in _fetchers:
+        raise ValueError("Prefetch '%s' is already registered" % name)
+    _fetchers[name] = routing.read_only(fetch)
+    return name
+
+
+class Session():
+    def __init__(self, credentials: dict, userid: int, workers: int, wait: float):
+        """
+        :param credentials: The parsed credentials file, every worker connects with it.
+        :param userid: The logged in user.
+        :param workers: Fetches run at once, each worker on its own connection.
+        :param wait: Seconds get() waits for a value still loading.
+        """
+        self.credentials = credentials
+        self.userid = userid
+        self.wait = wait
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        self.values = {}
+        self.threads = [threading.Thread(target=self.worker, daemon=True) for _ in range(workers)]
+        # the tunnel the workers share, closed by the last one to stop
+        self.tunnel = contextlib.ExitStack()
+        self.params = None
+        self.running = workers
+
+    def start(self) -> None:
+        for thread in self.threads:
+            thread.start()
+        for name in _fetchers:
+            self.load(name, False)
+
+    def stop(self) -> None:
+        for _ in self.threads:
+            self.pending.put(None)
+
+    def load(self, name: str, after_write: bool) -> None:
+        """
+        Queues a value to load. get() waits for the new value from now on.
+
+        :param after_write: Whether it must see the session's latest write.
+        """
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.values[name] = future
+        self.pending.put((name, future, after_write))
+
+    def refresh(self, *names: str) -> None:
+        """
+        Loads values again after the session wrote.
+        """
+        for name in names:
+            self.load(name, True)
+
+    def get(self, name: str):
+        """
+        A value, waiting up to self.wait for it if it is still loading. None
+        if loading failed or is taking longer.
+        """
+        with self.lock:
+            future = self.values.get(name)
+        if future == None:
+            return None
+        try:
+            with profiling.timed(profiling.DATABASE):
+                return future.result(timeout=self.wait)
+        except Exception:
+            return None
+
+    def connection_params(self) -> dict:
+        """
+        Opens the session's tunnel the first time a worker needs it.
+        """
+        with self.lock:
+            if self.params == None:
+                host, port = connections.open_tunnel(self.tunnel, self.credentials, quiet=True)
+                self.params = connections.connection_params(self.credentials, host, port)
+            return self.params
+
+    def worker(self) -> None:
+        """
+        Runs queued fetches on its own connection until it gets None.
+        """
+        try:
+            with contextlib.ExitStack() as stack:
+                conn = connections.open_user_database(stack, self.credentials, self.connection_params(), self.userid)
+                transactions.interactive(conn, self.credentials)
+                while True:
+                    work = self.pending.get()
+                    if work == None:
+                        return
+                    name, future, after_write = work
+                    try:
+                        if after_write and isinstance(conn, routing.Router):
+                            # only replicas that replayed the write serve the reads
+                            conn.note_write()
+                        future.set_result(_fetchers[name](conn, self.userid))
+                    except Exception as e:
+                        future.set_exception(e)
+        except Exception as e:
+            # couldn't connect, readers fall back to querying themselves
+            while True:
+                work = self.pending.get()
+                if work == None:
+                    return
+                work[1].set_exception(e)
+        finally:
+            with self.lock:
+                self.running -= 1
+                last = self.running == 0
+            if last:
+                self.tunnel.close()
+
+
+def start(credentials: dict, userid: int) -> None:
+    """
+    Starts prefetching everything registered for a user who just logged in.
+
+    :param credentials: The parsed credentials file, may set "prefetch_workers" and "prefetch_wait".
+    :param userid: The user.
+    """
+    workers = int(credentials.get("prefetch_workers", DEFAULT_WORKERS))
+    if workers <= 0:
+        return
+    session = Session(credentials, userid, workers, float(credentials.get("prefetch_wait", DEFAULT_WAIT)))
+    with _sessions_lock:
+        _sessions[userid] = session
+    session.start()
+
+
+def stop(userid: int) -> None:
+    """
+    Stops a user's prefetch workers and forgets their values.
+    """
+    with _sessions_lock:
+        session = _sessions.pop(userid, None)
+    if session != None:
+        session.stop()
+
+
+def get(userid: int, name: str):
+    """
+    A prefetched value, None if it isn't available (query it instead).
+    """
+    session = _sessions.get(userid)
+    if session == None:
+        return None
+    return session.get(name)
+
+
+def refresh(userid: int, *names: str) -> None:
+    """
+    Loads values again after the session's own writes, call it once the
+    write has committed.
+    """
+    session = _sessions.get(userid)
+    if session != None:
+        session.refresh(*names)
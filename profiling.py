@@ -0,0 +1,251 @@
+#!/bin/python3
+
+"""
+Client side profiling of the menu actions, turned on with
+sigmadb.py --profile [directory].
+
+Each action picked from the main menu (and logging in) runs under
+cProfile, and its wall time is split into:
+
+database: waiting in execute() for the server, the tunnel and the rows to
+    arrive (a plain cursor receives the whole result here), in copies, and
+    in reads gathered from shards or fetched by the prefetch workers
+fetch: fetchone/fetchmany/fetchall turning the received rows into Python
+    objects, plus the round trips of server-side cursors (streaming.py)
+client: everything else, i.e. the app's own Python such as formatting
+    rows for printing
+
+Time waiting at a prompt is left out of all of them. Only the main thread
+is counted, the prefetch workers' own queries run beside it. The CPU
+column is the main thread's CPU time, which includes psycopg2 decoding.
+
+Every action writes NNN-<action>.prof to the directory (read it with
+python -m pstats or snakeviz, prompts show up under
+input_utils.get_input_matching there), and at exit a summary table per
+action is printed and written to summary.txt.
+"""
+
+import collections
+import contextlib
+import cProfile
+import os
+import re
+import threading
+import time
+
+import psycopg2.extensions
+
+DEFAULT_DIRECTORY = "profiles"
+
+DATABASE = "database"
+FETCH = "fetch"
+INPUT = "input"
+
+SUMMARY_FILE = "summary.txt"
+
+# Where profiles go, None while profiling is off
+directory = None
+
+# The action being profiled, None between actions
+_current = None
+
+# Finished actions in the order they ran
+_runs = []
+
+
+class Run():
+    def __init__(self, name: str):
+        """
+        :param name: The menu action.
+        """
+        self.name = name
+        self.thread = threading.get_ident()
+        self.phases = collections.Counter()
+        self.queries = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.file = None
+
+    def client(self) -> float:
+        """
+        Wall time not spent on the database, fetching or at a prompt.
+        """
+        return self.wall - self.phases[DATABASE] - self.phases[FETCH]
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """
+    Cursor timing its queries and fetches into the running action.
+    """
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record(DATABASE, started, 1)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            record(DATABASE, started, 1)
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            record(DATABASE, started, 1)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            record(FETCH, started)
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size == None else size)
+        finally:
+            record(FETCH, started)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            record(FETCH, started)
+
+
+def start(profile_directory: str = DEFAULT_DIRECTORY) -> None:
+    """
+    Turns profiling on, call it before connecting.
+
+    :param profile_directory: Where the profiles and the summary are written.
+    """
+    global directory
+    os.makedirs(profile_directory, exist_ok=True)
+    directory = profile_directory
+
+
+def cursor_factory():
+    """
+    :return: The cursor_factory for psycopg2.connect, None while profiling is off.
+    """
+    if directory == None:
+        return None
+    return TimedCursor
+
+
+def record(phase: str, started: float, queries: int = 0) -> None:
+    """
+    Adds the time since started to a phase of the running action, if the
+    calling thread is the one running it.
+
+    :param phase: DATABASE, FETCH or INPUT.
+    :param started: time.perf_counter() when the phase began.
+    :param queries: Queries the time was spent on.
+    """
+    run = _current
+    if run == None or run.thread != threading.get_ident():
+        return
+    run.phases[phase] += time.perf_counter() - started
+    run.queries += queries
+
+
+@contextlib.contextmanager
+def timed(phase: str):
+    """
+    Counts the time inside the with block towards a phase, e.g. waiting on
+    reads running on other threads.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, started)
+
+
+@contextlib.contextmanager
+def action(name: str):
+    """
+    Profiles a menu action. Does nothing while profiling is off or inside
+    another action, which the time then counts towards.
+
+    :param name: The action, runs with the same name are summed up.
+    """
+    global _current
+    if directory == None or _current != None:
+        yield
+        return
+
+    run = Run(name)
+    profile = cProfile.Profile()
+    _current = run
+    started = time.perf_counter()
+    cpu_started = time.thread_time()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        run.cpu = time.thread_time() - cpu_started
+        # prompts don't count as the action's time
+        run.wall = time.perf_counter() - started - run.phases[INPUT]
+        _current = None
+
+        run.file = "%03d-%s.prof" % (len(_runs) + 1, re.sub("[^a-z0-9]+", "-", name.lower()).strip("-"))
+        profile.dump_stats(os.path.join(directory, run.file))
+        _runs.append(run)
+
+
+def summary() -> str:
+    """
+    :return: A table of the time spent per action, in seconds, with a total row.
+    """
+    groups = {}
+    for run in _runs:
+        groups.setdefault(run.name, []).append(run)
+    groups["total"] = _runs
+
+    totals = {}
+    for name, runs in groups.items():
+        totals[name] = (
+            len(runs),
+            sum(run.queries for run in runs),
+            sum(run.wall for run in runs),
+            sum(run.phases[DATABASE] for run in runs),
+            sum(run.phases[FETCH] for run in runs),
+            sum(run.client() for run in runs),
+            sum(run.cpu for run in runs),
+        )
+
+    width = max(len(key) for key in totals)
+    lines = ["%-*s %6s %8s %9s %9s %9s %9s %9s" % (width, "action", "runs", "queries", "wall", "database", "fetch", "client", "cpu")]
+    for key, (runs, queries, wall, database, fetch, client, cpu) in totals.items():
+        lines.append("%-*s %6d %8d %9.3f %9.3f %9.3f %9.3f %9.3f" % (width, key, runs, queries, wall, database, fetch, client, cpu))
+    return "\n".join(lines)
+
+
+def finish() -> None:
+    """
+    Prints the summary and writes it, with a line per run, to SUMMARY_FILE.
+    Does nothing while profiling is off or if nothing ran.
+    """
+    if directory == None or len(_runs) == 0:
+        return
+
+    table = summary()
+    print("\nTime per action (seconds, prompts excluded):")
+    print(table)
+
+    with open(os.path.join(directory, SUMMARY_FILE), "w") as summary_file:
+        summary_file.write(table + "\n\nRuns:\n")
+        for run in _runs:
+            summary_file.write("%s %s: wall %.3f, database %.3f, fetch %.3f, client %.3f, cpu %.3f, %d queries\n" % (
+                run.file, run.name, run.wall, run.phases[DATABASE], run.phases[FETCH], run.client(), run.cpu, run.queries))
+    print("Profiles written to %s" % directory)
@@ -0,0 +1,453 @@
+#!/bin/python3
+
+"""
+Routes reads to replicas and writes to the primary.
+
+Each function in movie_funcs and user_funcs is marked with read_only or
+read_write. When it is called with a Router instead of a plain connection,
+the decorator swaps in the connection the operation should use: writes
+always go to the primary, reads go to a streaming replica as long as the
+replica is within the staleness tolerance and has replayed everything the
+session itself has written (read-your-writes).
+
+Called with a plain connection the decorators do nothing, so the rest of the
+code does not need to know whether replicas are configured.
+
+With shards the connection is a ShardRouter instead: each user's rows live
+in one of several databases, and the decorators first pick the shard of
+the function's userid (or user_id) argument, then route within it as
+above. Functions without one run on the directory, shard 0. Operations
+that need more than one shard are marked scatter (reads combining every
+shard's rows with gather()) or cross_shard (writes to both users' shards),
+and get the ShardRouter itself. See shards.py for what lives where.
+"""
+
+import concurrent.futures
+import functools
+import inspect
+import threading
+import time
+
+import profiling
+
+# How far behind the primary (in seconds) a replica may be and still serve reads
+DEFAULT_MAX_STALENESS = 5.0
+
+# How long a replica's lag measurement is trusted before asking again
+DEFAULT_CHECK_INTERVAL = 1.0
+
+REPLICA_STATUS_QUERY = """
+SELECT
+    pg_last_wal_replay_lsn(),
+    CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+"""
+
+# Users without a row here live on shard 0
+SHARD_OF_QUERY = "SELECT shard FROM user_shard WHERE userid = %s"
+
+PLACE_USER_QUERY = """
+INSERT INTO user_shard (userid, shard) VALUES (%s, %s)
+ON CONFLICT (userid) DO UPDATE SET shard = EXCLUDED.shard
+"""
+
+# Parameter names the decorators take the user from
+USER_ARGUMENTS = ("userid", "user_id")
+
+
+def lsn_to_int(lsn: str) -> int:
+    """
+    Converts a WAL location in PostgreSQL's 'X/Y' text form to a comparable int.
+
+    :param lsn: The location as text.
+    :return: The location as an int.
+    """
+    high, low = lsn.split("/")
+    return (int(high, 16) << 32) | int(low, 16)
+
+
+class Replica():
+    def __init__(self, conn):
+        self.conn = conn
+        self.replay_lsn = -1
+        self.lag = None
+        self.checked_at = 0.0
+
+    def refresh(self) -> None:
+        """
+        Asks the replica how far along it is.
+        """
+        with self.conn.cursor() as curs:
+            curs.execute(REPLICA_STATUS_QUERY)
+            replay_lsn, lag = curs.fetchone()
+        self.conn.rollback()
+
+        self.checked_at = time.monotonic()
+        if replay_lsn == None:
+            # not a standby (or not replaying yet), never route reads here
+            self.replay_lsn = -1
+            self.lag = None
+        else:
+            self.replay_lsn = lsn_to_int(replay_lsn)
+            self.lag = float(lag) if lag != None else None
+
+
+class Router():
+    def __init__(self, primary, replicas: list, max_staleness: float = DEFAULT_MAX_STALENESS, check_interval: float = DEFAULT_CHECK_INTERVAL):
+        """
+        :param primary: Connection to the primary.
+        :param replicas: Connections to the replicas.
+        :param max_staleness: Maximum replica lag in seconds for serving reads.
+        :param check_interval: How long a lag measurement is reused, in seconds.
+        """
+        self.primary = primary
+        self.replicas = [Replica(conn) for conn in replicas]
+        self.max_staleness = max_staleness
+        self.check_interval = check_interval
+        # WAL location of this session's last write, reads must not go behind it
+        self.last_write_lsn = -1
+        self._next_replica = 0
+
+    def _usable(self, replica: Replica) -> bool:
+        if time.monotonic() - replica.checked_at > self.check_interval or replica.replay_lsn < self.last_write_lsn:
+            replica.refresh()
+
+        if replica.lag == None or replica.lag > self.max_staleness:
+            return False
+        return replica.replay_lsn >= self.last_write_lsn
+
+    def for_read(self):
+        """
+        Picks the connection a read-only operation should use.
+
+        Replicas are tried round robin, the primary is used when none of them
+        is fresh enough.
+
+        :return: A connection.
+        """
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[self._next_replica]
+            self._next_replica = (self._next_replica + 1) % len(self.replicas)
+            try:
+                if self._usable(replica):
+                    return replica.conn
+            except Exception:
+                # a broken replica should not take reads down with it
+                replica.lag = None
+                replica.checked_at = time.monotonic()
+
+        return self.primary
+
+    def for_write(self):
+        """
+        Picks the connection a read-write operation should use.
+
+        :return: The primary connection.
+        """
+        return self.primary
+
+    def note_write(self) -> None:
+        """
+        Records the primary's current WAL location so later reads only go to
+        replicas that have caught up to it.
+        """
+        with self.primary.cursor() as curs:
+            curs.execute("SELECT pg_current_wal_lsn()")
+            self.last_write_lsn = lsn_to_int(curs.fetchone()[0])
+        self.primary.commit()
+
+
+class ShardRouter():
+    def __init__(self, directory, shards: list):
+        """
+        :param directory: Connection or Router to the main database, shard 0. It also holds the accounts, the catalog and user_shard.
+        :param shards: Connections to shards 1 and up, in order.
+        """
+        self.shards = [directory] + list(shards)
+        # userid: shard, placements only change while a user is logged out,
+        # so a user's is looked up again when they log in (forget())
+        self.placements = {}
+        self.lock = threading.Lock()
+        self._pool = None
+
+    def shard_of(self, userid: int) -> int:
+        """
+        The shard a user's rows live on.
+        """
+        with self.lock:
+            shard = self.placements.get(userid)
+        if shard != None:
+            return shard
+
+        directory = primary_connection(self.shards[0])
+        with directory.cursor() as curs:
+            curs.execute(SHARD_OF_QUERY, (userid,))
+            row = curs.fetchone()
+        directory.commit()
+
+        shard = row[0] if row != None else 0
+        with self.lock:
+            self.placements[userid] = shard
+        return shard
+
+    def forget(self, userid: int = None) -> None:
+        """
+        Drops a cached placement, so the next shard_of() reads user_shard again.
+
+        :param userid: The user, leave None to drop every placement.
+        """
+        with self.lock:
+            if userid == None:
+                self.placements.clear()
+            else:
+                self.placements.pop(userid, None)
+
+    def for_user(self, userid: int):
+        """
+        The connection or Router of a user's shard, the directory for None.
+        """
+        if userid == None:
+            return self.shards[0]
+        return self.shards[self.shard_of(userid)]
+
+    def place(self, userid: int, shard: int = None) -> int:
+        """
+        Records which shard a user lives on. New users are spread by id.
+
+        :param userid: The user.
+        :param shard: The shard, leave None to pick one from the id.
+        :return: The shard.
+        """
+        if shard == None:
+            shard = userid % len(self.shards)
+        directory = primary_connection(self.shards[0])
+        with directory.cursor() as curs:
+            curs.execute(PLACE_USER_QUERY, (userid, shard))
+        directory.commit()
+        with self.lock:
+            self.placements[userid] = shard
+        return shard
+
+    def _read_shard(self, shard, query: str, args) -> list[tuple]:
+        target = shard.for_read() if isinstance(shard, Router) else shard
+        try:
+            with target.cursor() as curs:
+                curs.execute(query, args)
+                return curs.fetchall()
+        finally:
+            target.rollback()
+
+    def gather(self, query: str, args=()) -> list[tuple]:
+        """
+        Runs a read on every shard at once.
+
+        :return: Every shard's rows, shard 0's first.
+        """
+        if self._pool == None:
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.shards))
+        futures = [self._pool.submit(self._read_shard, shard, query, args) for shard in self.shards]
+        with profiling.timed(profiling.DATABASE):
+            return [row for future in futures for row in future.result()]
+
+    def close(self) -> None:
+        """
+        Stops gather()'s threads. The connections are closed by whoever opened them.
+        """
+        if self._pool != None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+def primary_connection(conn):
+    """
+    The primary behind a connection or Router, for tools that need to write
+    or run long transactions outside of the decorated operations.
+
+    :param conn: A connection, Router or ShardRouter (its directory).
+    :return: A connection to the primary.
+    """
+    if isinstance(conn, ShardRouter):
+        return primary_connection(conn.shards[0])
+    if isinstance(conn, Router):
+        return conn.primary
+    return conn
+
+
+def all_connections(conn) -> list:
+    """
+    Every connection behind a connection, Router or ShardRouter, primary
+    (and directory) first.
+
+    :param conn: A connection, Router or ShardRouter.
+    """
+    if isinstance(conn, ShardRouter):
+        return [connection for shard in conn.shards for connection in all_connections(shard)]
+    if isinstance(conn, Router):
+        return [conn.primary] + [replica.conn for replica in conn.replicas]
+    return [conn]
+
+
+def shard_primaries(conn) -> list:
+    """
+    The primary of every shard, for jobs that maintain each one.
+
+    :param conn: A connection, Router or ShardRouter.
+    """
+    if isinstance(conn, ShardRouter):
+        return [primary_connection(shard) for shard in conn.shards]
+    return [primary_connection(conn)]
+
+
+def forget_placement(conn, userid: int) -> None:
+    """
+    Makes a ShardRouter look up a user's shard again, e.g. when they log in
+    after being moved. Does nothing without shards.
+    """
+    if isinstance(conn, ShardRouter):
+        conn.forget(userid)
+
+
+def connection_for(conn, userid: int = None):
+    """
+    The primary of a user's shard (the directory for None), for operations
+    marked scatter or cross_shard. Anything but a ShardRouter is returned as
+    is, the decorator has already picked it.
+    """
+    if isinstance(conn, ShardRouter):
+        return primary_connection(conn.for_user(userid))
+    return conn
+
+
+def connections_for(conn, userids: list[int]) -> list:
+    """
+    The primaries of the shards some users live on, each once.
+    """
+    if isinstance(conn, ShardRouter):
+        return [primary_connection(conn.shards[shard]) for shard in sorted(set(conn.shard_of(userid) for userid in userids))]
+    return [conn]
+
+
+def gather(conn, query: str, args=()) -> list[tuple]:
+    """
+    Runs a read on every shard and returns all their rows together, or on
+    the connection alone without shards. Each read ends its transaction,
+    so don't call it inside one.
+
+    :param conn: A connection or ShardRouter.
+    :param query: The query.
+    :param args: Arguments for the query's placeholders.
+    """
+    if isinstance(conn, ShardRouter):
+        return conn.gather(query, args)
+    try:
+        with conn.cursor() as curs:
+            curs.execute(query, args)
+            return curs.fetchall()
+    finally:
+        conn.rollback()
+
+
+def _user_argument(func) -> tuple[int, str]:
+    """
+    Where a function takes its user: (index after the connection, name), None if it doesn't.
+    """
+    names = list(inspect.signature(func).parameters)[1:]
+    for index, name in enumerate(names):
+        if name in USER_ARGUMENTS:
+            return (index, name)
+    return None
+
+
+def _shard_for_call(conn, user: tuple[int, str], args: tuple, kwargs: dict):
+    """
+    The connection or Router of the shard a call's user lives on.
+    """
+    if not isinstance(conn, ShardRouter):
+        return conn
+    userid = None
+    if user != None:
+        index, name = user
+        userid = args[index] if index < len(args) else kwargs.get(name)
+    return conn.for_user(userid)
+
+
+def read_only(func):
+    """
+    Marks an operation that never writes, it may be served by a replica.
+    """
+    user = _user_argument(func)
+
+    @functools.wraps(func)
+    def wrapper(conn, *args, **kwargs):
+        conn = _shard_for_call(conn, user, args, kwargs)
+        if not isinstance(conn, Router):
+            return func(conn, *args, **kwargs)
+
+        target = conn.for_read()
+        try:
+            return func(target, *args, **kwargs)
+        finally:
+            # don't hold a snapshot open on the replica between operations
+            target.rollback()
+
+    return wrapper
+
+
+def read_write(func):
+    """
+    Marks an operation that may write, it always runs on the primary.
+    """
+    user = _user_argument(func)
+
+    @functools.wraps(func)
+    def wrapper(conn, *args, **kwargs):
+        conn = _shard_for_call(conn, user, args, kwargs)
+        if not isinstance(conn, Router):
+            return func(conn, *args, **kwargs)
+
+        result = func(conn.for_write(), *args, **kwargs)
+        conn.note_write()
+        return result
+
+    return wrapper
+
+
+def scatter(func):
+    """
+    Marks a read that needs every shard. With a ShardRouter it gets the
+    router itself and reads with gather() and connection_for(), otherwise
+    it runs like read_only.
+    """
+    local = read_only(func)
+
+    @functools.wraps(func)
+    def wrapper(conn, *args, **kwargs):
+        if not isinstance(conn, ShardRouter):
+            return local(conn, *args, **kwargs)
+        return func(conn, *args, **kwargs)
+
+    return wrapper
+
+
+def cross_shard(func):
+    """
+    Marks an operation that may write to more than one user's shard. With a
+    ShardRouter it gets the router itself and picks primaries with
+    connection_for() and connections_for(), otherwise it runs like
+    read_write.
+    """
+    local = read_write(func)
+
+    @functools.wraps(func)
+    def wrapper(conn, *args, **kwargs):
+        if not isinstance(conn, ShardRouter):
+            return local(conn, *args, **kwargs)
+        result = func(conn, *args, **kwargs)
+        for shard in conn.shards:
+            if isinstance(shard, Router):
+                shard.note_write()
+        return result
+
+    return wrapper
@@ -0,0 +1,210 @@
+#!/bin/python3
+
+"""
+Versioned schema and index migrations.
+
+Every migration has a version number and runs at most once per database,
+in its own transaction. The versions applied so far are recorded in the
+schema_version table. Add new migrations to the end of MIGRATIONS, never
+edit one that has already shipped.
+
+usage: schema.py [status|migrate]
+"""
+
+import sys
+
+import feed
+import movie_cache
+import partitions
+import routing
+import shards
+import viewer_sketches
+
+
+class Index():
+    def __init__(self, name: str, table: str, definition: str):
+        """
+        :param name: Name of the index.
+        :param table: Table (quoted if needed) the index is on.
+        :param definition: Everything after the table name, e.g. '(movieid)' or 'USING gin (...)'.
+        """
+        self.name = name
+        self.table = table
+        self.definition = definition
+
+    def create_sql(self) -> str:
+        return "CREATE INDEX IF NOT EXISTS {} ON {} {}".format(self.name, self.table, self.definition)
+
+    def drop_sql(self) -> str:
+        return "DROP INDEX IF EXISTS {}".format(self.name)
+
+
+class Migration():
+    def __init__(self, version: int, description: str, steps: list):
+        """
+        :param version: Version the schema is at after this migration.
+        :param description: What the migration does.
+        :param steps: SQL strings, or functions taking a cursor, run in order.
+        """
+        self.version = version
+        self.description = description
+        self.steps = steps
+
+
+# Indexes for every access path in movie_funcs and user_funcs. The trigram
+# indexes serve the LOWER(...) LIKE '%...%' name searches.
+INDEXES = [
+    # browse_movies
+    Index("movie_title_trgm_idx", "movie", "USING gin (LOWER(title) gin_trgm_ops)"),
+    Index("movierelease_movieid_releasedate_idx", "movierelease", "(movieid, releasedate)"),
+    Index("movierelease_releasedate_idx", "movierelease", "(releasedate)"),
+    Index("moviegenre_movieid_idx", "moviegenre", "(movieid)"),
+    Index("moviegenre_genreid_idx", "moviegenre", "(genreid)"),
+    Index("genre_genrename_trgm_idx", "genre", "USING gin (LOWER(genrename) gin_trgm_ops)"),
+    Index("actsin_movieid_idx", "actsin", "(movieid)"),
+    Index("actsin_crewid_idx", "actsin", "(crewid)"),
+    Index("directed_movieid_idx", "directed", "(movieid)"),
+    Index("crewmember_firstname_trgm_idx", "crewmember", "USING gin (LOWER(firstname) gin_trgm_ops)"),
+    Index("crewmember_lastname_trgm_idx", "crewmember", "USING gin (LOWER(lastname) gin_trgm_ops)"),
+    Index("produced_movieid_idx", "produced", "(movieid)"),
+    Index("produced_studioid_idx", "produced", "(studioid)"),
+    Index("studio_name_trgm_idx", "studio", "USING gin (LOWER(name) gin_trgm_ops)"),
+    Index("rated_movieid_idx", "rated", "(movieid) INCLUDE (rating)"),
+    # rate_movie and view_profile
+    Index("rated_userid_rating_idx", "rated", "(userid, rating DESC, movieid)"),
+    # leaderboards and recommendations
+    Index("watched_datetime_idx", "watched", "(datetime)"),
+    Index("watched_userid_movieid_idx", "watched", "(userid, movieid)"),
+    Index("watched_movieid_userid_idx", "watched", "(movieid, userid)"),
+    # following
+    Index("following_followingid_idx", "following", "(followingid, followerid)"),
+    Index("following_followerid_idx", "following", "(followerid, followingid)"),
+    # login and account creation
+    Index("user_username_idx", "\"user\"", "(username)"),
+    Index("user_email_idx", "\"user\"", "(email)"),
+    # collections
+    Index("incollection_collectionid_idx", "incollection", "(collectionid, movieid)"),
+    Index("moviecollection_madeby_idx", "moviecollection", "(madeby, name)"),
+]
+
+MIGRATIONS = [
+    Migration(1, "Indexes for the browse, rating, leaderboard, following, login and collection queries",
+              ["CREATE EXTENSION IF NOT EXISTS pg_trgm"] + [index.create_sql() for index in INDEXES] + [
+               "ANALYZE movie, movierelease, moviegenre, genre, actsin, directed, crewmember, produced, studio, rated, watched, following, \"user\", incollection, moviecollection"]),
+    Migration(2, "Partition watched by month and add the watch rollup tables",
+              partitions.CREATE_ROLLUP_TABLES + [partitions.partition_watched] +
+              [index.create_sql() for index in INDEXES if index.table == "watched"] + ["ANALYZE watched"]),
+    # filled in by similarity.py
+    Migration(3, "Add the movie_similar neighbour table", ["""
+        CREATE TABLE IF NOT EXISTS movie_similar (
+            movieid integer NOT NULL,
+            rank smallint NOT NULL,
+            similarid integer NOT NULL,
+            score real NOT NULL,
+            PRIMARY KEY (movieid, rank)
+        )
+        """]),
+    # until now watched_user_movie_rollup only held expired months, add the
+    # retained events and keep it current from here on
+    Migration(4, "Maintain watched_user_movie_rollup on every watch",
+              ["LOCK TABLE watched IN SHARE MODE", partitions.ROLLUP_USER_MOVIE.format("watched")] +
+              partitions.CREATE_ROLLUP_TRIGGER + ["ANALYZE watched_user_movie_rollup"]),
+    Migration(5, "Notify movie_cache listeners when a movie changes", movie_cache.CREATE_INVALIDATION_TRIGGERS),
+    Migration(6, "Add the activity feed tables", feed.CREATE_FEED_TABLES),
+    Migration(7, "Sketch unique viewers per movie by day and for all time", viewer_sketches.BYTE_MIGRATION_STEPS),
+    Migration(8, "Add the shard tables and activity ids unique across shards", shards.CREATE_SHARD_TABLES + feed.CREATE_GLOBAL_ACTIVITY_IDS),
+    Migration(9, "Store viewer sketches as rank bits so they merge with bit_or", viewer_sketches.MIGRATION_STEPS),
+]
+
+
+def current_version(conn) -> int:
+    """
+    The version the database's schema is at, 0 if no migration has run.
+
+    :param conn: Connection to the database.
+    """
+    with conn.cursor() as curs:
+        curs.execute("SELECT to_regclass('schema_version')")
+        if curs.fetchone()[0] == None:
+            version = 0
+        else:
+            curs.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+            version = curs.fetchone()[0]
+    conn.commit()
+    return version
+
+
+def migrate(conn, target: int = None) -> list[Migration]:
+    """
+    Applies every migration the database hasn't had yet, each in its own
+    transaction.
+
+    :param conn: Connection to the primary.
+    :param target: Stop at this version. Leave None to apply everything.
+    :return: The migrations that were applied.
+    """
+    with conn.cursor() as curs:
+        curs.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version integer PRIMARY KEY,
+                description text NOT NULL,
+                applied timestamp NOT NULL DEFAULT now()
+            )
+            """)
+    conn.commit()
+
+    version = current_version(conn)
+    applied = []
+    for migration in MIGRATIONS:
+        if migration.version <= version or (target != None and migration.version > target):
+            continue
+
+        with conn.cursor() as curs:
+            # only one migrator at a time
+            curs.execute("LOCK TABLE schema_version IN EXCLUSIVE MODE")
+            curs.execute("SELECT 1 FROM schema_version WHERE version = %s", (migration.version,))
+            if curs.fetchone() != None:
+                conn.rollback()
+                continue
+
+            for step in migration.steps:
+                if callable(step):
+                    step(curs)
+                else:
+                    curs.execute(step)
+            curs.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)", (migration.version, migration.description))
+        conn.commit()
+        applied.append(migration)
+
+    return applied
+
+
+def main() -> int:
+    """
+    Shows or brings the schema up to date from the command line.
+
+    :return: 0 on success
+    """
+    import sigmadb
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "status"
+    if command not in ["status", "migrate"]:
+        print(__doc__)
+        return 1
+
+    credentials = sigmadb.load_credentials()
+    if credentials == None:
+        return 1
+
+    with sigmadb.connect(credentials) as conn:
+        conn = routing.primary_connection(conn)
+        if command == "migrate":
+            for migration in migrate(conn):
+                print("Applied %d: %s" % (migration.version, migration.description))
+        version = current_version(conn)
+        print("Schema is at version %d of %d" % (version, MIGRATIONS[-1].version))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,271 @@
+#!/bin/python3
+
+"""
+Composable movie searches.
+
+A MovieSearch collects any number of filters and compiles them into one
+statement. Filters on the movie itself become WHERE conditions, filters on
+linked tables (releases, genres, cast, directors, studios, ratings) become
+joins against small derived tables of matching movie ids, so each one can
+be answered from its own index. The filtering, ordering and LIMIT all
+happen before the display columns (genres, crew, average rating, ...) are
+computed, so those correlated lookups only run for the rows shown.
+
+    query, args = search.MovieSearch().title("star").year(1977).genres(["sci"]).compile(["title ASC"])
+
+Each filter is also kept in criteria as (method name, arguments), which is
+how catalog_snapshot.py answers the same search from its local copy.
+"""
+
+import datetime
+
+# The facts about a movie in m, what movie_cache keeps
+MOVIE_COLUMNS = """
+    movieid, title, length, mpaarating,
+    (
+        SELECT
+            MIN(releasedate)
+        FROM
+            "movierelease"
+        WHERE
+            movierelease.movieid = m.movieid
+    ) AS first_release,
+    (
+        SELECT
+            STRING_AGG(g.genrename, ', ' ORDER BY g.genrename)
+        FROM
+            "genre" AS g
+        JOIN
+            "moviegenre" AS mg ON (mg.genreid = g.genreid)
+        WHERE
+            mg.movieid = m.movieid
+    ) as genres,
+    (
+        SELECT
+            STRING_AGG(CONCAT(c.firstname, ' ', c.lastname), ', ' ORDER BY CONCAT(c.firstname, ' ', c.lastname))
+        FROM
+            "crewmember" AS c
+        JOIN
+            "actsin" AS a ON (a.crewid = c.crewid)
+        WHERE
+            a.movieid = m.movieid
+    ) AS crew,
+    (
+        SELECT
+            STRING_AGG(CONCAT(c.firstname, ' ', c.lastname), ', ' ORDER BY CONCAT(c.firstname, ' ', c.lastname))
+        FROM
+            "crewmember" AS c
+        JOIN
+            "directed" AS d ON (d.crewid = c.crewid)
+        WHERE
+            d.movieid = m.movieid
+    ) AS directors,
+    (
+        SELECT
+            STRING_AGG(s.name, ', ' ORDER BY s.name)
+        FROM
+            "studio" AS s
+        JOIN
+            "produced" AS p ON (p.studioid = s.studioid)
+        WHERE
+            p.movieid = m.movieid
+    ) AS studios
+"""
+
+# Everything browse_movies prints, computed per movie in m. Unique viewers
+# are approximate and all time (see viewer_sketches.py).
+BROWSE_COLUMNS = MOVIE_COLUMNS.rstrip() + """,
+    (
+        SELECT
+            AVG(rating)
+        FROM
+            "rated"
+        WHERE
+            rated.movieid = m.movieid
+    ) AS avg_rating,
+    (
+        SELECT
+            hll_estimate(registers)
+        FROM
+            "watched_movie_viewers"
+        WHERE
+            watched_movie_viewers.movieid = m.movieid
+    ) AS unique_viewers
+"""
+
+# Expressions for the columns a search can be ordered by, evaluated before
+# the LIMIT (title is a plain column)
+SORT_KEYS = {
+    "title": "m.title",
+    "first_release": "(SELECT MIN(releasedate) FROM \"movierelease\" WHERE movierelease.movieid = m.movieid)",
+    "genres": "(SELECT STRING_AGG(g.genrename, ', ' ORDER BY g.genrename) FROM \"genre\" AS g JOIN \"moviegenre\" AS mg ON (mg.genreid = g.genreid) WHERE mg.movieid = m.movieid)",
+    "studios": "(SELECT STRING_AGG(s.name, ', ' ORDER BY s.name) FROM \"studio\" AS s JOIN \"produced\" AS p ON (p.studioid = s.studioid) WHERE p.movieid = m.movieid)",
+}
+
+# Rows returned when a search doesn't set its own limit
+DEFAULT_LIMIT = 100
+
+
+class MovieSearch():
+    def __init__(self):
+        """
+        A search matching every movie, add filters to narrow it down.
+        Every filter must match, and each method returns the search so
+        calls can be chained.
+        """
+        self.conditions = []
+        self.condition_args = []
+        self.joins = []
+        self.join_args = []
+        self.criteria = []
+        self.limit = DEFAULT_LIMIT
+
+    def join_filter(self, query: str, args: list) -> 'MovieSearch':
+        """
+        Keeps the movies whose id is returned by a query. Not added to
+        criteria, the filters below are.
+
+        :param query: Query returning distinct movieid values.
+        :param args: Arguments for the query.
+        """
+        self.joins.append("JOIN ({}) AS f{} ON (f{}.movieid = m.movieid)".format(query, len(self.joins), len(self.joins)))
+        self.join_args.extend(args)
+        return self
+
+    def title(self, text: str) -> 'MovieSearch':
+        """
+        Titles containing some text, ignoring case.
+        """
+        self.criteria.append(("title", (text,)))
+        self.conditions.append("LOWER(m.title) LIKE LOWER(%s)")
+        self.condition_args.append("%{}%".format(text))
+        return self
+
+    def released_between(self, first: datetime.date, last: datetime.date) -> 'MovieSearch':
+        """
+        Movies with a release between two dates (inclusive). Pass the same
+        date twice for one day.
+        """
+        self.criteria.append(("released_between", (first, last)))
+        return self.join_filter("SELECT DISTINCT mr.movieid FROM \"movierelease\" AS mr WHERE mr.releasedate BETWEEN %s AND %s", [first, last])
+
+    def year(self, year: int) -> 'MovieSearch':
+        """
+        Movies with a release in a year.
+        """
+        return self.released_between(datetime.date(year, 1, 1), datetime.date(year, 12, 31))
+
+    def genres(self, names: list[str]) -> 'MovieSearch':
+        """
+        Movies in any of the genres (names are matched like titles). Call
+        again for movies that must also be in another genre.
+        """
+        self.criteria.append(("genres", (list(names),)))
+        return self.join_filter("""
+            SELECT DISTINCT mg.movieid
+            FROM "moviegenre" AS mg
+            JOIN "genre" AS g ON (g.genreid = mg.genreid)
+            WHERE LOWER(g.genrename) LIKE ANY(%s)
+            """, [["%{}%".format(name.lower()) for name in names]])
+
+    def cast(self, first_name: str, last_name: str) -> 'MovieSearch':
+        """
+        Movies with a cast member whose names contain the given text.
+        """
+        self.criteria.append(("cast", (first_name, last_name)))
+        return self.join_filter("""
+            SELECT DISTINCT a.movieid
+            FROM "actsin" AS a
+            JOIN "crewmember" AS c ON (c.crewid = a.crewid)
+            WHERE LOWER(c.firstname) LIKE LOWER(%s) AND LOWER(c.lastname) LIKE LOWER(%s)
+            """, ["%{}%".format(first_name), "%{}%".format(last_name)])
+
+    def director(self, first_name: str, last_name: str) -> 'MovieSearch':
+        """
+        Movies with a director whose names contain the given text.
+        """
+        self.criteria.append(("director", (first_name, last_name)))
+        return self.join_filter("""
+            SELECT DISTINCT d.movieid
+            FROM "directed" AS d
+            JOIN "crewmember" AS c ON (c.crewid = d.crewid)
+            WHERE LOWER(c.firstname) LIKE LOWER(%s) AND LOWER(c.lastname) LIKE LOWER(%s)
+            """, ["%{}%".format(first_name), "%{}%".format(last_name)])
+
+    def studio(self, name: str) -> 'MovieSearch':
+        """
+        Movies produced by a studio whose name contains the given text.
+        """
+        self.criteria.append(("studio", (name,)))
+        return self.join_filter("""
+            SELECT DISTINCT p.movieid
+            FROM "produced" AS p
+            JOIN "studio" AS s ON (s.studioid = p.studioid)
+            WHERE LOWER(s.name) LIKE LOWER(%s)
+            """, ["%{}%".format(name)])
+
+    def mpaa(self, ratings: list[str]) -> 'MovieSearch':
+        """
+        Movies with any of the MPAA ratings (e.g. ['PG', 'PG-13']).
+        """
+        self.criteria.append(("mpaa", (list(ratings),)))
+        self.conditions.append("UPPER(m.mpaarating) = ANY(%s)")
+        self.condition_args.append([rating.upper() for rating in ratings])
+        return self
+
+    def runtime(self, shortest: int = None, longest: int = None) -> 'MovieSearch':
+        """
+        Movies running between two lengths in minutes (inclusive), leave
+        either None for no bound.
+        """
+        self.criteria.append(("runtime", (shortest, longest)))
+        if shortest != None:
+            self.conditions.append("m.length >= %s")
+            self.condition_args.append(shortest)
+        if longest != None:
+            self.conditions.append("m.length <= %s")
+            self.condition_args.append(longest)
+        return self
+
+    def min_rating(self, rating: float) -> 'MovieSearch':
+        """
+        Movies whose average user rating is at least some value.
+        """
+        self.criteria.append(("min_rating", (rating,)))
+        return self.join_filter("SELECT r.movieid FROM \"rated\" AS r GROUP BY r.movieid HAVING AVG(r.rating) >= %s", [rating])
+
+    def limited_to(self, limit: int) -> 'MovieSearch':
+        """
+        Returns at most this many rows, None for all of them.
+        """
+        self.limit = limit
+        return self
+
+    def compile(self, order: list[str] = []) -> tuple[str, list]:
+        """
+        Builds the statement.
+
+        :param order: ORDER BY terms such as 'title ASC', on the columns in SORT_KEYS.
+        :return: (query, args) giving rows shaped like movie_funcs.print_movie expects, with unique viewers.
+        """
+        sort_columns = []
+        for term in order:
+            key = term.split()[0]
+            if key not in SORT_KEYS:
+                raise ValueError("Can't sort by '%s'" % key)
+            if key != "title":
+                sort_columns.append("{} AS {}".format(SORT_KEYS[key], key))
+        # movieid last so ties don't change which rows make the limit
+        order_by = " ORDER BY " + ", ".join(list(order) + ["movieid"])
+
+        inner = "SELECT " + ", ".join(["m.movieid", "m.title", "m.length", "m.mpaarating"] + sort_columns)
+        inner += " FROM \"movie\" AS m " + " ".join(self.joins)
+        if len(self.conditions) > 0:
+            inner += " WHERE " + " AND ".join(self.conditions)
+        inner += order_by
+        args = self.join_args + self.condition_args
+        if self.limit != None:
+            inner += " LIMIT %s"
+            args = args + [self.limit]
+
+        return "SELECT" + BROWSE_COLUMNS + "FROM (" + inner + ") AS m" + order_by, args
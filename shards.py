@@ -0,0 +1,486 @@
+#!/bin/python3
+
+"""
+User-keyed sharding across several PostgreSQL databases.
+
+All of a user's rows (watches, ratings, collections, feed events and what
+is derived from them) live in one database, their shard, so writes spread
+over as many primaries as there are shards. The database in the
+credentials is the directory and also shard 0. "shards" in credentials.json
+lists the others, each a dict of connection parameters overriding the
+directory's (like "replicas"), shard n being entry n - 1.
+
+Where things live:
+
+user_shard: which shard each user is on, in the directory only. Users
+    without a row are on shard 0, so an unsharded database needs no
+    migration. New accounts are spread by userid.
+"user" and the catalog (REPLICATED_TABLES): written to the directory and
+    copied to every shard by sync, so any shard can show a movie or a
+    username. New accounts are copied as they are created, and the
+    maintenance daemon syncs movie_similar after rebuilding it.
+following: each edge is kept on both users' shards, so followers and
+    followed users, the feed's fan out and the profile counts are answered
+    by one shard.
+
+routing.ShardRouter sends each operation to its user's shard. The
+leaderboards, the activity feed and browsing's average ratings and unique
+viewers are gathered from every shard (see movie_funcs.ranking and
+sketch_ranking, feed.page and movie_funcs.gather_browse_columns). The
+minimum rating filter and the "for you" co-viewers only see the shard they
+run on, the directory and the user's own shard. export.py reads each user from their shard. Tools other
+than the app, loadgen, maintenance, export and this one work on the
+directory alone, and async_db refuses to start with shards.
+
+status: users and schema version per shard
+migrate: bring every shard's schema up to date, and tell each its number
+sync: copy the accounts and the catalog from the directory to every shard
+move <userid> <shard>: move one user's rows to another shard
+rebalance [dry-run]: move idle users until every shard has about as many
+
+Move users while they are logged out, a running session keeps using the
+shard it looked up at login. rebalance only picks users who haven't logged
+in for IDLE_BEFORE_MOVE. A moved user's viewers stay in the old shard's
+unique viewer sketches as well, but the leaderboards and browsing OR the
+shards' sketches together (bit_or merges are idempotent), so they are
+still counted once.
+
+usage: shards.py [status|migrate|sync|move <userid> <shard>|rebalance [dry-run]]
+"""
+
+import sys
+import tempfile
+
+import routing
+import transactions
+
+CREATE_SHARD_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS user_shard (
+        userid integer PRIMARY KEY,
+        shard integer NOT NULL
+    )
+    """,
+    # one row, the database's own shard number
+    """
+    CREATE TABLE IF NOT EXISTS shard_identity (
+        shard integer PRIMARY KEY
+    )
+    """,
+]
+
+# Copied to every shard by sync, parents before the tables referencing them
+REPLICATED_TABLES = ["\"user\"", "genre", "studio", "crewmember", "movie", "movierelease", "moviegenre", "actsin", "directed", "produced", "movie_similar"]
+
+# Rows larger than this are spooled to disk while copied between databases
+SPOOL_BYTES = 16 * 1024 * 1024
+
+# Users who logged in more recently than this are never rebalanced
+IDLE_BEFORE_MOVE = "1 hour"
+
+TABLE_COLUMNS_QUERY = """
+SELECT quote_ident(attname)
+FROM pg_attribute
+WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+ORDER BY attnum
+"""
+
+PRIMARY_KEY_QUERY = """
+SELECT quote_ident(a.attname)
+FROM pg_index AS i
+JOIN pg_attribute AS a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+WHERE i.indrelid = %s::regclass AND i.indisprimary
+ORDER BY array_position(i.indkey::int2[], a.attnum)
+"""
+
+SHARDS_OF_QUERY = """
+SELECT u.userid, COALESCE(s.shard, 0)
+FROM unnest(%s::integer[]) AS u(userid)
+LEFT JOIN user_shard AS s ON s.userid = u.userid
+"""
+
+USERS_PER_SHARD_QUERY = """
+SELECT COALESCE(s.shard, 0), COUNT(*)
+FROM "user" AS u
+LEFT JOIN user_shard AS s ON s.userid = u.userid
+GROUP BY 1
+"""
+
+# Least recently active first, they are the least likely to be in a session
+MOVABLE_USERS_QUERY = """
+SELECT u.userid
+FROM "user" AS u
+LEFT JOIN user_shard AS s ON s.userid = u.userid
+WHERE COALESCE(s.shard, 0) = %s AND u.lastaccessdate < now() - %s::interval
+ORDER BY u.lastaccessdate, u.userid
+LIMIT %s
+"""
+
+# A user's rows in each sharded table, in the order they are copied
+# (deleted in reverse). Collections are copied by move_collections.
+USER_ROWS = [
+    ("rated", "userid = %(userid)s"),
+    ("watched", "userid = %(userid)s"),
+    # the rollup holds expired months too, it replaces what watched's trigger built
+    ("watched_user_movie_rollup", "userid = %(userid)s"),
+    ("activity", "userid = %(userid)s"),
+    # timelines are kept on the author's shard
+    ("feed_timeline", "actorid = %(userid)s"),
+    ("feed_pull_author", "userid = %(userid)s"),
+]
+
+USER_EDGES = "followerid = %(userid)s OR followingid = %(userid)s"
+
+
+def table_columns(conn, table: str) -> list[str]:
+    with conn.cursor() as curs:
+        curs.execute(TABLE_COLUMNS_QUERY, (table,))
+        return [column for (column,) in curs.fetchall()]
+
+
+def primary_key(conn, table: str) -> list[str]:
+    with conn.cursor() as curs:
+        curs.execute(PRIMARY_KEY_QUERY, (table,))
+        return [column for (column,) in curs.fetchall()]
+
+
+def copy_rows(source, destination, query: str, args, table: str, columns: list[str]) -> None:
+    """
+    Copies a query's rows from one database into a table of another with
+    COPY, spooled through a temporary file.
+
+    :param source: Connection the query runs on.
+    :param destination: Connection the rows are loaded on.
+    :param query: Query returning the columns, in order.
+    :param args: Arguments for the query's placeholders.
+    :param table: Table (quoted if needed) loaded.
+    :param columns: Columns (quoted if needed) loaded.
+    """
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES) as buffer:
+        with source.cursor() as curs:
+            bound = curs.mogrify(query, args).decode()
+            curs.copy_expert("COPY ({}) TO STDOUT".format(bound), buffer)
+        buffer.seek(0)
+        with destination.cursor() as curs:
+            curs.copy_expert("COPY {} ({}) FROM STDIN".format(table, ", ".join(columns)), buffer)
+
+
+def shards_of(conn, userids: list[int]) -> dict:
+    """
+    The shard of each of some users, in one query.
+
+    :param conn: Connection to the directory.
+    :return: Shard by userid.
+    """
+    with conn.cursor() as curs:
+        curs.execute(SHARDS_OF_QUERY, (list(userids),))
+        return dict(curs.fetchall())
+
+
+def add_account(conn, userid: int) -> None:
+    """
+    Places a new account on a shard and copies it to every shard. Call it
+    once the account has committed in the directory.
+
+    :param conn: Connection or ShardRouter, nothing happens without shards.
+    :param userid: The new account.
+    """
+    if not isinstance(conn, routing.ShardRouter):
+        return
+    conn.place(userid)
+    directory = routing.primary_connection(conn)
+    columns = table_columns(directory, "\"user\"")
+    for shard in routing.shard_primaries(conn)[1:]:
+        with transactions.transaction(shard):
+            copy_rows(directory, shard, "SELECT {} FROM \"user\" WHERE userid = %s".format(", ".join(columns)), (userid,), "\"user\"", columns)
+    directory.commit()
+
+
+def sync_shard(directory, shard, tables: list[str] = REPLICATED_TABLES) -> int:
+    """
+    Makes a shard's copies of REPLICATED_TABLES match the directory's, in
+    one transaction. Rows that haven't changed aren't touched.
+
+    :param directory: Connection to the directory, inside a read-only transaction.
+    :param shard: Connection to the shard, not inside a transaction.
+    :param tables: The tables to copy, in REPLICATED_TABLES' order.
+    :return: Rows inserted, updated or deleted.
+    """
+    changed = 0
+    with transactions.transaction(shard):
+        keys = {}
+        for index, table in enumerate(tables):
+            columns = table_columns(shard, table)
+            keys[table] = primary_key(shard, table)
+            incoming = "sync_%d" % index
+            with shard.cursor() as curs:
+                curs.execute("CREATE TEMPORARY TABLE {} (LIKE {}) ON COMMIT DROP".format(incoming, table))
+            copy_rows(directory, shard, "SELECT {} FROM {}".format(", ".join(columns), table), (), incoming, columns)
+
+            column_list = ", ".join(columns)
+            key_list = ", ".join(keys[table])
+            others = [column for column in columns if column not in keys[table]]
+            if len(keys[table]) == 0:
+                upsert = "INSERT INTO {0} ({1}) SELECT {1} FROM {2} EXCEPT SELECT {1} FROM {0}".format(table, column_list, incoming)
+            elif len(others) == 0:
+                upsert = "INSERT INTO {0} ({1}) SELECT {1} FROM {2} ON CONFLICT ({3}) DO NOTHING".format(table, column_list, incoming, key_list)
+            else:
+                upsert = "INSERT INTO {0} ({1}) SELECT {1} FROM {2} ON CONFLICT ({3}) DO UPDATE SET {4} WHERE ({5}) IS DISTINCT FROM ({6})".format(
+                    table, column_list, incoming, key_list,
+                    ", ".join("{0} = EXCLUDED.{0}".format(column) for column in others),
+                    ", ".join("{}.{}".format(table, column) for column in others),
+                    ", ".join("EXCLUDED." + column for column in others))
+            with shard.cursor() as curs:
+                curs.execute(upsert)
+                changed += curs.rowcount
+
+        # children first, so nothing still references a deleted row
+        for index, table in reversed(list(enumerate(tables))):
+            match_on = keys[table] if len(keys[table]) > 0 else table_columns(shard, table)
+            with shard.cursor() as curs:
+                curs.execute("DELETE FROM {} AS t WHERE NOT EXISTS (SELECT 1 FROM sync_{} AS s WHERE ({}) IS NOT DISTINCT FROM ({}))".format(
+                    table, index,
+                    ", ".join("s." + column for column in match_on),
+                    ", ".join("t." + column for column in match_on)))
+                changed += curs.rowcount
+    return changed
+
+
+def sync(conn, tables: list[str] = REPLICATED_TABLES) -> list[int]:
+    """
+    Copies the accounts and the catalog from the directory to every shard,
+    all from one snapshot of the directory.
+
+    :param conn: A ShardRouter whose connections are not inside a transaction.
+    :param tables: The tables to copy, in REPLICATED_TABLES' order.
+    :return: Rows changed on each shard after the directory.
+    """
+    return sync_primaries(routing.shard_primaries(conn), tables)
+
+
+def sync_primaries(primaries: list, tables: list[str] = REPLICATED_TABLES) -> list[int]:
+    """
+    sync() for callers holding the shards' primaries rather than a ShardRouter.
+
+    :param primaries: The primary of every shard, the directory first.
+    """
+    directory = primaries[0]
+    with transactions.transaction(directory, read_only=True):
+        with directory.cursor() as curs:
+            curs.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        return [sync_shard(directory, shard, tables) for shard in primaries[1:]]
+
+
+def migrate(conn) -> list[list]:
+    """
+    Applies the schema migrations to every shard and records each one's
+    number in its shard_identity.
+
+    :param conn: A ShardRouter or connection.
+    :return: The migrations applied on each shard.
+    """
+    import schema
+
+    applied = []
+    for number, shard in enumerate(routing.shard_primaries(conn)):
+        applied.append(schema.migrate(shard))
+        with transactions.transaction(shard):
+            with shard.cursor() as curs:
+                curs.execute("DELETE FROM shard_identity")
+                curs.execute("INSERT INTO shard_identity (shard) VALUES (%s)", (number,))
+    return applied
+
+
+def move_collections(source, destination, userid: int) -> None:
+    """
+    Copies a user's collections, which get new ids on the destination.
+    """
+    collection_columns = [column for column in table_columns(destination, "moviecollection") if column != "collectionid"]
+    link_columns = table_columns(destination, "incollection")
+    with source.cursor() as curs:
+        curs.execute("SELECT collectionid, {} FROM moviecollection WHERE madeby = %s".format(", ".join(collection_columns)), (userid,))
+        collections = curs.fetchall()
+        curs.execute("SELECT {} FROM incollection WHERE collectionid IN (SELECT collectionid FROM moviecollection WHERE madeby = %s)".format(", ".join(link_columns)), (userid,))
+        links = curs.fetchall()
+
+    new_ids = {}
+    with destination.cursor() as curs:
+        for collection in collections:
+            curs.execute("INSERT INTO moviecollection ({}) VALUES ({}) RETURNING collectionid".format(
+                ", ".join(collection_columns), ", ".join(["%s"] * len(collection_columns))), collection[1:])
+            new_ids[collection[0]] = curs.fetchone()[0]
+
+        position = link_columns.index("collectionid")
+        curs.executemany("INSERT INTO incollection ({}) VALUES ({})".format(", ".join(link_columns), ", ".join(["%s"] * len(link_columns))),
+                         [link[:position] + (new_ids[link[position]],) + link[position + 1:] for link in links])
+
+
+def delete_user_rows(conn, userid: int) -> None:
+    """
+    Deletes a user's sharded rows, except their follow edges.
+    """
+    with conn.cursor() as curs:
+        curs.execute("DELETE FROM incollection WHERE collectionid IN (SELECT collectionid FROM moviecollection WHERE madeby = %s)", (userid,))
+        curs.execute("DELETE FROM moviecollection WHERE madeby = %s", (userid,))
+        for table, condition in reversed(USER_ROWS):
+            curs.execute("DELETE FROM {} WHERE {}".format(table, condition), {"userid": userid})
+
+
+def move_user(conn, userid: int, shard: int) -> bool:
+    """
+    Moves a user's rows to another shard. The rows are copied and
+    committed there first, then the directory points at the new shard,
+    then the old rows are deleted, so the user's data is always reachable.
+    Running it again after a failure is safe.
+
+    :param conn: A ShardRouter whose connections are not inside a transaction.
+    :param userid: The user, who should be logged out.
+    :param shard: The shard to move them to.
+    :return: Whether anything moved (False if they were already there).
+    """
+    if shard < 0 or shard >= len(conn.shards):
+        raise ValueError("There is no shard %d" % shard)
+    current = conn.shard_of(userid)
+    if current == shard:
+        return False
+    primaries = routing.shard_primaries(conn)
+    source, destination = primaries[current], primaries[shard]
+
+    with transactions.transaction(source, read_only=True):
+        with source.cursor() as curs:
+            curs.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        with transactions.transaction(destination):
+            # leftovers of an earlier attempt
+            delete_user_rows(destination, userid)
+            for table, condition in USER_ROWS:
+                if table == "watched_user_movie_rollup":
+                    with destination.cursor() as curs:
+                        curs.execute("DELETE FROM watched_user_movie_rollup WHERE userid = %s", (userid,))
+                columns = table_columns(destination, table)
+                copy_rows(source, destination, "SELECT {} FROM {} WHERE {}".format(", ".join(columns), table, condition), {"userid": userid}, table, columns)
+            move_collections(source, destination, userid)
+
+            # edges already there belong to a followed user or follower on that shard
+            columns = ", ".join(table_columns(destination, "\"following\""))
+            with destination.cursor() as curs:
+                curs.execute("CREATE TEMPORARY TABLE moved_following (LIKE \"following\") ON COMMIT DROP")
+            copy_rows(source, destination, "SELECT {} FROM \"following\" WHERE {}".format(columns, USER_EDGES), {"userid": userid}, "moved_following", table_columns(destination, "\"following\""))
+            with destination.cursor() as curs:
+                curs.execute("INSERT INTO \"following\" ({0}) SELECT {0} FROM moved_following EXCEPT SELECT {0} FROM \"following\"".format(columns))
+
+        with source.cursor() as curs:
+            curs.execute("SELECT followerid, followingid FROM \"following\" WHERE " + USER_EDGES, {"userid": userid})
+            edges = curs.fetchall()
+
+    conn.place(userid, shard)
+
+    # edges stay where the other user still lives
+    others = set(follower if follower != userid else following for follower, following in edges)
+    placements = shards_of(primaries[0], others)
+    primaries[0].commit()
+    away = [other for other in others if placements[other] != current]
+    with transactions.transaction(source):
+        delete_user_rows(source, userid)
+        with source.cursor() as curs:
+            curs.execute("DELETE FROM \"following\" WHERE (followerid = %(userid)s AND followingid = ANY(%(away)s)) OR (followingid = %(userid)s AND followerid = ANY(%(away)s))",
+                         {"userid": userid, "away": away})
+    return True
+
+
+def users_per_shard(conn) -> list[int]:
+    """
+    How many users live on each shard.
+    """
+    directory = routing.primary_connection(conn)
+    counts = [0] * len(conn.shards)
+    with directory.cursor() as curs:
+        curs.execute(USERS_PER_SHARD_QUERY)
+        for shard, count in curs.fetchall():
+            counts[shard] = count
+    directory.commit()
+    return counts
+
+
+def plan_rebalance(conn) -> list[tuple[int, int]]:
+    """
+    Moves that even out the users per shard, fullest to emptiest, taking
+    the least recently active users who are idle.
+
+    :return: (userid, shard) moves.
+    """
+    directory = routing.primary_connection(conn)
+    counts = users_per_shard(conn)
+    target = -(-sum(counts) // len(counts))
+    movable = {}
+    with directory.cursor() as curs:
+        for shard, count in enumerate(counts):
+            if count > target:
+                curs.execute(MOVABLE_USERS_QUERY, (shard, IDLE_BEFORE_MOVE, count - target))
+                movable[shard] = [userid for (userid,) in curs.fetchall()]
+    directory.commit()
+
+    moves = []
+    for shard in movable:
+        for userid in movable[shard]:
+            emptiest = min(range(len(counts)), key=lambda index: counts[index])
+            if counts[shard] - counts[emptiest] <= 1:
+                break
+            moves.append((userid, emptiest))
+            counts[shard] -= 1
+            counts[emptiest] += 1
+    return moves
+
+
+def main() -> int:
+    """
+    Manages the shards from the command line.
+
+    :return: 0 on success
+    """
+    import schema
+    import sigmadb
+
+    arguments = sys.argv[1:]
+    command = arguments[0] if len(arguments) > 0 else "status"
+    if command not in ["status", "migrate", "sync", "move", "rebalance"] or (command == "move" and len(arguments) != 3):
+        print(__doc__)
+        return 1
+
+    credentials = sigmadb.load_credentials()
+    if credentials == None:
+        return 1
+
+    with sigmadb.connect(credentials) as conn:
+        if command == "migrate":
+            for number, applied in enumerate(migrate(conn)):
+                for migration in applied:
+                    print("Shard %d: applied %d: %s" % (number, migration.version, migration.description))
+        if not isinstance(conn, routing.ShardRouter):
+            print("No shards configured, everything is on the one database")
+            return 0 if command in ["status", "migrate"] else 1
+
+        match command:
+            case "status":
+                for number, (shard, count) in enumerate(zip(routing.shard_primaries(conn), users_per_shard(conn))):
+                    print("Shard %d: %d user(s), schema version %d" % (number, count, schema.current_version(shard)))
+            case "sync":
+                for number, changed in enumerate(sync(conn), start=1):
+                    print("Shard %d: %d row(s) changed" % (number, changed))
+            case "move":
+                userid, shard = int(arguments[1]), int(arguments[2])
+                if move_user(conn, userid, shard):
+                    print("Moved user %d to shard %d" % (userid, shard))
+                else:
+                    print("User %d is already on shard %d" % (userid, shard))
+            case "rebalance":
+                moves = plan_rebalance(conn)
+                for userid, shard in moves:
+                    if "dry-run" not in arguments[1:]:
+                        move_user(conn, userid, shard)
+                    print("User %d -> shard %d" % (userid, shard))
+                print("%d user(s) %s" % (len(moves), "would move" if "dry-run" in arguments[1:] else "moved"))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,18 +3,29 @@
 """
 The entry point for SigmaDB, the BEST movie database.
 
-usage: sigmadb.py
+usage: sigmadb.py [--profile [directory]]
+
+--profile times every menu action, see profiling.py.
 """
 
 import sys
-import psycopg2
-import getpass
-from sshtunnel import SSHTunnelForwarder
+import contextlib
 import json
 
+import catalog_snapshot
+import connections
 import user_funcs
 import movie_funcs
+import movie_cache
+import prefetch
+import profiling
 import input_utils
+import maintenance
+import routing
+import schema
+import statements
+import streaming
+import transactions
 
 pass_file = "credentials.json"
 
@@ -32,99 +43,198 @@ Welcome to:
 ======================================================
 """
 
+@contextlib.contextmanager
+def connect(credentials: dict, quiet: bool = False):
+    """
+    Opens the database connection(s) described by the credentials.
+
+    By default the database is reached through an SSH tunnel to starbug. If
+    the credentials have a "host" (and optionally "port" and "database") the
+    database is connected to directly instead, which is handy for a local
+    test instance. Each entry in "replicas" is a dict of connection
+    parameters overriding the primary's, reads are routed to them. Each
+    entry in "shards" is one too, users' data is spread over them and the
+    primary (see shards.py).
+
+    :param credentials: The parsed credentials file.
+    :param quiet: Don't print progress, e.g. from background threads.
+    :return: A context manager giving a connection, a routing.Router when replicas are configured, or a routing.ShardRouter when shards are.
+    """
+    with contextlib.ExitStack() as stack:
+        host, port = connections.open_tunnel(stack, credentials, quiet)
+        params = connections.connection_params(credentials, host, port)
+
+        conn = connections.open_connection(stack, params)
+        stack.enter_context(conn)
+        if not quiet:
+            print("Connected to database!")
+
+        replicas = [connections.open_connection(stack, params, replica) for replica in credentials.get("replicas", [])]
+
+        directory = conn
+        if len(replicas) > 0:
+            if not quiet:
+                print("Connected to %s replica(s)!" % len(replicas))
+            directory = routing.Router(conn, replicas, float(credentials.get("max_staleness", routing.DEFAULT_MAX_STALENESS)))
+
+        shards = []
+        for shard in credentials.get("shards", []):
+            shard_conn = connections.open_connection(stack, params, shard)
+            stack.enter_context(shard_conn)
+            shards.append(shard_conn)
+
+        if len(shards) == 0:
+            yield directory
+        else:
+            if not quiet:
+                print("Connected to %s shard(s)!" % len(shards))
+            router = routing.ShardRouter(directory, shards)
+            stack.callback(router.close)
+            yield router
+
+
+def load_credentials() -> dict:
+    """
+    Reads and checks the credentials file, applying any settings in it.
+
+    :return: The credentials, or None if they are incomplete.
+    """
+    with open(pass_file, 'r') as cf:
+        credentials = json.load(cf)
+
+    if not "username" in credentials:
+        print("Missing CS account username")
+        return None
+    if not "password" in credentials:
+        print("Missing CS account password")
+        return None
+
+    # optional: how many rows large result sets fetch per round trip
+    if "batch_size" in credentials:
+        streaming.batch_size = int(credentials["batch_size"])
+
+    return credentials
+
+
+# Names of the main menu's actions in profiles
+MENU_ACTIONS = {
+    "2": "browse movies",
+    "3": "manage followed users",
+    "4": "create collection",
+    "5": "browse collections",
+    "6": "recommended movies",
+    "7": "view profile",
+    "8": "maintenance status",
+}
+
+
 def main():
     """
     The entry point for the program
 
     :return: 0 on success
     """
-    try:
-        with open('credentials.json', 'r') as cf:
-            credentials = json.load(cf)
-
-        if not "username" in credentials:
-            print("Missing CS account username")
+    args = sys.argv[1:]
+    if len(args) > 0:
+        if args[0] != "--profile" or len(args) > 2:
+            print(__doc__)
             return 1
-        if not "password" in credentials:
-            print("Missing CS account password")
+        profiling.start(args[1] if len(args) == 2 else profiling.DEFAULT_DIRECTORY)
+
+    try:
+        credentials = load_credentials()
+        if credentials == None:
             return 1
-        dbuser = credentials["username"]
-        dbpass = credentials["password"]
-
-        with SSHTunnelForwarder(
-            ('starbug.cs.rit.edu', 22),
-            ssh_username=dbuser,
-            ssh_password=dbpass,
-            remote_bind_address=('127.0.0.1', 5432)) as server:
-
-            server.start()
-            print("Connected to server!")
-
-            params = {
-                'database': 'p320_10',
-                'user': dbuser,
-                'password': dbpass,
-                'host': '127.0.0.1',
-                'port': server.local_bind_port
-                }
-
-            with psycopg2.connect(**params) as conn:
-                print("Connected to database!")
-
-                print(sigma_title)
-
-                login_choice = input_utils.get_input_matching("Would you like create an account (1) or login (2): ", regex="[12]")
-                username = ""
-                userid = -1
-                if login_choice == "1":
+
+        with connect(credentials) as conn:
+            version = schema.current_version(routing.primary_connection(conn))
+            if version < schema.MIGRATIONS[-1].version:
+                print("Warning: the database schema is at version %d of %d, run schema.py migrate" % (version, schema.MIGRATIONS[-1].version))
+
+            # optional: browse a local copy of the catalog instead of the database
+            snapshot = None
+            if "catalog_snapshot" in credentials:
+                snapshot = catalog_snapshot.open_snapshot(routing.primary_connection(conn), credentials["catalog_snapshot"])
+
+            # no transaction stays open while waiting for input
+            transactions.interactive(conn, credentials)
+            # hear about changed movies before trusting cached ones
+            movie_cache.listen(conn, credentials)
+
+            print(sigma_title)
+
+            login_choice = input_utils.get_input_matching("Would you like create an account (1) or login (2): ", regex="[12]")
+            username = ""
+            userid = -1
+            if login_choice == "1":
+                with profiling.action("create account"):
                     username, userid = user_funcs.create_account(conn)
-                elif login_choice == "2":
+            elif login_choice == "2":
+                with profiling.action("login"):
                     username, userid = user_funcs.login(conn)
 
-                # Login failed (somehow), this shouldn't be possible (normally)
-                if username == "" or userid == -1:
-                    return 1
+            # Login failed (somehow), this shouldn't be possible (normally)
+            if username == "" or userid == -1:
+                return 1
 
-                print(f"\nWelcome {username}!\n")
+            print(f"\nWelcome {username}!\n")
 
+            # load what the menus show first while the user decides
+            prefetch.start(credentials, userid)
+            try:
                 print("What would you like to do?")
 
                 action = ""
                 while action != "1":
-                    action = input_utils.get_input_matching("1 - exit\n2 - browse movies\n3 - manage followed users\n4 - create collection\n5 - browse collections\n6 - recommended movies\n7 - View my profile\n>", regex='[1234567]')
-
-                    match action:
-                        case "2":
-                            selected_movie_id = movie_funcs.browse_movies(conn)
-                            if selected_movie_id != -1:
-                                watch_or_rate = input_utils.get_input_matching("1 - watch movie\n2 - rate movie\n> ", regex="[12]")
-                                if watch_or_rate == "1":
-                                    movie_funcs.watch_movie(conn, userid, selected_movie_id)
-                                elif watch_or_rate == "2":
-                                    movie_funcs.rate_movie(conn, userid, selected_movie_id)
-                        case "3":
-                            user_funcs.following_menu(conn, userid)
-                        case "4":
-                            user_funcs.create_collection(conn, userid)
-                        case "5":
-                            collection_id = user_funcs.browse_collections(conn, userid)
-                            if collection_id != -1:
-                                user_funcs.modify_collection(conn, userid, collection_id)
-                        case "6":
-                            select_recommended = input_utils.get_input_matching("1 - View most popular (last 90 days)\n2 - View most popular among followers\n3 - View top releases of the month\n4 - For you\n>", regex='[1234]')
-                            match select_recommended:
-                                case "1":
-                                    movie_funcs.top_20_last_90_days(conn)
-                                case "2":
-                                    movie_funcs.top_20_among_followers(conn, userid)
-                                case "3":
-                                    movie_funcs.top_5_releases_of_month(conn)
-                                case "4":
-                                    movie_funcs.view_recommended(conn, userid)
-                        case'7':
-                            user_funcs.view_profile(conn, userid)
+                    action = input_utils.get_input_matching("1 - exit\n2 - browse movies\n3 - manage followed users\n4 - create collection\n5 - browse collections\n6 - recommended movies\n7 - View my profile\n8 - maintenance status\n>", regex='[12345678]')
+
+                    if action == "1":
+                        break
+
+                    with profiling.action(MENU_ACTIONS[action]):
+                        match action:
+                            case "2":
+                                if snapshot != None:
+                                    selected_movie_id = catalog_snapshot.browse(snapshot)
+                                else:
+                                    selected_movie_id = movie_funcs.browse_movies(conn)
+                                if selected_movie_id != -1:
+                                    watch_or_rate = input_utils.get_input_matching("1 - watch movie\n2 - rate movie\n3 - more like this\n> ", regex="[123]")
+                                    if watch_or_rate == "1":
+                                        movie_funcs.watch_movie(conn, userid, selected_movie_id)
+                                    elif watch_or_rate == "2":
+                                        movie_funcs.rate_movie(conn, userid, selected_movie_id)
+                                    elif watch_or_rate == "3":
+                                        movie_funcs.more_like_this(conn, selected_movie_id, userid)
+                            case "3":
+                                user_funcs.following_menu(conn, userid)
+                            case "4":
+                                user_funcs.create_collection(conn, userid)
+                            case "5":
+                                collection_id = user_funcs.browse_collections(conn, userid)
+                                if collection_id != -1:
+                                    user_funcs.modify_collection(conn, userid, collection_id)
+                            case "6":
+                                select_recommended = input_utils.get_input_matching("1 - View most popular (last 90 days)\n2 - View most popular among followers\n3 - View top releases of the month\n4 - For you\n>", regex='[1234]')
+                                match select_recommended:
+                                    case "1":
+                                        movie_funcs.top_20_last_90_days(conn)
+                                    case "2":
+                                        movie_funcs.top_20_among_followers(conn, userid)
+                                    case "3":
+                                        movie_funcs.top_5_releases_of_month(conn)
+                                    case "4":
+                                        movie_funcs.view_recommended(conn, userid)
+                            case'7':
+                                user_funcs.view_profile(conn, userid)
+                            case "8":
+                                maintenance.print_status()
+                                print()
+                                statements.print_plan_cache(routing.all_connections(conn))
 
                 print("Goodbye!")
+            finally:
+                prefetch.stop(userid)
 
     except KeyboardInterrupt:
         # Keyboard interrupt is not a failure
@@ -133,6 +243,8 @@ def main():
     except Exception as e:
         print(e)
         return 1
+    finally:
+        profiling.finish()
 
     return 0
 
@@ -0,0 +1,200 @@
+#!/bin/python3
+
+"""
+Content-based "more like this" neighbours.
+
+Every movie gets a sparse feature vector built from its genres, cast,
+directors and studios. Features are weighted by how rare they are (IDF)
+and by kind, and vectors are normalized, so the dot product of two movies
+is their cosine similarity. The nearest neighbours of every movie are
+computed in batches with array operations and stored in movie_similar,
+where movie_funcs.more_like_this reads them with a single index lookup.
+
+Features shared by more than MAX_FEATURE_MOVIES movies (a huge genre, say)
+are left out of the neighbour search. That bounds the work per movie on
+large catalogs, and since such features have the lowest IDF they barely
+move the scores anyway. Set it to None for the exact result.
+
+usage: similarity.py
+"""
+
+import io
+import sys
+
+import numpy as np
+
+import analytics
+import routing
+
+# (link query, weight) for each kind of feature
+FEATURE_QUERIES = [
+    ("SELECT movieid::int4, genreid::int4 FROM moviegenre", 1.0),
+    ("SELECT movieid::int4, crewid::int4 FROM actsin", 1.0),
+    ("SELECT movieid::int4, crewid::int4 FROM directed", 1.5),
+    ("SELECT movieid::int4, studioid::int4 FROM produced", 0.5),
+]
+
+# Neighbours stored per movie
+NEIGHBOURS = 20
+
+# Features on more movies than this are skipped by the search, None to keep all
+MAX_FEATURE_MOVIES = 5000
+
+# Size of the (batch x movies) score block computed at once
+BATCH_CELLS = 1 << 24
+
+
+class Features():
+    def __init__(self, conn):
+        """
+        Loads the links and builds the normalized feature vectors as
+        coordinate lists sorted by movie.
+
+        :param conn: Connection to the database.
+        """
+        movie_parts = []
+        feature_parts = []
+        weight_parts = []
+        self.feature_count = 0
+        for query, weight in FEATURE_QUERIES:
+            movies, entities = analytics.copy_columns(conn, query, [">i4", ">i4"])
+            # every kind of feature gets its own range of column numbers
+            entity_ids, entity_index = np.unique(entities, return_inverse=True)
+            movie_parts.append(movies)
+            feature_parts.append(entity_index.astype(np.int64) + self.feature_count)
+            weight_parts.append(np.full(len(movies), weight))
+            self.feature_count += len(entity_ids)
+        conn.commit()
+
+        self.movie_ids, rows = np.unique(np.concatenate(movie_parts), return_inverse=True)
+        features = np.concatenate(feature_parts)
+        weights = np.concatenate(weight_parts)
+
+        # a link listed twice is still one feature
+        keys, first = np.unique(rows.astype(np.int64) * max(self.feature_count, 1) + features, return_index=True)
+        self.rows = keys // max(self.feature_count, 1)
+        self.columns = keys % max(self.feature_count, 1)
+
+        self.movie_counts = np.bincount(self.columns, minlength=self.feature_count)
+        weights = weights[first] * np.log1p(len(self.movie_ids) / self.movie_counts[self.columns])
+        norms = np.sqrt(np.bincount(self.rows, weights=weights ** 2, minlength=len(self.movie_ids)))
+        self.weights = weights / norms[self.rows]
+
+
+def nearest_neighbours(features: Features, count: int = NEIGHBOURS, max_feature_movies: int = MAX_FEATURE_MOVIES) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The most similar movies to every movie.
+
+    :param features: The feature vectors.
+    :param count: Neighbours to find per movie.
+    :param max_feature_movies: Skip features on more movies than this, None to keep all.
+    :return: (neighbour row numbers, scores), both (movies x count). Missing neighbours are -1 with a score of 0.
+    """
+    movie_count = len(features.movie_ids)
+    neighbours = np.full((movie_count, count), -1, dtype=np.int64)
+    scores = np.zeros((movie_count, count))
+    if movie_count < 2:
+        return neighbours, scores
+
+    # postings: the movies having each feature
+    by_feature = np.argsort(features.columns, kind="stable")
+    posting_rows = features.rows[by_feature]
+    posting_weights = features.weights[by_feature]
+    posting_starts = np.concatenate(([0], np.cumsum(features.movie_counts)))
+
+    searched = np.ones(features.feature_count, dtype=bool)
+    if max_feature_movies != None:
+        searched = features.movie_counts <= max_feature_movies
+
+    row_starts = np.searchsorted(features.rows, np.arange(movie_count + 1))
+    batch = max(1, BATCH_CELLS // movie_count)
+    keep = min(count, movie_count - 1)
+    for start in range(0, movie_count, batch):
+        stop = min(movie_count, start + batch)
+        lo, hi = row_starts[start], row_starts[stop]
+        query_rows = features.rows[lo:hi] - start
+        query_columns = features.columns[lo:hi]
+        query_weights = features.weights[lo:hi]
+
+        used = searched[query_columns]
+        query_rows, query_columns, query_weights = query_rows[used], query_columns[used], query_weights[used]
+
+        # pair every query feature with every movie in its posting list
+        lengths = features.movie_counts[query_columns]
+        run_offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        positions = np.repeat(posting_starts[query_columns], lengths) + run_offsets
+        cells = np.repeat(query_rows, lengths) * movie_count + posting_rows[positions]
+        block = np.bincount(cells, weights=np.repeat(query_weights, lengths) * posting_weights[positions],
+                            minlength=(stop - start) * movie_count).reshape(stop - start, movie_count)
+        # a movie is not its own neighbour
+        block[np.arange(stop - start), np.arange(start, stop)] = 0
+
+        top = np.argpartition(-block, keep - 1, axis=1)[:, :keep]
+        top_scores = np.take_along_axis(block, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        neighbours[start:stop, :keep] = np.where(top_scores > 0, top, -1)
+        scores[start:stop, :keep] = np.where(top_scores > 0, top_scores, 0)
+
+    return neighbours, scores
+
+
+def store(conn, features: Features, neighbours: np.ndarray, scores: np.ndarray) -> int:
+    """
+    Replaces the contents of movie_similar in one transaction, readers keep
+    seeing the old neighbours until it commits.
+
+    :param conn: Connection to the primary.
+    :param features: The feature vectors the neighbours were found for.
+    :param neighbours: Neighbour row numbers from nearest_neighbours().
+    :param scores: Scores from nearest_neighbours().
+    :return: Rows written.
+    """
+    movie_rows, ranks = np.nonzero(neighbours >= 0)
+    buffer = io.StringIO()
+    for movie_row, rank in zip(movie_rows, ranks):
+        buffer.write("%d\t%d\t%d\t%.6f\n" % (features.movie_ids[movie_row], rank + 1, features.movie_ids[neighbours[movie_row, rank]], scores[movie_row, rank]))
+    buffer.seek(0)
+
+    with conn.cursor() as curs:
+        curs.execute("DELETE FROM movie_similar")
+        curs.copy_expert("COPY movie_similar (movieid, rank, similarid, score) FROM STDIN", buffer)
+        curs.execute("ANALYZE movie_similar")
+    conn.commit()
+    return len(movie_rows)
+
+
+def rebuild(conn) -> int:
+    """
+    Recomputes every movie's neighbours.
+
+    :param conn: Connection to the primary.
+    :return: Rows written to movie_similar.
+    """
+    features = Features(conn)
+    neighbours, scores = nearest_neighbours(features)
+    return store(conn, features, neighbours, scores)
+
+
+def main() -> int:
+    """
+    Rebuilds movie_similar from the command line.
+
+    :return: 0 on success
+    """
+    import sigmadb
+
+    credentials = sigmadb.load_credentials()
+    if credentials == None:
+        return 1
+
+    with sigmadb.connect(credentials) as conn:
+        rows = rebuild(routing.primary_connection(conn))
+    print("Stored %d neighbour(s)" % rows)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,193 @@
+#!/bin/python3
+
+"""
+A registry of named prepared statements for the hot queries.
+
+Queries are registered once (normally at import time) using the same %s
+placeholders as the rest of the code. The first time a statement is run on a
+connection it is PREPAREd on the server, after that it is run with EXECUTE so
+the server can skip parsing and, once it settles on a generic plan, planning.
+
+How the server has been planning them is shown by print_plan_cache(), the
+app prints it for its own connections under menu option 8.
+"""
+
+import re
+import threading
+import weakref
+
+# Matches the placeholders psycopg2 understands so they can be turned into
+# the $n parameters PREPARE expects
+PLACEHOLDER_PATTERN = re.compile(r"%%|%s")
+
+
+class Statement():
+    def __init__(self, name: str, query: str):
+        self.name = name
+        self.query = query
+        self.param_count = 0
+        self.server_text = PLACEHOLDER_PATTERN.sub(self._number_placeholder, query)
+        self.executions = 0
+        self.prepares = 0
+
+    def _number_placeholder(self, match) -> str:
+        if match.group(0) == "%%":
+            return "%"
+        self.param_count += 1
+        return "$%d" % self.param_count
+
+    def execute_text(self) -> str:
+        """
+        The EXECUTE command to send for this statement
+        """
+        if self.param_count == 0:
+            return "EXECUTE " + self.name
+        return "EXECUTE {} ({})".format(self.name, ", ".join(["%s"] * self.param_count))
+
+
+# name -> Statement
+_statements = {}
+
+# connection -> names of the statements already prepared on it
+_prepared = weakref.WeakKeyDictionary()
+
+# Guards the registry, _prepared and the counters, which worker threads
+# (loadgen sessions, prefetch workers) share. A connection is only used by
+# one thread at a time, so the queries themselves run outside it.
+_lock = threading.Lock()
+
+
+def register(name: str, query: str) -> str:
+    """
+    Registers a query under a name so it can be prepared and executed.
+
+    Registering the same name and query twice is harmless, registering a
+    different query under a name that is already taken is an error.
+
+    :param name: Name of the statement, must be a valid SQL identifier.
+    :param query: The query with %s placeholders.
+    :return: The name of the statement.
+    """
+    with _lock:
+        existing = _statements.get(name)
+        if existing != None:
+            if existing.query != query:
+                raise ValueError("Statement '%s' is already registered with a different query" % name)
+            return name
+
+        _statements[name] = Statement(name, query)
+    return name
+
+
+def get(name: str) -> Statement:
+    """
+    Looks up a registered statement.
+
+    :param name: Name of the statement.
+    :return: The statement.
+    """
+    return _statements[name]
+
+
+def registered() -> list[Statement]:
+    """
+    All the statements that have been registered so far.
+    """
+    with _lock:
+        return list(_statements.values())
+
+
+def execute(curs, name: str, args: tuple = ()) -> None:
+    """
+    Runs a registered statement, preparing it on the cursor's connection
+    first if it has not been prepared there yet.
+
+    Results are read from the cursor as usual (fetchone, fetchall, etc.)
+
+    :param curs: Cursor to execute with.
+    :param name: Name of the registered statement.
+    :param args: Arguments for the statement's placeholders.
+    """
+    statement = _statements[name]
+    if len(args) != statement.param_count:
+        raise ValueError("Statement '%s' takes %d argument(s), got %d" % (name, statement.param_count, len(args)))
+
+    with _lock:
+        prepared = _prepared.setdefault(curs.connection, set())
+        needs_prepare = name not in prepared
+
+    if needs_prepare:
+        curs.execute("PREPARE {} AS {}".format(name, statement.server_text))
+        with _lock:
+            prepared.add(name)
+            statement.prepares += 1
+
+    curs.execute(statement.execute_text(), args)
+    with _lock:
+        statement.executions += 1
+
+
+def forget(conn) -> None:
+    """
+    Forgets which statements were prepared on a connection, for example
+    after a DISCARD ALL or when the session was reset underneath us.
+
+    :param conn: The connection.
+    """
+    with _lock:
+        _prepared.pop(conn, None)
+
+
+def plan_cache_stats(conn) -> list[tuple]:
+    """
+    Reports how each statement prepared on a connection has been planned.
+
+    The server builds custom plans for the first few executions and then
+    switches to a cached generic plan if it is not more expensive, a
+    statement that keeps getting custom plans is still paying for planning
+    on every call.
+
+    :param conn: Connection to inspect.
+    :return: A list of (name, executions, prepares, generic plans, custom plans)
+    """
+    with conn.cursor() as curs:
+        curs.execute("SELECT name, generic_plans, custom_plans FROM pg_prepared_statements ORDER BY name")
+        server_stats = curs.fetchall()
+
+    stats = []
+    with _lock:
+        for name, generic_plans, custom_plans in server_stats:
+            statement = _statements.get(name)
+            if statement == None:
+                continue
+            stats.append((name, statement.executions, statement.prepares, generic_plans, custom_plans))
+
+    return stats
+
+
+def print_plan_cache(connections: list) -> None:
+    """
+    Prints plan_cache_stats() for some connections, each statement's plans
+    added up over the connections it was prepared on. Connections nothing
+    was prepared on are skipped.
+
+    :param connections: The connections, e.g. routing.all_connections().
+    """
+    with _lock:
+        prepared = [conn for conn in connections if len(_prepared.get(conn, ())) > 0]
+    if len(prepared) == 0:
+        print("No statements have been prepared yet")
+        return
+
+    totals = {}
+    for conn in prepared:
+        for name, executions, prepares, generic_plans, custom_plans in plan_cache_stats(conn):
+            # executions and prepares are counted for the whole process already
+            _, _, generic_total, custom_total = totals.get(name, (executions, prepares, 0, 0))
+            totals[name] = (executions, prepares, generic_total + generic_plans, custom_total + custom_plans)
+        # don't leave a snapshot open outside autocommit
+        conn.rollback()
+
+    print("Prepared statements on %d connection(s):" % len(prepared))
+    for name, (executions, prepares, generic_plans, custom_plans) in sorted(totals.items()):
+        print("\t%s: %d execution(s), %d prepare(s), %d generic plan(s), %d custom plan(s)" % (name, executions, prepares, generic_plans, custom_plans))
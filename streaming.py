@@ -0,0 +1,66 @@
+#!/bin/python3
+
+"""
+Streams query results through named server-side cursors.
+
+A regular psycopg2 cursor pulls the whole result set into memory on
+execute(), these helpers instead fetch a batch at a time so large results
+run in bounded memory and callers can start printing as soon as the first
+batch arrives.
+"""
+
+import contextlib
+import itertools
+
+import transactions
+
+# How many rows to pull from the server per round trip
+batch_size = 500
+
+# Named cursors must be unique within a transaction
+_cursor_ids = itertools.count()
+
+
+def stream_batches(conn, query: str, args: tuple = None, size: int = None):
+    """
+    Runs a query on a server-side cursor and yields its rows in batches.
+
+    Named cursors only live as long as the transaction they were opened in,
+    so the connection must not be committed until the generator finishes.
+    On an autocommit connection the cursor gets a read-only transaction of
+    its own that ends with the generator.
+
+    :param conn: Connection to the database.
+    :param query: The query to run.
+    :param args: Arguments for the query's placeholders.
+    :param size: Rows per batch. Leave None to use the module's batch_size.
+    :return: A generator of lists of rows.
+    """
+    if size == None:
+        size = batch_size
+
+    with contextlib.ExitStack() as stack:
+        if conn.autocommit:
+            stack.enter_context(transactions.transaction(conn, read_only=True))
+        curs = stack.enter_context(conn.cursor(name="sigma_stream_%d" % next(_cursor_ids)))
+        curs.itersize = size
+        curs.execute(query, args)
+        while True:
+            rows = curs.fetchmany(size)
+            if not rows:
+                break
+            yield rows
+
+
+def stream_rows(conn, query: str, args: tuple = None, size: int = None):
+    """
+    Runs a query on a server-side cursor and yields its rows one at a time.
+
+    :param conn: Connection to the database.
+    :param query: The query to run.
+    :param args: Arguments for the query's placeholders.
+    :param size: Rows per batch. Leave None to use the module's batch_size.
+    :return: A generator of rows.
+    """
+    for rows in stream_batches(conn, query, args, size):
+        yield from rows
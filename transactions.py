@@ -0,0 +1,115 @@
+#!/bin/python3
+
+"""
+Explicit transaction scopes.
+
+psycopg2 opens a transaction with the first statement and keeps it open
+until commit() or rollback(), so a function that queries and then waits at
+a prompt leaves its backend idle in transaction, holding a snapshot (and
+any locks) while the user reads the screen. Interactive sessions therefore
+run in autocommit (see interactive()): each plain statement is its own
+transaction and nothing stays open between statements. Work that needs
+several statements to see or change the data together opens a scope:
+
+transaction(conn, read_only=True): a short read-only transaction, e.g. for
+    a server-side cursor
+run_write(conn, work, ...): a read-write transaction that is retried when
+    it loses a serialization failure or deadlock
+
+Never prompt inside a scope. As a backstop interactive() also sets a
+statement timeout and an idle-in-transaction timeout, so a forgotten
+transaction is ended by the server instead of blocking vacuum.
+"""
+
+import contextlib
+import random
+import time
+
+import psycopg2.extensions
+
+import routing
+
+# Longest a single statement may run in an interactive session (ms)
+DEFAULT_STATEMENT_TIMEOUT = 30000
+
+# Longest an interactive session may sit idle inside a transaction (ms)
+DEFAULT_IDLE_TIMEOUT = 60000
+
+# serialization_failure and deadlock_detected, safe to retry from the top
+RETRY_CODES = {"40001", "40P01"}
+
+MAX_RETRIES = 5
+
+# First retry waits up to this long (seconds), doubling each time
+RETRY_BACKOFF = 0.05
+
+
+def interactive(conn, credentials: dict) -> None:
+    """
+    Puts every connection behind a connection or Router into autocommit and
+    sets its session timeouts.
+
+    :param conn: A connection or Router, not inside a transaction.
+    :param credentials: The parsed credentials file, may set "statement_timeout" and "idle_in_transaction_timeout" (ms).
+    """
+    statement_timeout = int(credentials.get("statement_timeout", DEFAULT_STATEMENT_TIMEOUT))
+    idle_timeout = int(credentials.get("idle_in_transaction_timeout", DEFAULT_IDLE_TIMEOUT))
+    for connection in routing.all_connections(conn):
+        connection.rollback()
+        connection.autocommit = True
+        with connection.cursor() as curs:
+            curs.execute("SET statement_timeout = %s", (statement_timeout,))
+            curs.execute("SET idle_in_transaction_session_timeout = %s", (idle_timeout,))
+
+
+@contextlib.contextmanager
+def transaction(conn, read_only: bool = False):
+    """
+    Runs a block in one transaction, committed if it finishes and rolled
+    back if it raises. Read-only transactions are always rolled back.
+
+    :param conn: Connection that is not already inside a transaction.
+    :param read_only: Whether the block only reads.
+    :return: A context manager giving the connection.
+    """
+    if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        raise RuntimeError("A transaction is already open on this connection")
+
+    autocommit = conn.autocommit
+    conn.autocommit = False
+    conn.readonly = read_only
+    try:
+        yield conn
+        if read_only:
+            conn.rollback()
+        else:
+            conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.readonly = None
+        conn.autocommit = autocommit
+
+
+def run_write(conn, work, *args, retries: int = MAX_RETRIES):
+    """
+    Runs work(cursor, *args) in a read-write transaction, starting over when
+    the transaction fails with a serialization failure or deadlock. The
+    work may run more than once, so it must not prompt or print.
+
+    :param conn: Connection that is not already inside a transaction.
+    :param work: Function doing the transaction's statements.
+    :param retries: How many times to start over before giving up.
+    :return: Whatever work returns.
+    """
+    for attempt in range(retries + 1):
+        try:
+            with transaction(conn) as tconn:
+                with tconn.cursor() as curs:
+                    return work(curs, *args)
+        except Exception as e:
+            if getattr(e, "pgcode", None) not in RETRY_CODES or attempt == retries:
+                raise
+        # back off with jitter so the conflicting sessions don't collide again
+        time.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** attempt))
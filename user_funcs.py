@@ -7,12 +7,23 @@ Functions to handle queries related to users
 from datetime import datetime
 import math
 
+import feed
 import input_utils
 import hashlib
+import movie_cache
 import movie_funcs
+import prefetch
+import routing
+import shards
+import statements
+import streaming
+import transactions
 
 MAX_INPUT_LEN = 255
 
+LOGIN_SELECT = statements.register("login_select", "SELECT username, userid FROM \"user\" WHERE username = %s AND password = %s")
+LOGIN_UPDATE_ACCESS = statements.register("login_update_access", "UPDATE \"user\" SET lastaccessdate = %s WHERE userid = %s")
+
 def pass_to_hash(password: str, username: str) -> str:
     """
     Converts a password to a hash stored in the database.
@@ -29,6 +40,12 @@ def pass_to_hash(password: str, username: str) -> str:
     hashfunc.update(saltfunc.digest())
     return hashfunc.hexdigest()
 
+USERNAME_TAKEN_QUERY = "SELECT * FROM \"user\" WHERE username = %s"
+EMAIL_TAKEN_QUERY = "SELECT * FROM \"user\" WHERE email=%s"
+INSERT_ACCOUNT_QUERY = "INSERT INTO \"user\"(firstname, lastname, username, password, email, creationdate, lastaccessdate) VALUES (%s, %s, %s, %s, %s, %s, %s)"
+USERID_BY_USERNAME_QUERY = "SELECT userid FROM \"user\" WHERE username = %s"
+
+@routing.cross_shard
 def create_account(conn) -> tuple[str, int]:
     """
     Guides the user through creating an account.
@@ -36,6 +53,8 @@ def create_account(conn) -> tuple[str, int]:
     :param conn: Connection to database.
     :return: A tuple (username, userid) of the new account.
     """
+    # accounts are made in the directory, then copied to every shard
+    directory = routing.connection_for(conn)
 
     print("Just need a few things to get you started!")
 
@@ -45,12 +64,12 @@ def create_account(conn) -> tuple[str, int]:
     password = ""
     email = ""
 
-    with conn.cursor() as curs:
+    with directory.cursor() as curs:
         while username == "":
             username = input_utils.get_input_matching(f"Username: ", MAX_INPUT_LEN)
 
             # need to check if usernam already taken in the db
-            curs.execute("SELECT * FROM \"user\" WHERE username = %s", (username,))
+            curs.execute(USERNAME_TAKEN_QUERY, (username,))
             results = curs.fetchall()
 
             if len(results) > 0:
@@ -62,7 +81,7 @@ def create_account(conn) -> tuple[str, int]:
             email = input_utils.get_input_matching(f"Email: ", MAX_INPUT_LEN, "^\S+@\S+\.\S+$", "Not a valid email address.")
 
             # need to check if email already taken in the db
-            curs.execute("SELECT * FROM \"user\" WHERE email=%s", (email,))
+            curs.execute(EMAIL_TAKEN_QUERY, (email,))
             results = curs.fetchall()
 
             if len(results) > 0:
@@ -73,32 +92,58 @@ def create_account(conn) -> tuple[str, int]:
         first_name = input_utils.get_input_matching(f"First Name: ", MAX_INPUT_LEN)
         last_name = input_utils.get_input_matching(f"Last Name: ", MAX_INPUT_LEN)
 
-        curs.execute("INSERT INTO \"user\"(firstname, lastname, username, password, email, creationdate, lastaccessdate) VALUES (%s, %s, %s, %s, %s, %s, %s)",\
-                    (first_name,\
-                    last_name,\
-                    username,\
-                    password,\
-                    email,\
-                    datetime.now(),\
-                    datetime.now()))
+    userid = transactions.run_write(directory, insert_account, first_name, last_name, username, password, email)
+    shards.add_account(conn, userid)
+    return (username, userid)
 
-        conn.commit()
 
-        curs.execute("SELECT userid FROM \"user\" WHERE username = %s", (username,))
-        results = curs.fetchall()
-        if len(results) != 1:
-            raise RuntimeError("User not found after being created!")
+def insert_account(curs, first_name, last_name, username, password, email) -> int:
+    """
+    Transaction body for create_account.
 
-        return (username, results[0][0])
+    :return: The new account's userid.
+    """
+    curs.execute(INSERT_ACCOUNT_QUERY,\
+                (first_name,\
+                last_name,\
+                username,\
+                password,\
+                email,\
+                datetime.now(),\
+                datetime.now()))
+
+    curs.execute(USERID_BY_USERNAME_QUERY, (username,))
+    results = curs.fetchall()
+    if len(results) != 1:
+        raise RuntimeError("User not found after being created!")
+
+    return results[0][0]
 
 
 def login(conn) -> tuple[str, int]:
     """
     Logins the user to their account
 
+    With shards the user's shard is looked up again, they may have been
+    moved while logged out.
+
     :param conn: Connection to database.
     :return: A tuple (username, userid) of the logged in account.
     """
+    account = check_login(conn)
+    routing.forget_placement(conn, account[1])
+    return account
+
+
+@routing.read_write
+def check_login(conn) -> tuple[str, int]:
+    """
+    Asks for a username and password until they match an account, and
+    records the access.
+
+    :param conn: Connection to database.
+    :return: A tuple (username, userid) of the account.
+    """
 
     username = ""
     password = ""
@@ -108,7 +153,7 @@ def login(conn) -> tuple[str, int]:
             username = input_utils.get_input_matching(f"Username: ", MAX_INPUT_LEN)
             password = pass_to_hash(input_utils.get_input_matching(f"Password: ", MAX_INPUT_LEN, hide_input=True), username)
 
-            curs.execute("SELECT username, userid FROM \"user\" WHERE username = %s AND password = %s", (username, password))
+            statements.execute(curs, LOGIN_SELECT, (username, password))
             results = curs.fetchall()
 
             if len(results) > 1:
@@ -116,7 +161,7 @@ def login(conn) -> tuple[str, int]:
 
             if len(results) == 1:
                 # update last login time to now
-                curs.execute("UPDATE \"user\" SET lastaccessdate = %s WHERE userid = %s", (datetime.now(), (results[0][1])))
+                statements.execute(curs, LOGIN_UPDATE_ACCESS, (datetime.now(), results[0][1]))
                 conn.commit()
 
                 return results[0]
@@ -124,6 +169,42 @@ def login(conn) -> tuple[str, int]:
             print("Username or password incorrect!")
 
 
+USER_BY_EMAIL_QUERY = "SELECT userid, username FROM \"user\" WHERE email=%s"
+IS_FOLLOWING_QUERY = "SELECT * FROM \"following\" WHERE followerid = %s AND followingid = %s"
+FOLLOW_QUERY = "INSERT INTO \"following\" (followerid, followingid) VALUES (%s, %s)"
+UNFOLLOW_QUERY = "DELETE FROM \"following\" WHERE followerid = %s AND followingid = %s"
+
+def follow_edge(curs, userid, followingid) -> None:
+    """
+    Transaction body for set_following, adding the edge if it isn't there.
+    """
+    curs.execute(IS_FOLLOWING_QUERY, (userid, followingid))
+    if curs.fetchone() == None:
+        curs.execute(FOLLOW_QUERY, (userid, followingid))
+
+
+def unfollow_edge(curs, userid, followingid) -> None:
+    """
+    Transaction body for set_following, removing the edge.
+    """
+    curs.execute(UNFOLLOW_QUERY, (userid, followingid))
+
+
+def set_following(conn, userid, followingid, follow: bool) -> None:
+    """
+    Follows or unfollows a user. With shards the edge is kept on both
+    users' shards (see shards.py), and written to each.
+
+    :param conn: Connection or ShardRouter.
+    :param userid: The follower.
+    :param followingid: The user followed.
+    :param follow: Whether to follow or unfollow.
+    """
+    for shard in routing.connections_for(conn, [userid, followingid]):
+        transactions.run_write(shard, follow_edge if follow else unfollow_edge, userid, followingid)
+
+
+@routing.cross_shard
 def follow_user(conn, userid):
     """
     Guides user through following another user specified by email
@@ -131,13 +212,14 @@ def follow_user(conn, userid):
     :param conn: Connection to database
     :param userid: ID of currently logged in user
     """
-    with conn.cursor() as curs:
+    local = routing.connection_for(conn, userid)
+    with local.cursor() as curs:
         # prompt for email to follow
         print("Who would you like to follow?")
         email = input_utils.get_input_matching("Email: ", MAX_INPUT_LEN,  "^\S+@\S+\.\S+$", "Not a valid email address")
 
         # check if user exists
-        curs.execute("SELECT userid, username FROM \"user\" WHERE email=%s", (email,))
+        curs.execute(USER_BY_EMAIL_QUERY, (email,))
         results = curs.fetchall()
         if len(results) == 0:
             print(f"\nUser with email {email} doesn't exist!")
@@ -151,7 +233,7 @@ def follow_user(conn, userid):
                 return
 
             # check if already following
-            curs.execute("SELECT * FROM \"following\" WHERE followerid = %s AND followingid = %s", (userid, followingid))
+            curs.execute(IS_FOLLOWING_QUERY, (userid, followingid))
             results = curs.fetchall()
             if len(results) > 0:
                 print(f"\nAlready following {following_username}!")
@@ -160,11 +242,13 @@ def follow_user(conn, userid):
                 answer = input_utils.get_input_matching(f"follow {following_username}? y/n\n", regex="[yn]")
                 match answer:
                     case "y":
-                        curs.execute("INSERT INTO \"following\" (followerid, followingid) VALUES (%s, %s)", (userid, followingid))
+                        set_following(conn, userid, followingid, True)
                         print(f"\nNow following {following_username}!")
-    conn.commit()
+    local.commit()
+    prefetch.refresh(userid, FOLLOWING, PROFILE)
 
 
+@routing.cross_shard
 def unfollow_user(conn, userid):
     """
     Guides user through unfollowing another user specified by email
@@ -172,13 +256,14 @@ def unfollow_user(conn, userid):
     :param conn: Connection to database
     :param userid: ID of currently logged in user
     """
-    with conn.cursor() as curs:
+    local = routing.connection_for(conn, userid)
+    with local.cursor() as curs:
         # prompt for email to unfollow
         print("Who would you like to unfollow?")
         email = input_utils.get_input_matching("Email: ", MAX_INPUT_LEN,  "^\S+@\S+\.\S+$", "Not a valid email address")
 
         # check if user exists
-        curs.execute("SELECT userid, username FROM \"user\" WHERE email=%s", (email,))
+        curs.execute(USER_BY_EMAIL_QUERY, (email,))
         results = curs.fetchall()
         if len(results) == 0:
             print(f"\nUser with email {email} doesn't exist!")
@@ -187,20 +272,35 @@ def unfollow_user(conn, userid):
             following_username = results[0][1]
 
             # check if already following
-            curs.execute("SELECT * FROM \"following\" WHERE followerid = %s AND followingid = %s", (userid, followingid))
+            curs.execute(IS_FOLLOWING_QUERY, (userid, followingid))
             results = curs.fetchall()
             # unfollow user
             if len(results) > 0:
                 answer = input_utils.get_input_matching(f"unfollow {following_username}? y/n\n", regex="[yn]")
                 match answer:
                     case "y":
-                        curs.execute("DELETE FROM \"following\" WHERE followerid = %s AND followingid = %s", (userid, followingid))
+                        set_following(conn, userid, followingid, False)
                         print(f"\nUnfollowed {following_username}!")
             else:
                 print(f"\nNot following {following_username}!")
-    conn.commit()
+    local.commit()
+    prefetch.refresh(userid, FOLLOWING, PROFILE)
 
 
+FOLLOWING_PAGE_QUERY = "SELECT username, email, userid FROM \"user\" WHERE userid IN (SELECT followingid FROM \"following\" WHERE followerid = %s LIMIT %s OFFSET %s)"
+
+def fetch_following(conn, userid) -> list[tuple]:
+    """
+    The first page of view_following.
+    """
+    with conn.cursor() as curs:
+        curs.execute(FOLLOWING_PAGE_QUERY, (userid, 10, 0))
+        return curs.fetchall()
+
+# Loaded right after login (see prefetch.py)
+FOLLOWING = prefetch.register("following", fetch_following)
+
+@routing.cross_shard
 def view_following(conn, userid):
     """
     Displays 10 other users that the current user follows at a time and gives
@@ -209,15 +309,18 @@ def view_following(conn, userid):
     :param conn: Connection to database
     :param userid: ID of currently logged in user
     """
-    with conn.cursor() as curs:
+    local = routing.connection_for(conn, userid)
+    with local.cursor() as curs:
 
         action = ""
         start_index = 0
         end_index = 10
         while action != "1":
             # get next 10 users that are followed
-            curs.execute("SELECT username, email, userid FROM \"user\" WHERE userid IN (SELECT followingid FROM \"following\" WHERE followerid = %s LIMIT %s OFFSET %s)", (userid, end_index, start_index))
-            results = curs.fetchall()
+            results = prefetch.get(userid, FOLLOWING) if start_index == 0 else None
+            if results == None:
+                curs.execute(FOLLOWING_PAGE_QUERY, (userid, end_index, start_index))
+                results = curs.fetchall()
 
             # if following anyone, display them
             if len(results) > 0:
@@ -258,7 +361,8 @@ def view_following(conn, userid):
                                 selection_id = results[selection_index][2]
                                 selection_username = results[selection_index][0]
                                 # unfollow user
-                                curs.execute("DELETE FROM \"following\" WHERE followerid = %s AND followingid = %s", (userid, selection_id))
+                                set_following(conn, userid, selection_id, False)
+                                prefetch.refresh(userid, FOLLOWING, PROFILE)
                                 print(f"Unfollowed %s!\n" % (selection_username))
                             else:
                                 print("\nInvalid selection!")
@@ -268,7 +372,51 @@ def view_following(conn, userid):
                 break
         print("\nBack to manage following submenu!")
 
-    conn.commit()
+    local.commit()
+
+
+@routing.scatter
+def view_feed(conn, userid):
+    """
+    Shows what the users the current user follows recently watched and
+    rated, a page at a time.
+
+    :param conn: Connection to database
+    :param userid: ID of currently logged in user
+    """
+    # cursors of the pages shown so far, to go back to
+    pages = [feed.FIRST_PAGE]
+    while True:
+        # with shards every shard sends its authors' events
+        results = feed.page(conn, userid, pages[-1])
+
+        if len(results) == 0 and len(pages) == 1:
+            print("\nNothing from the people you follow yet!")
+            return
+
+        titles = movie_funcs.titles(routing.connection_for(conn, userid), [result[3] for result in results])
+        print("\nActivity feed:")
+        for (activityid, username, kind, movieid, value, created), title in zip(results, titles):
+            when = created.strftime("%m/%d/%Y %I:%M %p")
+            if kind == "watch":
+                print("\t%s watched '%s' for %s minutes (%s)" % (username, title, value, when))
+            else:
+                print("\t%s rated '%s' %s stars (%s)" % (username, title, value, when))
+        if len(results) < feed.PAGE_SIZE:
+            print("End of activity feed!")
+
+        action = input_utils.get_input_matching("\n1 - back to manage following menu\n2 - view more\n3 - view previous\n", regex="[123]")
+        match action:
+            case "1":
+                return
+            case "2":
+                if len(results) == feed.PAGE_SIZE:
+                    pages.append(results[-1][0])
+            case "3":
+                if len(pages) > 1:
+                    pages.pop()
+                else:
+                    print("Can't go back any further!")
 
 
 def following_menu(conn, userid):
@@ -281,7 +429,7 @@ def following_menu(conn, userid):
     print("manage following submenu: What would you like to do?")
     action = ""
     while action != "1":
-        action = input_utils.get_input_matching("1 - back to menu\n2 - follow user\n3 - unfollow user\n4 - view who you're following\n", regex="[1234]")
+        action = input_utils.get_input_matching("1 - back to menu\n2 - follow user\n3 - unfollow user\n4 - view who you're following\n5 - activity feed\n", regex="[12345]")
 
         match action:
             # follow a user
@@ -293,10 +441,16 @@ def following_menu(conn, userid):
             # view who you follow
             case "4":
                 view_following(conn, userid)
+            # what the people you follow have been watching and rating
+            case "5":
+                view_feed(conn, userid)
 
     print("Back to menu!")
 
 
+CREATE_COLLECTION_QUERY = "INSERT INTO moviecollection (name, madeby) VALUES (%s, %s)"
+
+@routing.read_write
 def create_collection(conn, user_id) -> None:
     """
     Creates a new empty collection for the user.
@@ -310,13 +464,57 @@ def create_collection(conn, user_id) -> None:
         user_id = str(user_id)
         #Creates an empty collection
         collection_name = input_utils.get_input_matching("What would you like to name your new collection?\n")
-        curs.execute("INSERT INTO moviecollection (name, madeby) VALUES (%s, %s)", (collection_name, user_id))
+        curs.execute(CREATE_COLLECTION_QUERY, (collection_name, user_id))
 
     print("Collection created!")
 
     conn.commit()
+    prefetch.refresh(int(user_id), COLLECTIONS, PROFILE)
+
 
+# titles and lengths come from movie_cache
+COLLECTION_MOVIES_QUERY = "SELECT movieid FROM incollection WHERE collectionid = %s"
+
+# A query to remove a movie from a collection
+REMOVE_MOVIE_QUERY = """
+DELETE FROM incollection
+WHERE movieid = %s AND collectionid = %s
+"""
+# A query to add a movie into a collection
+ADD_MOVIE_QUERY = """
+INSERT INTO incollection (movieid, collectionid)
+VALUES (%s, %s)
+"""
+IN_COLLECTION_QUERY = "SELECT COUNT(*) FROM incollection WHERE movieid = %s AND collectionid = %s"
+# Deletes a collection from the table
+DELETE_MOVIECOLLECTION_QUERY = """
+DELETE FROM moviecollection
+WHERE collectionid = %s
+"""
+# Deletes all movie IDs associated with the collection ID
+DELETE_ALL_MOVIE_QUERY = """
+DELETE FROM incollection
+WHERE collectionid = %s
+"""
+# Changes the name of the collection
+CHANGE_NAME_QUERY = """
+UPDATE moviecollection
+SET name = %s
+WHERE collectionid = %s
+"""
+WATCH_COLLECTION_QUERY = """
+WITH viewing(userid, datetime) AS (VALUES (%s::integer, %s::timestamp))
+INSERT INTO watched (userid, movieid, datetime, watchduration)
+SELECT viewing.userid, ic.movieid, viewing.datetime, m.length
+FROM incollection AS ic
+LEFT JOIN movie AS m
+ON (m.movieid = ic.movieid)
+CROSS JOIN viewing
+WHERE ic.collectionid = %s
+RETURNING movieid, watchduration
+"""
 
+@routing.read_write
 def modify_collection(conn, user_id, collection_id) -> None:
     """
     Modify a collection or view movies in it
@@ -325,56 +523,16 @@ def modify_collection(conn, user_id, collection_id) -> None:
     :param user_id: The ID of the user
     :param collection_id: The ID of the collection
     """
-
-    # A query to remove a movie from a collection
-    remove_movie_query = """
-    DELETE FROM incollection
-    WHERE movieid = %s AND collectionid = %s
-    """
-    # A query to add a movie into a collection
-    add_movie_query = """
-    INSERT INTO incollection (movieid, collectionid)
-    VALUES (%s, %s)
-    """
-    # Deletes a collection from the table
-    delete_moviecollection_query = """
-    DELETE FROM moviecollection
-    WHERE collectionid = %s
-    """
-
-    # Deletes all movie IDs associated with the collection ID
-    delete_all_movie_query = """
-    DELETE FROM incollection
-    WHERE collectionid = %s
-    """
-
-    # Changes the name of the collection
-    change_name_query = """
-    UPDATE moviecollection
-    SET name = %s
-    WHERE collectionid = %s
-    """
-
-    watch_collection_query = """
-    WITH viewing(userid, datetime) AS (VALUES (%s, %s))
-    INSERT INTO watched (userid, movieid, datetime, watchduration)
-    SELECT viewing.userid, ic.movieid, viewing.datetime, m.length
-    FROM incollection AS ic
-    LEFT JOIN movie AS m
-    ON (m.movieid = ic.movieid)
-    CROSS JOIN viewing
-    WHERE ic.collectionid = %s
-    """
-
     with conn.cursor() as curs:
         while True:
-            curs.execute("SELECT ic.movieid, title, length FROM incollection AS ic LEFT JOIN movie ON (ic.movieid = movie.movieid) WHERE ic.collectionid = %s ORDER BY title", (collection_id,))
-            results = curs.fetchall()
-
             print("\nMovies in collection: ")
-            for i in range(0, len(results)):
-                result = results[i]
-                print("%d - %s (%s min) " % ((i,) + result[1:]))
+            movie_ids = [movie_id for (movie_id,) in streaming.stream_rows(conn, COLLECTION_MOVIES_QUERY, (collection_id,))]
+            conn.commit()
+            movies = movie_cache.get_many(conn, movie_ids)
+            movie_ids.sort(key=lambda movie_id: movies[movie_id].title if movie_id in movies else "")
+            for i, movie_id in enumerate(movie_ids):
+                movie = movies.get(movie_id)
+                print("%d - %s (%s min) " % (i, movie.title if movie != None else None, movie.length if movie != None else None))
 
             print("\nWhat would you like to do?")
             action = int(input_utils.get_input_matching("1 - exit to main menu\n2 - watch all movies\n3 - remove a movie\n4 - add a movie \n5 - modify name of collection\n6 - delete collection\n", regex="^[123456]"))
@@ -382,14 +540,15 @@ def modify_collection(conn, user_id, collection_id) -> None:
                 case 1:
                     return
                 case 2:
-                    curs.execute(watch_collection_query, (user_id, datetime.now(), collection_id,))
-                    conn.commit()
+                    transactions.run_write(conn, watch_collection, user_id, collection_id, datetime.now())
+                    prefetch.refresh(user_id, movie_funcs.WATCHED, movie_funcs.FOR_YOU_IDS)
                     print("Watched all movies!")
                 case 3:
                     selected_movie = int(input_utils.get_input_matching("Select a movie above to remove: ", regex="^(?:\d+)$"))
-                    if selected_movie >= 0 and selected_movie < len(results):
-                        curs.execute(remove_movie_query, (results[selected_movie][0], collection_id))
+                    if selected_movie >= 0 and selected_movie < len(movie_ids):
+                        curs.execute(REMOVE_MOVIE_QUERY, (movie_ids[selected_movie], collection_id))
                         conn.commit()
+                        prefetch.refresh(user_id, COLLECTIONS)
                         print("Movie removed!")
                     else:
                         print("Not a movie in the collection.")
@@ -398,134 +557,195 @@ def modify_collection(conn, user_id, collection_id) -> None:
                     if movie_id == -1:
                         print("No movie added!")
                     else:
-                        # check if the movie is already in the collection
-                        curs.execute("SELECT COUNT(*) FROM incollection WHERE movieid = %s AND collectionid = %s", (movie_id, collection_id))
-                        if int(curs.fetchone()[0]) > 0:
-                            print("Movie already in collection!")
-                        else:
-                            curs.execute(add_movie_query, (movie_id, collection_id))
+                        if transactions.run_write(conn, add_to_collection, movie_id, collection_id):
+                            prefetch.refresh(user_id, COLLECTIONS)
                             print("Movie added!")
+                        else:
+                            print("Movie already in collection!")
                     conn.commit()
                 case 5:
                     new_name = input_utils.get_input_matching("What would you like to name your collection: ")
-                    curs.execute(change_name_query, (new_name, collection_id))
+                    curs.execute(CHANGE_NAME_QUERY, (new_name, collection_id))
                     conn.commit()
+                    prefetch.refresh(user_id, COLLECTIONS)
                 case 6:
-                    curs.execute(delete_all_movie_query, (collection_id,))
-                    curs.execute(delete_moviecollection_query, (collection_id,))
-                    conn.commit()
+                    transactions.run_write(conn, delete_collection, collection_id)
+                    prefetch.refresh(user_id, COLLECTIONS, PROFILE)
                     print("Collection deleted!")
                     return
 
 
-def browse_collections(conn, user_id) -> None:
+def add_to_collection(curs, movie_id, collection_id) -> bool:
     """
-    Displays all the user's collections
+    Transaction body for adding a movie in modify_collection.
 
-    :param conn: Connection to the database
-    :param user_id: The ID of the user
-    :return: The collection id to modify or -1 if none selected
+    :return: Whether the movie was added (False if it was already there).
     """
+    # check if the movie is already in the collection
+    curs.execute(IN_COLLECTION_QUERY, (movie_id, collection_id))
+    if int(curs.fetchone()[0]) > 0:
+        return False
+    curs.execute(ADD_MOVIE_QUERY, (movie_id, collection_id))
+    return True
 
-    get_collections_query = """
-    SELECT collectionid, name,
-    (
-        SELECT COUNT(movieid) FROM incollection AS ic
-        WHERE ic.collectionid = mc.collectionid
-    ) AS movie_count,
-    (
-        SELECT SUM(length) FROM movie as m
-        WHERE m.movieid in
-        (
-            SELECT movieid FROM incollection AS ic
-            WHERE ic.collectionid = mc.collectionid
-        )
-    ) AS total_length
-    FROM moviecollection AS mc
-    WHERE mc.madeby = %s
-    ORDER BY name ASC
+
+def watch_collection(curs, user_id, collection_id, date_watched) -> None:
+    """
+    Transaction body for watching every movie in modify_collection, each
+    watch goes to the user's followers' feeds.
     """
+    curs.execute(WATCH_COLLECTION_QUERY, (user_id, date_watched, collection_id,))
+    feed.publish(curs, user_id, "watch", curs.fetchall(), date_watched)
 
-    with conn.cursor() as curs:
-        while True:
-            curs.execute(get_collections_query, (user_id,))
-            results = curs.fetchall()
 
-            print("\nFound %s collection(s)" % len(results))
-            for i in range(0, len(results)):
-                result = results[i]
-                if result[-1] != None:
-                    minutes = int(result[-1])
-                    hours = math.floor(minutes / 60)
-                    minutes %= 60
-                else:
-                    minutes = 0
-                    hours = 0
-                print("%d - %s: %s Movies (%s:%s hrs:min) " % ((i,) + result[1:-1] + (hours,) + (minutes,)))
+def delete_collection(curs, collection_id) -> None:
+    """
+    Transaction body for deleting a collection in modify_collection, the
+    movies and the collection go together.
+    """
+    curs.execute(DELETE_ALL_MOVIE_QUERY, (collection_id,))
+    curs.execute(DELETE_MOVIECOLLECTION_QUERY, (collection_id,))
 
-            user_input = input_utils.get_input_matching("\nSelect a collection number to view it or 'e' to return to menu\n", regex='^(?:\d+|[e])$')
 
-            if user_input == 'e':
-                return -1
-            elif int(user_input) >= 0 and int(user_input) < len(results):
-                return results[int(user_input)][0]
-            else:
-                print("Not a valid id!")
+GET_COLLECTIONS_QUERY = """
+SELECT collectionid, name,
+(
+    SELECT COUNT(movieid) FROM incollection AS ic
+    WHERE ic.collectionid = mc.collectionid
+) AS movie_count,
+(
+    SELECT SUM(length) FROM movie as m
+    WHERE m.movieid in
+    (
+        SELECT movieid FROM incollection AS ic
+        WHERE ic.collectionid = mc.collectionid
+    )
+) AS total_length
+FROM moviecollection AS mc
+WHERE mc.madeby = %s
+ORDER BY name ASC
+"""
 
+def fetch_collections(conn, user_id) -> list[tuple]:
+    """
+    The user's collections with their movie counts and total lengths.
+    """
+    results = list(streaming.stream_rows(conn, GET_COLLECTIONS_QUERY, (user_id,)))
     conn.commit()
+    return results
 
-def view_profile(conn, userid) -> None:
+# Loaded right after login (see prefetch.py)
+COLLECTIONS = prefetch.register("collections", fetch_collections)
+
+@routing.read_only
+def browse_collections(conn, user_id) -> None:
     """
-    Displays a users profile information of following, number of collections
-    and top ten rated movies
-    
+    Displays all the user's collections
+
     :param conn: Connection to the database
-    :param userid: The ID of the user
-    :return: Nothing since it displays viewer profile.
-    """
-    # gets the number of collections for a user
-    get_num_collections = """
-    SELECT COUNT(collectionid) 
-    FROM moviecollection
-    WHERE madeby = %s
+    :param user_id: The ID of the user
+    :return: The collection id to modify or -1 if none selected
     """
 
-    # get number of followers a user is following 
-    get_num_followers = """
-    SELECT COUNT(followingid)
-    FROM following AS fw
-    WHERE fw.followerid = %s
-    """
+    while True:
+        results = prefetch.get(user_id, COLLECTIONS)
+        if results == None:
+            results = fetch_collections(conn, user_id)
+
+        collection_ids = []
+        for result in results:
+            if result[-1] != None:
+                minutes = int(result[-1])
+                hours = math.floor(minutes / 60)
+                minutes %= 60
+            else:
+                minutes = 0
+                hours = 0
+            print("%d - %s: %s Movies (%s:%s hrs:min) " % ((len(collection_ids),) + result[1:-1] + (hours,) + (minutes,)))
+            collection_ids.append(result[0])
+
+        print("\nFound %s collection(s)" % len(collection_ids))
+
+        user_input = input_utils.get_input_matching("\nSelect a collection number to view it or 'e' to return to menu\n", regex='^(?:\d+|[e])$')
+
+        if user_input == 'e':
+            return -1
+        elif int(user_input) >= 0 and int(user_input) < len(collection_ids):
+            return collection_ids[int(user_input)]
+        else:
+            print("Not a valid id!")
+
+
+# gets the number of collections for a user
+GET_NUM_COLLECTIONS = """
+SELECT COUNT(collectionid) 
+FROM moviecollection
+WHERE madeby = %s
+"""
+
+# get number of followers a user is following 
+GET_NUM_FOLLOWERS = """
+SELECT COUNT(followingid)
+FROM following AS fw
+WHERE fw.followerid = %s
+"""
+
+# Get number of users following a specific user
+GET_NUM_FOLLOWING = """
+SELECT COUNT(*)
+FROM following as fw
+WHERE fw.followingid = %s 
+"""
 
-    # Get number of users following a specific user
-    get_num_following = """
-    SELECT COUNT(*)
-    FROM following as fw
-    WHERE fw.followingid = %s 
+# Gets the movie names of the top ten highest rated movies for the user
+TEN_HIGHEST_RATINGS = """
+SELECT m.title FROM rated as r
+LEFT JOIN movie AS m
+ON m.movieid = r.movieid
+WHERE r.userid = %s
+ORDER BY r.rating DESC
+LIMIT 10
+"""
+
+def fetch_profile(conn, userid) -> tuple:
     """
+    What view_profile shows.
 
-    # Gets the movie names of the top ten highest rated movies for the user
-    ten_highest_ratings = """
-    SELECT m.title FROM rated as r
-    LEFT JOIN movie AS m
-    ON m.movieid = r.movieid
-    WHERE r.userid = %s
-    ORDER BY r.rating DESC
-    LIMIT 10
+    :return: (number of collections, followers, following, top ten rated titles)
     """
     with conn.cursor() as curs:
-        curs.execute(get_num_collections, (userid,))
+        curs.execute(GET_NUM_COLLECTIONS, (userid,))
         num_collections = curs.fetchone()[0]
-        print(f"Number of collections: {num_collections}")
-        curs.execute(get_num_followers, (userid,))
+        curs.execute(GET_NUM_FOLLOWERS, (userid,))
         num_followers = curs.fetchone()[0]
-        print(f"Number of followers: {num_followers}")
-        curs.execute(get_num_following, (userid,))
+        curs.execute(GET_NUM_FOLLOWING, (userid,))
         num_following = curs.fetchone()[0]
-        print(f"Number of users followed: {num_following}")
-        curs.execute(ten_highest_ratings, (userid,))
-        top_ten = curs.fetchall()
-        print("Top 10 rated movies: ")
-        for i in range(len(top_ten)):
-            print(f"{i+1}: {top_ten[i][0]}")
+        curs.execute(TEN_HIGHEST_RATINGS, (userid,))
+        top_ten = [title for (title,) in curs.fetchall()]
+    return (num_collections, num_followers, num_following, top_ten)
+
+# Loaded right after login (see prefetch.py)
+PROFILE = prefetch.register("profile", fetch_profile)
+
+@routing.read_only
+def view_profile(conn, userid) -> None:
+    """
+    Displays a users profile information of following, number of collections
+    and top ten rated movies
+    
+    :param conn: Connection to the database
+    :param userid: The ID of the user
+    :return: Nothing since it displays viewer profile.
+    """
+    profile = prefetch.get(userid, PROFILE)
+    if profile == None:
+        profile = fetch_profile(conn, userid)
+    num_collections, num_followers, num_following, top_ten = profile
+
+    print(f"Number of collections: {num_collections}")
+    print(f"Number of followers: {num_followers}")
+    print(f"Number of users followed: {num_following}")
+    print("Top 10 rated movies: ")
+    for i in range(len(top_ten)):
+        print(f"{i+1}: {top_ten[i]}")
     return